@@ -0,0 +1,876 @@
+from __future__ import print_function
+import sys
+import argparse
+import time
+import os
+import pickle
+import tempfile
+import shutil
+import json
+import io
+import tracemalloc
+import multiprocessing
+from contextlib import redirect_stdout
+from math import sqrt
+from itertools import product
+import torch
+import numpy as np
+from data import VOC_300, VOC_512, COCO_300, COCO_512, COCO_mobile_300, VOC_CLASSES
+from data.coco import load_coco_cache, COCODetection
+from data.voc_eval import voc_eval, voc_eval_all, voc_eval_table, gt_arrays, load_gt_cache, \
+    parse_rec, format_results
+from layers.functions import PriorBox, Detect
+from layers.functions import prior_box
+from layers.modules import MultiBoxLoss
+from utils.box_utils import match, match_batch, pad_targets, log_sum_exp, topk_mask, decode, \
+    select_candidates
+from utils.nms.cpu_nms import cpu_nms
+from utils.nms_wrapper import batched_nms_candidates
+from utils.detection_store import DetectionStore
+from utils.pycocotools.coco import COCO, COCOArrays
+from utils.pycocotools.cocoeval import COCOeval, COCOevalStream
+from utils.pycocotools import mask as maskUtils
+
+parser = argparse.ArgumentParser(
+    description='Receptive Field Block Net Microbenchmarks')
+parser.add_argument('bench', nargs='*', default=['match'],
+                    help='benchmarks to run: match, mining, priors, detect, nms, post, vocgt, voceval, '
+                         'cocoeval, cocogt')
+parser.add_argument('-s', '--size', default='512',
+                    help='300 or 512 input size.')
+parser.add_argument('-d', '--dataset', default='COCO',
+                    help='VOC or COCO version')
+parser.add_argument('-b', '--batch_size', default=32,
+                    type=int, help='Batch size')
+parser.add_argument('--max_objs', default=20, type=int,
+                    help='Max ground truth objects per image')
+parser.add_argument('--iters', default=10, type=int,
+                    help='Timed iterations per benchmark')
+parser.add_argument('--seed', default=0, type=int, help='Random seed')
+parser.add_argument('--top_k', default=None, type=int,
+                    help='Pre-NMS top-k per class for the nms and post benchmarks')
+parser.add_argument('--num_images', default=1000, type=int,
+                    help='Images in the synthetic evaluation benchmarks')
+parser.add_argument('--processes', default=4, type=int,
+                    help='Pool size for the parallel evaluation benchmarks')
+args = parser.parse_args()
+
+if args.dataset == 'VOC':
+    cfg = (VOC_300, VOC_512)[args.size == '512']
+    num_classes = 21
+else:
+    cfg = (COCO_300, COCO_512)[args.size == '512']
+    num_classes = 81
+
+
+# equivalence checks that failed; the run exits non-zero if there are any
+failures = []
+
+
+def check(name, same):
+    """Record the outcome of an equivalence check, returning it."""
+    if not same:
+        failures.append(name)
+    return same
+
+
+def timeit(fn, iters):
+    fn()  # warm up
+    t0 = time.time()
+    for _ in range(iters):
+        out = fn()
+    return (time.time() - t0) / iters, out
+
+
+def random_targets(num, max_objs, num_classes):
+    """Random point-form boxes with labels, one [num_obj,5] tensor per image."""
+    targets = []
+    for _ in range(num):
+        n = np.random.randint(1, max_objs + 1)
+        xy = np.random.uniform(0, 0.8, (n, 2))
+        wh = np.random.uniform(0.02, 0.6, (n, 2))
+        boxes = np.hstack((xy, np.minimum(xy + wh, 1.)))
+        labels = np.random.randint(1, num_classes, (n, 1))
+        targets.append(torch.from_numpy(
+            np.hstack((boxes, labels)).astype(np.float32)))
+    return targets
+
+
+def bench_match(priors):
+    targets = random_targets(args.batch_size, args.max_objs, num_classes)
+    num, num_priors = len(targets), priors.size(0)
+    variance = cfg['variance']
+
+    def per_image():
+        loc_t = torch.Tensor(num, num_priors, 4)
+        conf_t = torch.LongTensor(num, num_priors)
+        for idx in range(num):
+            match(0.5, targets[idx][:, :-1], priors, variance,
+                  targets[idx][:, -1], loc_t, conf_t, idx)
+        return loc_t, conf_t
+
+    def batched():
+        truths, labels, valid = pad_targets(targets)
+        return match_batch(0.5, truths, priors, variance, labels, valid)
+
+    t_ref, (loc_ref, conf_ref) = timeit(per_image, args.iters)
+    t_new, (loc_new, conf_new) = timeit(batched, args.iters)
+    pos = conf_ref > 0
+    same = check('match', torch.equal(conf_ref, conf_new) and
+                 torch.equal(loc_ref[pos], loc_new[pos]))
+    print('match: batch {:d}, {:d} priors'.format(num, num_priors))
+    print('  per-image {:.2f}ms  batched {:.2f}ms  speedup {:.1f}x  '
+          'identical: {}'.format(t_ref * 1e3, t_new * 1e3, t_ref / t_new, same))
+
+
+def bench_mining(priors):
+    targets = random_targets(args.batch_size, args.max_objs, num_classes)
+    num, num_priors = len(targets), priors.size(0)
+    loc_data = torch.randn(num, num_priors, 4)
+    conf_data = torch.randn(num, num_priors, num_classes) * 3
+    truths, labels, valid = pad_targets(targets)
+    _, conf_t = match_batch(0.5, truths, priors, cfg['variance'], labels, valid)
+    pos = conf_t > 0
+    num_neg = torch.clamp(3 * pos.long().sum(1, keepdim=True), max=num_priors - 1)
+
+    def double_sort():
+        batch_conf = conf_data.view(-1, num_classes)
+        loss_c = log_sum_exp(batch_conf) - batch_conf.gather(1, conf_t.view(-1, 1))
+        loss_c[pos.view(-1, 1)] = 0
+        loss_c = loss_c.view(num, -1)
+        _, loss_idx = loss_c.sort(1, descending=True)
+        _, idx_rank = loss_idx.sort(1)
+        return idx_rank < num_neg.expand_as(idx_rank)
+
+    def topk():
+        x_max = conf_data.max()
+        loss_c = (conf_data - x_max).exp_().sum(2).log_() + x_max
+        loss_c -= conf_data[:, :, 0]
+        loss_c[pos] = 0
+        return topk_mask(loss_c, num_neg)
+
+    t_ref, neg_ref = timeit(double_sort, args.iters)
+    t_new, neg_new = timeit(topk, args.iters)
+    losses = []
+    for mining in ('sort', 'topk'):
+        criterion = MultiBoxLoss(num_classes, 0.5, True, 0, True, 3, 0.5, False,
+                                 mining=mining)
+        loss_l, loss_c = criterion((loc_data, conf_data), priors, targets)
+        losses.append(loss_c.item())
+    print('mining: batch {:d}, {:d} priors, {:d} negatives'.format(
+        num, num_priors, int(neg_ref.sum())))
+    print('  double sort {:.2f}ms  top-k {:.2f}ms  speedup {:.1f}x  '
+          'identical: {}  conf loss {:.6f} / {:.6f}'.format(
+              t_ref * 1e3, t_new * 1e3, t_ref / t_new,
+              check('mining', torch.equal(neg_ref, neg_new)), losses[0], losses[1]))
+
+
+def looped_priors(pb):
+    """The original nested-loop PriorBox.forward, as reference."""
+    mean = []
+    for k, f in enumerate(pb.feature_maps):
+        for i, j in product(range(f), repeat=2):
+            f_k = pb.image_size / pb.steps[k]
+            cx = (j + 0.5) / f_k
+            cy = (i + 0.5) / f_k
+            s_k = pb.min_sizes[k]/pb.image_size
+            mean += [cx, cy, s_k, s_k]
+            s_k_prime = sqrt(s_k * (pb.max_sizes[k]/pb.image_size))
+            mean += [cx, cy, s_k_prime, s_k_prime]
+            for ar in pb.aspect_ratios[k]:
+                mean += [cx, cy, s_k*sqrt(ar), s_k/sqrt(ar)]
+                mean += [cx, cy, s_k/sqrt(ar), s_k*sqrt(ar)]
+    output = torch.Tensor(mean).view(-1, 4)
+    if pb.clip:
+        output.clamp_(max=1, min=0)
+    return output
+
+
+def bench_priors(priors):
+    cache_dir = tempfile.mkdtemp()
+    for name, c in [('VOC_300', VOC_300), ('VOC_512', VOC_512),
+                    ('COCO_300', COCO_300), ('COCO_512', COCO_512),
+                    ('COCO_mobile_300', COCO_mobile_300)]:
+        pb = PriorBox(c, cache_dir=cache_dir)
+        t_ref, ref = timeit(lambda: looped_priors(pb), args.iters)
+
+        def cold():
+            prior_box._prior_cache.clear()
+            return pb._generate()
+
+        def disk():
+            prior_box._prior_cache.clear()
+            return pb.forward()
+        t_gen, gen = timeit(cold, args.iters)
+        t_disk, from_disk = timeit(disk, args.iters)
+        t_mem, from_mem = timeit(pb.forward, args.iters)
+        same = check('priors ' + name, all(torch.equal(ref, p) for p in
+                                           (torch.from_numpy(gen), from_disk, from_mem)))
+        print('priors {:s}: {:d} priors'.format(name, ref.size(0)))
+        print('  loops {:.2f}ms  arrays {:.2f}ms  disk cache {:.2f}ms  '
+              'memo {:.3f}ms  bit-identical: {}'.format(
+                  t_ref * 1e3, t_gen * 1e3, t_disk * 1e3, t_mem * 1e3, same))
+
+
+def bench_detect(priors):
+    num, num_priors = args.batch_size, priors.size(0)
+    loc = torch.randn(num, num_priors, 4) * 0.5
+    conf = torch.softmax(torch.randn(num * num_priors, num_classes), -1)
+    detector = Detect(num_classes, 0, cfg)
+
+    def per_image():
+        boxes = torch.zeros(num, num_priors, 4)
+        scores = torch.zeros(num, num_priors, num_classes)
+        conf_preds = conf.view(num, num_priors, num_classes)
+        for i in range(num):
+            boxes[i] = decode(loc[i], priors, cfg['variance'])
+            scores[i] = conf_preds[i].clone()
+        return boxes, scores
+
+    t_ref, (boxes_ref, scores_ref) = timeit(per_image, args.iters)
+    t_new, (boxes, scores) = timeit(
+        lambda: detector.forward((loc, conf), priors), args.iters)
+    print('detect: batch {:d}, {:d} priors'.format(num, num_priors))
+    print('  per-image {:.2f}ms  batched {:.2f}ms  speedup {:.1f}x  '
+          'identical: {}'.format(t_ref * 1e3, t_new * 1e3, t_ref / t_new,
+                                 check('detect', torch.equal(boxes_ref, boxes) and
+                                       torch.equal(scores_ref, scores))))
+
+
+def random_detections(priors, num):
+    """Decoded boxes in pixels and peaky softmax scores, like a trained net."""
+    num_priors = priors.size(0)
+    loc = torch.randn(num, num_priors, 4) * 0.5
+    logits = torch.randn(num * num_priors, num_classes)
+    logits[:, 0] += 7
+    # a few percent of the priors see an object of some class
+    obj = torch.rand(num * num_priors) < 0.03
+    cls = torch.randint(1, num_classes, (int(obj.sum()),))
+    logits[obj.nonzero().view(-1), cls] += 9
+    conf = torch.softmax(logits, -1)
+    boxes, scores = Detect(num_classes, 0, cfg).forward((loc, conf), priors)
+    scale = torch.Tensor([500, 375, 500, 375])
+    return boxes * scale, scores.clone()
+
+
+def bench_nms(priors):
+    num = args.batch_size
+    boxes, scores = random_detections(priors, num)
+    img, cls, dets = [], [], []
+    for i in range(num):
+        c_cls, inds, c_scores = select_candidates(scores[i], 0.01, args.top_k)
+        img.append(np.full(len(c_cls), i))
+        cls.append(c_cls.numpy())
+        dets.append(torch.cat((boxes[i][inds], c_scores.unsqueeze(1)), 1).numpy())
+    img, cls, dets = np.concatenate(img), np.concatenate(cls), np.concatenate(dets)
+
+    def per_class():
+        all_dets = []
+        for i in range(num):
+            offsets = np.searchsorted(img * num_classes + cls,
+                                      i * num_classes + np.arange(num_classes + 1))
+            all_dets.append([None] + [dets[offsets[j]:offsets[j + 1]][
+                cpu_nms(dets[offsets[j]:offsets[j + 1]], 0.45), :]
+                for j in range(1, num_classes)])
+        return all_dets
+
+    t_ref, ref = timeit(per_class, args.iters)
+    t_new, new = timeit(lambda: batched_nms_candidates(img, cls, dets, num, num_classes, 0.45,
+                                                       force_cpu=True), args.iters)
+    same = check('nms', all(np.array_equal(a[j], b[j]) for a, b in zip(ref, new)
+                            for j in range(1, num_classes)))
+    print('nms: batch {:d}, {:d} classes, {:d} candidates, {:d} kept'.format(
+        num, num_classes - 1, len(dets), sum(len(d) for dets in new for d in dets[1:])))
+    print('  per-class cpu_nms {:.2f}ms  batched {:.2f}ms  speedup {:.1f}x  '
+          'identical: {}'.format(t_ref * 1e3, t_new * 1e3, t_ref / t_new, same))
+
+
+def bench_post(priors):
+    boxes, scores = random_detections(priors, 1)
+    boxes, scores = boxes[0], scores[0]
+    max_per_image = 200
+
+    def limit(all_boxes):
+        image_scores = np.concatenate([b[:, -1] for b in all_boxes])
+        if len(image_scores) > max_per_image:
+            image_thresh = np.partition(image_scores, -max_per_image)[-max_per_image]
+            all_boxes = [b[b[:, -1] >= image_thresh] for b in all_boxes]
+        return all_boxes
+
+    def numpy_path():
+        boxes_np, scores_np = boxes.numpy(), scores.numpy()
+        all_boxes = []
+        for j in range(1, num_classes):
+            inds = np.where(scores_np[:, j] > 0.01)[0]
+            c_dets = np.hstack((boxes_np[inds], scores_np[inds, j][:, np.newaxis])).astype(
+                np.float32, copy=False)
+            all_boxes.append(c_dets[cpu_nms(c_dets, 0.45)])
+        image_scores = np.hstack([b[:, -1] for b in all_boxes])
+        if len(image_scores) > max_per_image:
+            image_thresh = np.sort(image_scores)[-max_per_image]
+            all_boxes = [b[b[:, -1] >= image_thresh] for b in all_boxes]
+        return all_boxes
+
+    def torch_path(top_k=None):
+        cls, inds, c_scores = select_candidates(scores, 0.01, top_k)
+        dets = torch.cat((boxes[inds], c_scores.unsqueeze(1)), 1).numpy()
+        offsets = np.cumsum(np.bincount(cls.numpy(), minlength=num_classes))
+        all_boxes = []
+        for j in range(1, num_classes):
+            c_dets = dets[offsets[j - 1]:offsets[j]]
+            all_boxes.append(c_dets[cpu_nms(c_dets, 0.45)])
+        return limit(all_boxes)
+
+    t_ref, ref = timeit(numpy_path, args.iters)
+    t_new, new = timeit(torch_path, args.iters)
+    same = check('post', all(np.array_equal(a, b) for a, b in zip(ref, new)))
+    print('post: {:d} classes, {:d} kept'.format(num_classes - 1,
+                                                 sum(len(b) for b in new)))
+    print('  numpy {:.2f}ms  torch select {:.2f}ms  speedup {:.1f}x  '
+          'identical: {}'.format(t_ref * 1e3, t_new * 1e3, t_ref / t_new, same))
+    if args.top_k is not None:
+        t_k, _ = timeit(lambda: torch_path(args.top_k), args.iters)
+        print('  torch select, top {:d} per class {:.2f}ms'.format(args.top_k, t_k * 1e3))
+
+
+def random_voc(num_images):
+    """Synthetic VOC annotations and detections: jittered copies of the
+    ground truth (true and duplicate hits), random boxes, coarse scores so
+    there are ties.
+    """
+    names = ['{:06d}'.format(i) for i in range(num_images)]
+    recs = {}
+    for name in names:
+        objs = []
+        for _ in range(np.random.randint(0, 8)):
+            x1, y1 = np.random.randint(0, 300, 2)
+            w, h = np.random.randint(5, 200, 2)
+            objs.append({'name': VOC_CLASSES[np.random.randint(1, 21)], 'pose': 'Unspecified',
+                         'truncated': 0, 'difficult': int(np.random.rand() < 0.15),
+                         'bbox': [x1 + 1, y1 + 1, x1 + w, y1 + h]})
+        recs[name] = objs
+    all_boxes = [[[] for _ in names] for _ in VOC_CLASSES]
+    for i, name in enumerate(names):
+        for j in range(1, len(VOC_CLASSES)):
+            m = np.random.randint(0, 6)
+            boxes = np.random.uniform(0, 400, (m, 4))
+            boxes[:, 2:] = boxes[:, :2] + np.random.uniform(5, 150, (m, 2))
+            for obj in recs[name]:
+                if obj['name'] == VOC_CLASSES[j]:
+                    hits = np.random.randint(0, 3)
+                    boxes = np.vstack((boxes, np.array(obj['bbox'], dtype=np.float64) - 1 +
+                                       np.random.normal(0, 4, (hits, 4))))
+            scores = np.round(np.random.uniform(0, 1, (len(boxes), 1)), np.random.randint(2, 5))
+            all_boxes[j][i] = np.hstack((boxes, scores)).astype(np.float32)
+    return names, recs, all_boxes
+
+
+def write_voc_annotations(recs, annopath):
+    """Write recs as VOC xml files annopath.format(name)."""
+    os.makedirs(os.path.dirname(annopath))
+    for name, objs in recs.items():
+        with open(annopath.format(name), 'w') as f:
+            f.write('<annotation><filename>{:s}.jpg</filename>'.format(name))
+            for obj in objs:
+                f.write('<object><name>{:s}</name><pose>{:s}</pose><truncated>{:d}</truncated>'
+                        '<difficult>{:d}</difficult><bndbox><xmin>{:d}</xmin><ymin>{:d}</ymin>'
+                        '<xmax>{:d}</xmax><ymax>{:d}</ymax></bndbox></object>'.format(
+                            obj['name'], obj['pose'], obj['truncated'], obj['difficult'],
+                            *[int(v) for v in obj['bbox']]))
+            f.write('</annotation>')
+
+
+def voc_layout(num_images):
+    """random_voc() written out: a directory with xml annotations and the
+    image set file.
+    """
+    names, recs, all_boxes = random_voc(num_images)
+    cachedir = tempfile.mkdtemp()
+    annopath = os.path.join(cachedir, 'Annotations', '{:s}.xml')
+    write_voc_annotations(recs, annopath)
+    return names, recs, all_boxes, cachedir, annopath
+
+
+def bench_voc_gt(priors):
+    names, recs, _, cachedir, annopath = voc_layout(args.num_images)
+    annofiles = [annopath.format(name) for name in names]
+    with open(os.path.join(cachedir, 'annots.pkl'), 'wb') as f:
+        pickle.dump(dict((name, parse_rec(annopath.format(name))) for name in names), f)
+
+    def unpickle():
+        with open(os.path.join(cachedir, 'annots.pkl'), 'rb') as f:
+            return pickle.load(f)
+
+    def cold():
+        for f in os.listdir(cachedir):
+            if f.startswith('voc_gt_'):
+                shutil.rmtree(os.path.join(cachedir, f))
+        return load_gt_cache(annofiles, cachedir, args.processes)
+    t_parse, _ = timeit(lambda: [parse_rec(f) for f in annofiles], 1)
+    t_cold, _ = timeit(cold, 1)
+    t_pkl, _ = timeit(unpickle, args.iters)
+    t_warm, gt = timeit(lambda: load_gt_cache(annofiles, cachedir), args.iters)
+    same = check('voc gt cache', all(
+        np.array_equal(gt['bbox'][gt['offsets'][i]:gt['offsets'][i + 1]],
+                       np.array([o['bbox'] for o in recs[name]]).reshape(-1, 4))
+        for i, name in enumerate(names)))
+    print('voc gt: {:d} images, {:d} objects'.format(len(names), len(gt['bbox'])))
+    print('  serial parse {:.2f}ms  parallel parse + save ({:d} processes) {:.2f}ms'.format(
+        t_parse * 1e3, args.processes, t_cold * 1e3))
+    print('  annots.pkl load {:.2f}ms  cache load (stat + npy) {:.2f}ms  identical: {}'.format(
+        t_pkl * 1e3, t_warm * 1e3, same))
+
+
+def bench_voc_eval(priors):
+    names, recs, all_boxes, cachedir, annopath = voc_layout(args.num_images)
+    imagesetfile = os.path.join(cachedir, 'test.txt')
+    with open(imagesetfile, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    detpath = os.path.join(cachedir, 'det_{:s}.txt')
+
+    def write_loop():
+        # results files as VOCDetection._write_voc_results_file used to write them
+        for j, cls in enumerate(VOC_CLASSES[1:], 1):
+            with open(detpath.format(cls), 'wt') as f:
+                for i, name in enumerate(names):
+                    dets = all_boxes[j][i]
+                    for k in range(dets.shape[0]):
+                        f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.format(
+                            name, dets[k, -1], dets[k, 0] + 1, dets[k, 1] + 1,
+                            dets[k, 2] + 1, dets[k, 3] + 1))
+
+    def write_bulk(store):
+        for j, cls in enumerate(VOC_CLASSES[1:], 1):
+            img, dets = store.class_dets(j)
+            with open(detpath.format(cls) + '.bulk', 'wt') as f:
+                f.write(format_results(names, img, dets))
+
+    store = DetectionStore.from_all_boxes(all_boxes)
+    t_loop, _ = timeit(write_loop, args.iters)
+    t_bulk, _ = timeit(lambda: write_bulk(store), args.iters)
+    same = True
+    for cls in VOC_CLASSES[1:]:
+        with open(detpath.format(cls)) as f, open(detpath.format(cls) + '.bulk') as g:
+            same &= f.read() == g.read()
+    check('voc results files', same)
+    print('voc results files: {:d} detections'.format(len(store)))
+    print('  per row {:.2f}ms  per class {:.2f}ms  speedup {:.1f}x  identical: {}'.format(
+        t_loop * 1e3, t_bulk * 1e3, t_loop / t_bulk, same))
+
+    def per_class(use_07_metric):
+        write_loop()
+        return dict((cls, voc_eval(detpath, annopath, imagesetfile, cls, cachedir,
+                                   0.5, use_07_metric)) for cls in VOC_CLASSES[1:])
+
+    def single_pass(use_07_metric):
+        gt = gt_arrays(load_gt_cache([annopath.format(n) for n in names], cachedir),
+                       VOC_CLASSES)
+        return voc_eval_all(all_boxes, gt, VOC_CLASSES, 0.5, use_07_metric)
+
+    for use_07_metric in (True, False):
+        t_ref, ref = timeit(lambda: per_class(use_07_metric), args.iters)
+        t_new, new = timeit(lambda: single_pass(use_07_metric), args.iters)
+        same = check('voc eval single pass', all(
+            np.array_equal(ref[c][0], new[c][0]) and np.array_equal(ref[c][1], new[c][1])
+            and ref[c][2] == new[c][2] for c in VOC_CLASSES[1:]))
+        print('voc eval ({:s} metric): {:d} images, mAP {:.4f}'.format(
+            ('area', '07 11-point')[use_07_metric], len(names),
+            np.mean([new[c][2] for c in VOC_CLASSES[1:]])))
+        print('  per-class files {:.2f}ms  single pass {:.2f}ms  speedup {:.1f}x  '
+              'identical: {}'.format(t_ref * 1e3, t_new * 1e3, t_ref / t_new, same))
+
+    # AP table over 0.5:0.95 against one voc_eval_all per threshold
+    gt = gt_arrays(load_gt_cache([annopath.format(n) for n in names], cachedir),
+                   VOC_CLASSES)
+    ovthreshs = np.linspace(.5, .95, 10)
+
+    def serial():
+        table = []
+        for t in ovthreshs:
+            res = voc_eval_all(all_boxes, gt, VOC_CLASSES, t)
+            table.append([res[c][2] for c in VOC_CLASSES[1:]])
+        return np.array(table)
+    t_ref, ref = timeit(serial, args.iters)
+    print('voc AP table: {:d} thresholds x {:d} classes, mAP@[.5:.95] {:.4f}'.format(
+        len(ovthreshs), len(VOC_CLASSES) - 1, ref.mean()))
+    # the default serial fallback of small tables, then the pool forced
+    for processes, min_work, label in ((1, None, '1 process'),
+                                       (args.processes, None, '{:d} processes'),
+                                       (args.processes, 0, '{:d} processes, pool forced')):
+        kwargs = dict() if min_work is None else dict(min_pool_work=min_work)
+        t_new, table = timeit(lambda: voc_eval_table(all_boxes, gt, VOC_CLASSES, ovthreshs,
+                                                     processes=processes, **kwargs), args.iters)
+        print('  per threshold {:.2f}ms  table, {:s} {:.2f}ms  speedup {:.1f}x  '
+              'identical: {}'.format(t_ref * 1e3, label.format(processes), t_new * 1e3,
+                                     t_ref / t_new,
+                                     check('voc AP table', np.array_equal(ref, table))))
+
+
+
+def random_coco(num_images, num_cats):
+    """Synthetic COCO ground truth and bbox results: crowd regions, objects
+    of every area range, duplicated objects and detections for IoU ties,
+    coarse scores for score ties and some (image, category) pairs with more
+    detections than maxDets.
+    """
+    images = [{'id': i + 1, 'width': 640, 'height': 480} for i in range(num_images)]
+    cats = [{'id': c + 1, 'name': str(c + 1)} for c in range(num_cats)]
+    anns, results = [], []
+    for img in images:
+        objs = []
+        for _ in range(np.random.randint(0, 12)):
+            w, h = np.exp(np.random.uniform(np.log(4), np.log(400), 2))
+            x, y = np.random.uniform(0, 640 - w), np.random.uniform(0, 480 - h)
+            objs.append([x, y, w, h])
+            if np.random.rand() < 0.1:
+                objs.append([x, y, w, h])
+        for bb in objs:
+            anns.append({'id': len(anns) + 1, 'image_id': img['id'],
+                         'category_id': np.random.randint(1, num_cats + 1),
+                         'bbox': bb, 'area': bb[2] * bb[3] * np.random.uniform(0.5, 1),
+                         'iscrowd': int(np.random.rand() < 0.1)})
+        for ann in anns[len(anns) - len(objs):]:
+            for _ in range(np.random.randint(0, 6)):
+                bb = np.array(ann['bbox']) * np.random.normal(1, 0.15, 4)
+                results.append({'image_id': img['id'], 'category_id': ann['category_id'],
+                                'bbox': bb.tolist() if np.random.rand() < 0.9 else ann['bbox'],
+                                'score': round(np.random.rand(), 2)})
+        for _ in range(np.random.randint(0, 60) + (np.random.rand() < 0.02) * 120):
+            w, h = np.random.uniform(4, 300, 2)
+            results.append({'image_id': img['id'], 'category_id': np.random.randint(1, 4),
+                            'bbox': [np.random.uniform(0, 600), np.random.uniform(0, 440), w, h],
+                            'score': round(np.random.rand(), 2)})
+    return {'images': images, 'categories': cats, 'annotations': anns}, results
+
+
+def coco_apis(dataset, results):
+    """COCO ground truth and loadRes() result objects of random_coco data."""
+    with redirect_stdout(io.StringIO()):
+        coco_gt = COCO()
+        coco_gt.dataset = dataset
+        coco_gt.createIndex()
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump(results, f)
+            f.flush()
+            coco_dt = coco_gt.loadRes(f.name)
+    return coco_gt, coco_dt
+
+
+def coco_eval(coco_gt, coco_dt, accumulate=True, processes=1, **params):
+    """A quiet bbox COCOeval with params overridden, evaluated."""
+    E = COCOeval(coco_gt, coco_dt, 'bbox')
+    for name, value in params.items():
+        setattr(E.params, name, value)
+    with redirect_stdout(io.StringIO()):
+        E.evaluate(processes)
+        if accumulate:
+            E.accumulate()
+    return E
+
+
+def same_eval_imgs(a, b):
+    """Whether two COCOeval.evalImgs hold the same matches."""
+    return len(a) == len(b) and all(
+        (x is None and y is None) or
+        (x is not None and y is not None and
+         x['image_id'] == y['image_id'] and x['category_id'] == y['category_id'] and
+         x['aRng'] == y['aRng'] and x['dtIds'] == y['dtIds'] and
+         x['gtIds'] == y['gtIds'] and x['dtScores'] == y['dtScores'] and
+         all(np.array_equal(x[k], y[k])
+             for k in ('dtMatches', 'gtMatches', 'gtIgnore', 'dtIgnore')))
+        for x, y in zip(a, b))
+
+
+def check_fast_match(num_datasets=5):
+    """fastMatch against the reference matching loop of evaluateImg on
+    random data sets, with the default parameters and with fewer max dets,
+    other IoU thresholds and categories ignored.
+    """
+    variants = [dict(), dict(maxDets=[1, 3, 7]), dict(iouThrs=np.array([.1, .5, .55, .9])),
+                dict(useCats=0)]
+    same = True
+    for _ in range(num_datasets):
+        coco_gt, coco_dt = coco_apis(*random_coco(200, 4))
+        for params in variants:
+            ref = coco_eval(coco_gt, coco_dt, fastMatch=0, **params)
+            new = coco_eval(coco_gt, coco_dt, fastMatch=1, **params)
+            same &= (same_eval_imgs(ref.evalImgs, new.evalImgs) and
+                     np.array_equal(ref.eval['precision'], new.eval['precision']) and
+                     np.array_equal(ref.eval['recall'], new.eval['recall']))
+    print('  fastMatch against the matching loop, {:d} random data sets x {:d} '
+          'parameter sets: identical: {}'.format(num_datasets, len(variants), same))
+    return check('cocoeval fastMatch', same)
+
+
+def bench_coco_eval(priors):
+    dataset, results = random_coco(args.num_images, 5)
+    coco_gt, coco_dt = coco_apis(dataset, results)
+    print('coco eval: {:d} images, {:d} objects, {:d} detections'.format(
+        len(dataset['images']), len(dataset['annotations']), len(results)))
+
+    # bbox iou without the compiled extension, against it where it is built
+    pairs = [(coco_dt.loadAnns(coco_dt.getAnnIds(imgIds=i)),
+              coco_gt.loadAnns(coco_gt.getAnnIds(imgIds=i))) for i in coco_gt.getImgIds()]
+    pairs = [([d['bbox'] for d in dt], [g['bbox'] for g in gt], [g['iscrowd'] for g in gt])
+             for dt, gt in pairs if dt and gt]
+    t_np, ious = timeit(lambda: [maskUtils.bbIou(*pair) for pair in pairs], args.iters)
+    try:
+        t_c, ref = timeit(lambda: [maskUtils.iou(*pair) for pair in pairs], args.iters)
+    except Exception as e:
+        print('  bbox iou: numpy {:.2f}ms, compiled iou unavailable ({})'.format(t_np * 1e3, e))
+    else:
+        same = check('bbox iou', all(np.array_equal(a, b) for a, b in zip(ref, ious)))
+        print('  bbox iou: {:d} images, compiled {:.2f}ms  numpy {:.2f}ms  identical: {}'.format(
+            len(pairs), t_c * 1e3, t_np * 1e3, same))
+
+    check_fast_match()
+    t_loop, ref = timeit(lambda: coco_eval(coco_gt, coco_dt, False, fastMatch=0), args.iters)
+    t_fast, new = timeit(lambda: coco_eval(coco_gt, coco_dt, False, fastMatch=1), args.iters)
+    same = same_eval_imgs(ref.evalImgs, new.evalImgs)
+    with redirect_stdout(io.StringIO()):
+        ref.accumulate()
+        new.accumulate()
+    same &= (np.array_equal(ref.eval['precision'], new.eval['precision']) and
+             np.array_equal(ref.eval['recall'], new.eval['recall']))
+    check('cocoeval evaluate', same)
+    print('  evaluate: loop matching {:.2f}s  vectorized {:.2f}s  speedup {:.1f}x  '
+          'identical: {}'.format(t_loop, t_fast, t_loop / t_fast, same))
+
+    t_par, par = timeit(lambda: coco_eval(coco_gt, coco_dt, False, processes=args.processes),
+                        args.iters)
+    same = check('cocoeval processes', list(par.ious) == list(new.ious) and
+                 all(np.array_equal(par.ious[key], new.ious[key]) for key in new.ious) and
+                 same_eval_imgs(par.evalImgs, new.evalImgs))
+    print('  evaluate: 1 process {:.2f}s  {:d} processes {:.2f}s  speedup {:.1f}x  '
+          'identical: {}  ({:d} cpus)'.format(t_fast, args.processes, t_par, t_fast / t_par,
+                                              same, multiprocessing.cpu_count()))
+
+    def accumulate(E, fast):
+        E.params.fastAccumulate = fast
+        with redirect_stdout(io.StringIO()):
+            E.accumulate()
+        return E.eval['precision'].copy(), E.eval['recall'].copy()
+    t_loop, ref = timeit(lambda: accumulate(new, 0), args.iters)
+    t_fast, acc = timeit(lambda: accumulate(new, 1), args.iters)
+    same = check('cocoeval accumulate',
+                 np.array_equal(ref[0], acc[0]) and np.array_equal(ref[1], acc[1]))
+    print('  accumulate: loop {:.2f}s  vectorized {:.2f}s  speedup {:.1f}x  '
+          'identical: {}'.format(t_loop, t_fast, t_loop / t_fast, same))
+
+    # the list of dicts evaluate() used to keep, against the arrays
+    compact = new.evalImgs
+    tracemalloc.start()
+    new.evalImgs = [None if e is None else
+                    dict((k, v.copy() if isinstance(v, np.ndarray) else v) for k, v in e.items())
+                    for e in compact]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    array_bytes = sum(v.nbytes for v in vars(compact).values() if isinstance(v, np.ndarray))
+    t_dicts, dicts = timeit(lambda: accumulate(new, 1), args.iters)
+    new.evalImgs = compact
+    same = check('cocoeval evalImgs arrays',
+                 np.array_equal(dicts[0], acc[0]) and np.array_equal(dicts[1], acc[1]))
+    print('  evalImgs: {:d} entries, dicts {:.1f}MB  arrays {:.1f}MB  accumulate {:.2f}s / '
+          '{:.2f}s  identical: {}'.format(len(compact), dict_bytes / 2.**20, array_bytes / 2.**20,
+                                          t_dicts, t_fast, same))
+
+    # streaming: images fed as arrays, running AP on the first half, final
+    # AP on all against loadRes + evaluate
+    by_image = dict((i, []) for i in coco_gt.getImgIds())
+    for r in results:
+        by_image[r['image_id']].append(r)
+    images = sorted(by_image)
+    half = images[:len(images) // 2]
+
+    def stream():
+        with redirect_stdout(io.StringIO()):
+            E = COCOevalStream(coco_gt)
+            for n, i in enumerate(images):
+                if n == len(half):
+                    E.evaluate()
+                    E.accumulate()
+                    running = E.eval['precision'].copy()
+                rs = by_image[i]
+                E.addImage(i, [r['category_id'] for r in rs],
+                           np.array([r['bbox'] for r in rs]).reshape(-1, 4),
+                           [r['score'] for r in rs])
+            E.evaluate()
+            E.accumulate()
+        return running, E
+
+    def batch():
+        E = coco_eval(*coco_apis(dataset, results))
+        return E
+    t_batch, E = timeit(batch, args.iters)
+    t_stream, (running, S) = timeit(stream, args.iters)
+    same = check('cocoeval stream', np.array_equal(S.eval['precision'], E.eval['precision']) and
+                 np.array_equal(S.eval['recall'], E.eval['recall']) and
+                 np.array_equal(running,
+                                coco_eval(coco_gt, coco_dt, imgIds=half).eval['precision']))
+    print('  stream: loadRes + evaluate {:.2f}s  per-image add + evaluate {:.2f}s  '
+          'identical (running and final): {}'.format(t_batch, t_stream, same))
+
+    # result ingestion: a dict walk per result against columns, on the
+    # results repeated over the images
+    reps = max(1, 1000000 // len(results))
+    columns = (np.tile([r['image_id'] for r in results], reps),
+               np.tile([r['bbox'] for r in results], (reps, 1)),
+               np.tile([r['score'] for r in results], reps),
+               np.tile([r['category_id'] for r in results], reps))
+    dicts = [{'image_id': i, 'category_id': c, 'bbox': b, 'score': s}
+             for i, b, s, c in zip(*[col.tolist() for col in columns])]
+
+    def load_dicts():
+        with redirect_stdout(io.StringIO()):
+            return coco_gt.loadRes([dict(d) for d in dicts])
+
+    def load_arrays():
+        with redirect_stdout(io.StringIO()):
+            return coco_gt.loadResArrays(*columns)
+    t_dicts, ref = timeit(load_dicts, args.iters)
+    t_arrays, res = timeit(load_arrays, args.iters)
+    same = check('loadResArrays', all(
+        dict((k, v) for k, v in a.items() if k != 'segmentation') == b
+        for a, b in zip(ref.dataset['annotations'], res.dataset['annotations'])) and
+        dict((i, [a['id'] for a in anns]) for i, anns in ref.imgToAnns.items()) ==
+        dict((i, [a['id'] for a in anns]) for i, anns in res.imgToAnns.items()) and
+        dict(ref.catToImgs) == dict(res.catToImgs))
+    print('  loadRes: {:d} results, dicts {:.2f}s  arrays {:.2f}s  speedup {:.1f}x  '
+          'identical: {}'.format(len(dicts), t_dicts, t_arrays, t_dicts / t_arrays, same))
+
+
+def bench_coco_gt(priors):
+    dataset, results = random_coco(args.num_images, 80)
+    for ann in dataset['annotations']:
+        # a polygon like the real files have, kept only by the dict index
+        x, y, w, h = ann['bbox']
+        t = np.linspace(0, 2 * np.pi, 16, endpoint=False)
+        ann['segmentation'] = [np.stack((x + w / 2 * (1 + np.cos(t)),
+                                         y + h / 2 * (1 + np.sin(t))), 1).ravel().tolist()]
+        # some boxes the roidb has to clip or drop
+        if ann['id'] % 37 == 0:
+            ann['bbox'] = [x - 20, y - 10, w + 700, h]
+        if ann['id'] % 53 == 0:
+            ann['area'] = 0.
+    with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+        json.dump(dataset, f)
+        f.flush()
+
+        def load(cls):
+            with redirect_stdout(io.StringIO()):
+                tracemalloc.start()
+                coco = cls(f.name)
+                size = tracemalloc.get_traced_memory()[0]
+                tracemalloc.stop()
+            return coco, size
+        (ref, dict_bytes), (new, array_bytes) = load(COCO), load(COCOArrays)
+
+        # startup: parse the json against open the memory-mapped cache
+        cachedir = tempfile.mkdtemp()
+        with redirect_stdout(io.StringIO()):
+            t_json, _ = timeit(lambda: COCOArrays(f.name), args.iters)
+            load_coco_cache(f.name, cachedir)
+            t_cache, cached = timeit(lambda: load_coco_cache(f.name, cachedir), args.iters)
+        cache_same = check('coco annotation cache', cached.dataset == new.dataset and
+                           all(np.array_equal(cached.columns[k], new.columns[k])
+                               for k in new.columns) and
+                           cached.getAnnIds(imgIds=ref.getImgIds()[:20]) ==
+                           new.getAnnIds(imgIds=ref.getImgIds()[:20]))
+        shutil.rmtree(cachedir)
+    print('coco gt index: {:d} images, {:d} objects'.format(
+        len(dataset['images']), len(dataset['annotations'])))
+
+    img_ids, cat_ids = sorted(ref.getImgIds()), sorted(ref.getCatIds())
+
+    def per_image(coco):
+        # what COCODetection does for its roidb
+        return [coco.loadAnns(coco.getAnnIds(imgIds=i, iscrowd=None)) for i in img_ids]
+
+    def eval_query(coco):
+        # what COCOeval._prepare does
+        return coco.getAnnIds(imgIds=img_ids, catIds=cat_ids)
+    with redirect_stdout(io.StringIO()):
+        fresh = COCOArrays.fromArrays(new.toArrays())
+    # the first pass builds the per-image lists, the dict index did that at load
+    t0 = time.time()
+    per_image(fresh)
+    t_first = time.time() - t0
+    t_dict, ref_anns = timeit(lambda: per_image(ref), args.iters)
+    t_array, new_anns = timeit(lambda: per_image(new), args.iters)
+    fields = ('id', 'image_id', 'category_id', 'bbox', 'area', 'iscrowd')
+    same = all([dict((k, a[k]) for k in fields) for a in anns] == b
+               for anns, b in zip(ref_anns, new_anns))
+    t_dict_q, ref_ids = timeit(lambda: eval_query(ref), args.iters)
+    t_array_q, new_ids = timeit(lambda: eval_query(new), args.iters)
+    same &= ref_ids == new_ids
+    queries = [dict(), dict(catIds=cat_ids[:3]), dict(areaRng=[32 ** 2, 96 ** 2], iscrowd=0),
+               dict(imgIds=img_ids[::3] + [-1], catIds=cat_ids[1], iscrowd=1)]
+    same &= all(ref.getAnnIds(**q) == new.getAnnIds(**q) for q in queries)
+    same &= all(set(ref.getImgIds(**q)) == set(new.getImgIds(**q))
+                for q in (dict(catIds=cat_ids[:2]), dict(imgIds=img_ids[:50], catIds=cat_ids[0])))
+    same &= (dict(ref.catToImgs) == dict(new.catToImgs) and
+             dict((i, [a['id'] for a in anns]) for i, anns in ref.imgToAnns.items()) ==
+             dict((i, [a['id'] for a in anns]) for i, anns in new.imgToAnns.items()))
+    ref_eval = coco_eval(*coco_apis(dataset, results))
+    new_eval = coco_eval(new, coco_apis(dataset, results)[1])
+    same &= (np.array_equal(ref_eval.eval['precision'], new_eval.eval['precision']) and
+             np.array_equal(ref_eval.eval['recall'], new_eval.eval['recall']))
+    check('coco gt index', same)
+
+    # COCODetection roidb, per image as before against whole-dataset arrays
+    det = COCODetection.__new__(COCODetection)
+    det._classes = ('__background__',) + tuple(c['name'] for c in ref.loadCats(cat_ids))
+    det._class_to_ind = dict(zip(det._classes, range(len(det._classes))))
+    det._class_to_coco_cat_id = dict(zip(det._classes[1:], cat_ids))
+    t_roidb_ref, roidb_ref = timeit(lambda: [roidb_from_index(det, i, ref) for i in img_ids],
+                                    args.iters)
+    t_roidb, (boxes, offsets) = timeit(lambda: det._roidb_arrays(img_ids, new), args.iters)
+    roidb_same = check('coco gt roidb', len(roidb_ref) == len(offsets) - 1 and
+                       all(np.array_equal(r, boxes[a:b]) for r, a, b in
+                           zip(roidb_ref, offsets[:-1], offsets[1:])))
+    print('  memory: dicts {:.1f}MB  arrays {:.1f}MB'.format(dict_bytes / 2.**20,
+                                                           array_bytes / 2.**20))
+    print('  startup: json {:.2f}s  binary cache {:.3f}s  speedup {:.0f}x  identical: {}'.format(
+        t_json, t_cache, t_json / t_cache, cache_same))
+    print('  per-image anns: dicts {:.2f}ms  arrays {:.2f}ms  speedup {:.1f}x  '
+          '(first pass {:.2f}ms)'.format(t_dict * 1e3, t_array * 1e3, t_dict / t_array,
+                                          t_first * 1e3))
+    print('  eval query: dicts {:.2f}ms  arrays {:.2f}ms  speedup {:.1f}x  identical: {}'.format(
+        t_dict_q * 1e3, t_array_q * 1e3, t_dict_q / t_array_q, same))
+    print('  gt roidb: per image {:.1f}ms  vectorized {:.2f}ms  speedup {:.0f}x  identical: {}'.format(
+        t_roidb_ref * 1e3, t_roidb * 1e3, t_roidb_ref / t_roidb, roidb_same))
+
+
+def roidb_from_index(det, index, coco):
+    """The per-image COCODetection roidb entry _roidb_arrays replaced."""
+    im_ann = coco.loadImgs(index)[0]
+    width, height = im_ann['width'], im_ann['height']
+    objs = coco.loadAnns(coco.getAnnIds(imgIds=index, iscrowd=None))
+    res = []
+    for obj in objs:
+        x1 = np.max((0, obj['bbox'][0]))
+        y1 = np.max((0, obj['bbox'][1]))
+        x2 = np.min((width - 1, x1 + np.max((0, obj['bbox'][2] - 1))))
+        y2 = np.min((height - 1, y1 + np.max((0, obj['bbox'][3] - 1))))
+        if obj['area'] > 0 and x2 >= x1 and y2 >= y1:
+            cat_id_to_class_ind = dict([(det._class_to_coco_cat_id[cls], det._class_to_ind[cls])
+                                        for cls in det._classes[1:]])
+            res.append([x1, y1, x2, y2, cat_id_to_class_ind[obj['category_id']]])
+    return np.array(res, dtype=np.float64).reshape(-1, 5)
+
+
+if __name__ == '__main__':
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    with torch.no_grad():
+        priors = PriorBox(cfg).forward()
+    benches = {'match': bench_match, 'mining': bench_mining,
+               'priors': bench_priors, 'detect': bench_detect,
+               'nms': bench_nms, 'post': bench_post, 'vocgt': bench_voc_gt,
+               'voceval': bench_voc_eval, 'cocoeval': bench_coco_eval,
+               'cocogt': bench_coco_gt}
+    for name in args.bench:
+        benches[name](priors)
+    if failures:
+        print('FAILED: ' + ', '.join(failures))
+        sys.exit(1)
@@ -1,5 +1,6 @@
 # from .voc import VOCDetection, AnnotationTransform, detection_collate, VOC_CLASSES
 from .voc0712 import VOCDetection, AnnotationTransform, detection_collate, VOC_CLASSES
 from .coco import COCODetection
+from .eval_dataset import EvalDataset, eval_collate
 from .data_augment import *
 from .config import *
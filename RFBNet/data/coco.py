@@ -17,10 +17,35 @@ import cv2
 import numpy as np
 import json
 import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from utils.pycocotools.coco import COCO
-from utils.pycocotools.cocoeval import COCOeval
+from utils.pycocotools.coco import COCOArrays
+from utils.pycocotools.cocoeval import COCOeval, COCOevalStream
 from utils.pycocotools import mask as COCOmask
+from utils.detection_store import as_store
+from utils.file_cache import file_key, save_arrays, load_arrays
+
+
+def _missing_paths(paths):
+    return [path for path in paths if not os.path.exists(path)]
+
+
+def load_coco_cache(annofile, cachedir):
+    """COCOArrays of an annotation file, opened from memory-mapped arrays.
+
+    The arrays are cached in cachedir under the file name and a hash of the
+    file path, mtime and size, so the json is parsed once and a changed
+    file is never served stale.
+    """
+    cache = os.path.join(cachedir, '{:s}_{:s}'.format(
+        os.path.splitext(os.path.basename(annofile))[0], file_key(annofile)))
+    if os.path.isdir(cache):
+        return COCOArrays.fromArrays(load_arrays(cache))
+    coco = COCOArrays(annofile)
+    save_arrays(cache, coco.toArrays())
+    print('wrote COCO annotation cache to {}'.format(cache))
+    return coco
 
 
 class COCODetection(data.Dataset):
@@ -39,10 +64,18 @@ class COCODetection(data.Dataset):
             (eg: take in caption string, return tensor of word indices)
         dataset_name (string, optional): which dataset to load
             (default: 'VOC2007')
+        check_paths (string, optional): 'eager' asserts that every image
+            exists while the dataset is built, 'lazy' builds the paths
+            without touching the filesystem and only fails when a missing
+            image is read, 'background' is lazy and also checks every path
+            in a thread pool, see path_report (default: 'eager')
+        path_threads (int, optional): threads of the background check
     """
 
     def __init__(self, root, image_sets, preproc=None, target_transform=None,
-                 dataset_name='COCO'):
+                 dataset_name='COCO', check_paths='eager', path_threads=16):
+        assert check_paths in ('eager', 'lazy', 'background'), \
+                'Unknown check_paths: {}'.format(check_paths)
         self.root = root
         self.cache_path = os.path.join(self.root, 'cache')
         self.image_set = image_sets
@@ -51,6 +84,8 @@ class COCODetection(data.Dataset):
         self.name = dataset_name
         self.ids = list()
         self.annotations = list()
+        self.missing_images = None
+        self._path_thread = None
         self._view_map = {
             'minival2014' : 'val2014',          # 5k val2014 subset
             'valminusminival2014' : 'val2014',  # val2014 \setminus minival2014
@@ -63,7 +98,7 @@ class COCODetection(data.Dataset):
                         if coco_name in self._view_map
                         else coco_name)
             annofile = self._get_ann_file(coco_name)
-            _COCO = COCO(annofile)
+            _COCO = load_coco_cache(annofile, self.cache_path)
             self._COCO = _COCO
             self.coco_name = coco_name
             cats = _COCO.loadCats(_COCO.getCatIds())
@@ -74,17 +109,24 @@ class COCODetection(data.Dataset):
                                                   _COCO.getCatIds()))
             indexes = _COCO.getImgIds()
             self.image_indexes = indexes
-            self.ids.extend([self.image_path_from_index(data_name, index) for index in indexes ])
+            self.ids.extend([self.image_path_from_index(data_name, index,
+                                                        check=check_paths == 'eager')
+                             for index in indexes])
             if image_set.find('test') != -1:
                 print('test set will not load annotations!')
             else:
                 self.annotations.extend(self._load_coco_annotations(coco_name, indexes,_COCO))
+        if check_paths == 'background':
+            self._path_thread = threading.Thread(target=self._check_paths,
+                                                 args=(path_threads,))
+            self._path_thread.daemon = True
+            self._path_thread.start()
 
 
-
-    def image_path_from_index(self, name, index):
+    def image_path_from_index(self, name, index, check=True):
         """
-        Construct an image path from the image's "index" identifier.
+        Construct an image path from the image's "index" identifier,
+        asserting that it exists if check.
         """
         # Example image path for index=119993:
         #   images/train2014/COCO_train2014_000000119993.jpg
@@ -92,11 +134,55 @@ class COCODetection(data.Dataset):
                      str(index).zfill(12) + '.jpg')
         image_path = os.path.join(self.root, 'images',
                               name, file_name)
-        assert os.path.exists(image_path), \
-                'Path does not exist: {}'.format(image_path)
+        if check:
+            assert os.path.exists(image_path), \
+                    'Path does not exist: {}'.format(image_path)
         return image_path
 
 
+    def _check_paths(self, threads):
+        chunks = [self.ids[i:i + 256] for i in range(0, len(self.ids), 256)]
+        pool = ThreadPoolExecutor(max_workers=threads)
+        try:
+            missing = [path for paths in pool.map(_missing_paths, chunks) for path in paths]
+        finally:
+            pool.shutdown()
+        print('{}: checked {:d} image paths, {:d} missing'.format(
+            self.name, len(self.ids), len(missing)))
+        for path in missing[:10]:
+            print('  missing: {}'.format(path))
+        if len(missing) > 10:
+            print('  ... and {:d} more'.format(len(missing) - 10))
+        self.missing_images = missing
+
+
+    def path_report(self, timeout=None):
+        """
+        Paths of the missing images found by the background check, waiting
+        up to timeout seconds for it to finish; None if it has not.
+        """
+        if self._path_thread is not None:
+            self._path_thread.join(timeout)
+        return self.missing_images
+
+
+    def _read_image(self, index):
+        img_id = self.ids[index]
+        img = cv2.imread(img_id, cv2.IMREAD_COLOR)
+        if img is None:
+            if not os.path.exists(img_id):
+                raise IOError('Path does not exist: {}'.format(img_id))
+            raise IOError('Could not read image: {}'.format(img_id))
+        return img
+
+
+    def __getstate__(self):
+        # a DataLoader may pickle the dataset into its workers
+        state = self.__dict__.copy()
+        state['_path_thread'] = None
+        return state
+
+
     def _get_ann_file(self, name):
         prefix = 'instances' if name.find('test') == -1 \
                 else 'image_info'
@@ -105,67 +191,70 @@ class COCODetection(data.Dataset):
 
 
     def _load_coco_annotations(self, coco_name, indexes, _COCO):
-        cache_file=os.path.join(self.cache_path,coco_name+'_gt_roidb.pkl')
-        if os.path.exists(cache_file):
-            with open(cache_file, 'rb') as fid:
-                roidb = pickle.load(fid)
+        """
+        [num_objs,5] targets (x1, y1, x2, y2, class) of every image of
+        indexes, views into one array cached in cache_path under the
+        annotation file's hash, so a changed file gets a new roidb.
+        """
+        cache_file = os.path.join(self.cache_path, '{:s}_gt_roidb_{:s}'.format(
+            coco_name, file_key(self._get_ann_file(coco_name))))
+        if os.path.isdir(cache_file):
+            roidb = load_arrays(cache_file, ['boxes', 'offsets'], mmap_mode=None)
+            boxes, offsets = roidb['boxes'], roidb['offsets']
             print('{} gt roidb loaded from {}'.format(coco_name,cache_file))
-            return roidb
+        else:
+            boxes, offsets = self._roidb_arrays(indexes, _COCO)
+            save_arrays(cache_file, {'boxes': boxes, 'offsets': offsets})
+            print('wrote gt roidb to {}'.format(cache_file))
+        assert len(offsets) == len(indexes) + 1, \
+                'Stale gt roidb: {}'.format(cache_file)
+        return [boxes[a:b] for a, b in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
 
-        gt_roidb = [self._annotation_from_index(index, _COCO)
-                    for index in indexes]
-        with open(cache_file, 'wb') as fid:
-            pickle.dump(gt_roidb,fid,pickle.HIGHEST_PROTOCOL)
-        print('wrote gt roidb to {}'.format(cache_file))
-        return gt_roidb
 
-
-    def _annotation_from_index(self, index, _COCO):
+    def _roidb_arrays(self, indexes, _COCO):
         """
-        Loads COCO bounding-box instance annotations. Crowd instances are
-        handled by marking their overlaps (with all categories) to -1. This
-        overlap value means that crowd "instances" are excluded from training.
+        Loads COCO bounding-box instance annotations of all images at once,
+        as boxes [G,5] (x1, y1, x2, y2, class) and per-image offsets
+        [len(indexes)+1].  Boxes are clipped to the image and objects with
+        no area or an empty clipped box are dropped.  Crowd instances are
+        kept, as by the per-image loader this replaces.
         """
-        im_ann = _COCO.loadImgs(index)[0]
-        width = im_ann['width']
-        height = im_ann['height']
+        imgs = _COCO.loadImgs(indexes)
+        rows, offsets = _COCO.getAnnRows(indexes)
+        img = np.repeat(np.arange(len(indexes)), np.diff(offsets))
+        width = np.array([im['width'] for im in imgs], dtype=np.float64)[img]
+        height = np.array([im['height'] for im in imgs], dtype=np.float64)[img]
+        bbox = _COCO.columns['bbox'][rows]
 
-        annIds = _COCO.getAnnIds(imgIds=index, iscrowd=None)
-        objs = _COCO.loadAnns(annIds)
         # Sanitize bboxes -- some are invalid
-        valid_objs = []
-        for obj in objs:
-            x1 = np.max((0, obj['bbox'][0]))
-            y1 = np.max((0, obj['bbox'][1]))
-            x2 = np.min((width - 1, x1 + np.max((0, obj['bbox'][2] - 1))))
-            y2 = np.min((height - 1, y1 + np.max((0, obj['bbox'][3] - 1))))
-            if obj['area'] > 0 and x2 >= x1 and y2 >= y1:
-                obj['clean_bbox'] = [x1, y1, x2, y2]
-                valid_objs.append(obj)
-        objs = valid_objs
-        num_objs = len(objs)
-
-        res = np.zeros((num_objs, 5))
+        x1 = np.maximum(0, bbox[:, 0])
+        y1 = np.maximum(0, bbox[:, 1])
+        x2 = np.minimum(width - 1, x1 + np.maximum(0, bbox[:, 2] - 1))
+        y2 = np.minimum(height - 1, y1 + np.maximum(0, bbox[:, 3] - 1))
+        valid = (_COCO.columns['area'][rows] > 0) & (x2 >= x1) & (y2 >= y1)
 
         # Lookup table to map from COCO category ids to our internal class
         # indices
-        coco_cat_id_to_class_ind = dict([(self._class_to_coco_cat_id[cls],
-                                          self._class_to_ind[cls])
-                                         for cls in self._classes[1:]])
-
-        for ix, obj in enumerate(objs):
-            cls = coco_cat_id_to_class_ind[obj['category_id']]
-            res[ix, 0:4] = obj['clean_bbox']
-            res[ix, 4] = cls
+        cat_ids = np.array([self._class_to_coco_cat_id[cls] for cls in self._classes[1:]],
+                           dtype=np.int64)
+        class_inds = np.array([self._class_to_ind[cls] for cls in self._classes[1:]])
+        order = np.argsort(cat_ids)
+        cat_ids, class_inds = cat_ids[order], class_inds[order]
+        cat = _COCO.columns['category_id'][rows][valid]
+        pos = np.minimum(np.searchsorted(cat_ids, cat), len(cat_ids) - 1)
+        if not np.all(cat_ids[pos] == cat):
+            raise KeyError(cat[cat_ids[pos] != cat][0].item())
 
-        return res
+        boxes = np.stack((x1, y1, x2, y2), axis=1)[valid]
+        boxes = np.hstack((boxes, class_inds[pos][:, None].astype(np.float64)))
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(img[valid], minlength=len(indexes)))))
+        return boxes, offsets.astype(np.int64)
 
 
 
     def __getitem__(self, index):
-        img_id = self.ids[index]
         target = self.annotations[index]
-        img = cv2.imread(img_id, cv2.IMREAD_COLOR)
+        img = self._read_image(index)
         height, width, _ = img.shape
 
         if self.target_transform is not None:
@@ -194,8 +283,7 @@ class COCODetection(data.Dataset):
         Return:
             PIL img
         '''
-        img_id = self.ids[index]
-        return cv2.imread(img_id, cv2.IMREAD_COLOR)
+        return self._read_image(index)
 
 
     def pull_tensor(self, index):
@@ -244,72 +332,111 @@ class COCODetection(data.Dataset):
         print('~~~~ Summary metrics ~~~~')
         coco_eval.summarize()
 
-    def _do_detection_eval(self, res_file, output_dir):
+    def _do_detection_eval(self, results, output_dir, processes=1):
         ann_type = 'bbox'
-        coco_dt = self._COCO.loadRes(res_file)
+        # the arrays the results json was written from: no json round trip
+        coco_dt = self._COCO.loadResArrays(*results)
         coco_eval = COCOeval(self._COCO, coco_dt)
         coco_eval.params.useSegm = (ann_type == 'segm')
-        coco_eval.evaluate()
+        coco_eval.evaluate(processes)
+        return self._report_detection_eval(coco_eval, output_dir)
+
+    def _report_detection_eval(self, coco_eval, output_dir):
         coco_eval.accumulate()
         self._print_detection_eval_metrics(coco_eval)
         eval_file = os.path.join(output_dir, 'detection_results.pkl')
         with open(eval_file, 'wb') as fid:
             pickle.dump(coco_eval, fid, pickle.HIGHEST_PROTOCOL)
         print('Wrote COCO eval results to: {}'.format(eval_file))
+        return coco_eval.stats[0]
+
+    def stream_evaluator(self):
+        """COCOevalStream over the ground truth, to be fed image by image
+        with add_stream_detections.
+        """
+        return COCOevalStream(self._COCO)
+
+    def add_stream_detections(self, coco_eval, im_ind, dets_per_class):
+        """Add the detections of image im_ind, a list of [n,5] arrays indexed
+        by class, to a COCOevalStream.  Boxes are converted as for the
+        results json, so the final AP equals evaluate_detections.
+        """
+        cat_ids, dets = [], []
+        for cls_ind, cls in enumerate(self._classes):
+            if cls == '__background__' or len(dets_per_class[cls_ind]) == 0:
+                continue
+            cat_ids.append(np.full(len(dets_per_class[cls_ind]),
+                                   self._class_to_coco_cat_id[cls], dtype=np.int64))
+            dets.append(dets_per_class[cls_ind])
+        bboxes, scores = self._coco_boxes(np.concatenate(dets) if dets else np.zeros((0, 5)))
+        coco_eval.addImage(self.image_indexes[im_ind],
+                           np.concatenate(cat_ids) if cat_ids else [], bboxes, scores)
+
+    def stream_ap(self, coco_eval):
+        """Running AP@[.5:.95] of the images added to a COCOevalStream."""
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        # area range index 0: all area ranges, last max dets: 100 per image
+        precision = coco_eval.eval['precision'][:, :, :, 0, -1]
+        return np.mean(precision[precision > -1]) if np.any(precision > -1) else float('nan')
+
+    def evaluate_stream(self, coco_eval, output_dir):
+        """evaluate_detections for a COCOevalStream fed every image, without
+        the results json.
+        """
+        coco_eval.evaluate(allImages=1)
+        return self._report_detection_eval(coco_eval, output_dir)
+
+    def _coco_boxes(self, dets):
+        """COCO x,y,w,h boxes and scores of [n,5] detections, in float64."""
+        dets = np.asarray(dets, dtype=np.float64)
+        return np.hstack((dets[:, :2], dets[:, 2:4] - dets[:, :2] + 1)), dets[:, 4]
 
-    def _coco_results_one_category(self, boxes, cat_id):
-        results = []
-        for im_ind, index in enumerate(self.image_indexes):
-            dets = boxes[im_ind].astype(np.float)
-            if dets == []:
+    def _coco_results(self, all_boxes):
+        """(image ids, x,y,w,h boxes, scores, category ids) of all
+        detections, by class then image, as columns for loadResArrays.
+        """
+        store = as_store(all_boxes)
+        image_indexes = np.asarray(self.image_indexes, dtype=np.int64)
+        img_ids, bboxes, scores, cat_ids = [], [], [], []
+        for cls_ind, cls in enumerate(self._classes):
+            if cls == '__background__':
                 continue
-            scores = dets[:, -1]
-            xs = dets[:, 0]
-            ys = dets[:, 1]
-            ws = dets[:, 2] - xs + 1
-            hs = dets[:, 3] - ys + 1
-            results.extend(
-              [{'image_id' : index,
-                'category_id' : cat_id,
-                'bbox' : [xs[k], ys[k], ws[k], hs[k]],
-                'score' : scores[k]} for k in range(dets.shape[0])])
-        return results
-
-    def _write_coco_results_file(self, all_boxes, res_file):
+            img, dets = store.class_dets(cls_ind)
+            boxes, cls_scores = self._coco_boxes(dets)
+            img_ids.append(image_indexes[img])
+            bboxes.append(boxes)
+            scores.append(cls_scores)
+            cat_ids.append(np.full(len(dets), self._class_to_coco_cat_id[cls], dtype=np.int64))
+        return (np.concatenate(img_ids), np.concatenate(bboxes),
+                np.concatenate(scores), np.concatenate(cat_ids))
+
+    def _write_coco_results_file(self, results, res_file):
         # [{"image_id": 42,
         #   "category_id": 18,
         #   "bbox": [258.15,41.29,348.26,243.78],
         #   "score": 0.236}, ...]
-        results = []
-        for cls_ind, cls in enumerate(self._classes):
-            if cls == '__background__':
-                continue
-            print('Collecting {} results ({:d}/{:d})'.format(cls, cls_ind,
-                                                          self.num_classes ))
-            coco_cat_id = self._class_to_coco_cat_id[cls]
-            results.extend(self._coco_results_one_category(all_boxes[cls_ind],
-                                                           coco_cat_id))
-            '''
-            if cls_ind ==30:
-                res_f = res_file+ '_1.json'
-                print('Writing results json to {}'.format(res_f))
-                with open(res_f, 'w') as fid:
-                    json.dump(results, fid)
-                results = []
-            '''
-        #res_f2 = res_file+'_2.json'
+        img_ids, bboxes, scores, cat_ids = results
+        print('Collecting {:d} results'.format(len(scores)))
+        results = [{'image_id' : index,
+                    'category_id' : cat_id,
+                    'bbox' : bbox,
+                    'score' : score}
+                   for index, cat_id, bbox, score in zip(img_ids.tolist(), cat_ids.tolist(),
+                                                         bboxes.tolist(), scores.tolist())]
         print('Writing results json to {}'.format(res_file))
         with open(res_file, 'w') as fid:
             json.dump(results, fid)
 
-    def evaluate_detections(self, all_boxes, output_dir):
+    def evaluate_detections(self, all_boxes, output_dir, processes=1):
         res_file = os.path.join(output_dir, ('detections_' +
                                          self.coco_name +
                                          '_results'))
         res_file += '.json'
-        self._write_coco_results_file(all_boxes, res_file)
+        results = self._coco_results(all_boxes)
+        self._write_coco_results_file(results, res_file)
         # Only do evaluation on non-test sets
         if self.coco_name.find('test') == -1:
-            self._do_detection_eval(res_file, output_dir)
+            return self._do_detection_eval(results, output_dir, processes)
         # Optionally cleanup results json file
 
@@ -0,0 +1,45 @@
+import torch
+import torch.utils.data as data
+
+
+class EvalDataset(data.Dataset):
+    """Test-time view of a detection dataset for use with a DataLoader, so
+    images are read and transformed in the loader workers.
+
+    Arguments:
+        dataset (Dataset): VOCDetection or COCODetection, only pull_image is
+            used
+        transform (callable): test transform, e.g. BaseTransform
+    Returns:
+        (index, transformed image, (height, width) of the original image)
+    """
+
+    def __init__(self, dataset, transform):
+        self.dataset = dataset
+        self.transform = transform
+
+    def __getitem__(self, index):
+        img = self.dataset.pull_image(index)
+        if img is None:
+            raise IOError('Could not read image {:d} of {}'.format(
+                index, self.dataset.name))
+        return index, self.transform(img), img.shape[:2]
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def eval_collate(batch):
+    """Collate fn for EvalDataset.
+
+    Return:
+        A tuple containing:
+            1) (list of int) dataset indices of the batch
+            2) (tensor) batch of images stacked on their 0 dim
+            3) (tensor) [width, height, width, height] of every original
+               image, used to scale the decoded boxes back, Shape: [batch,4]
+    """
+    indices = [sample[0] for sample in batch]
+    imgs = torch.stack([sample[1] for sample in batch], 0)
+    scale = torch.Tensor([[w, h, w, h] for _, _, (h, w) in batch])
+    return indices, imgs, scale
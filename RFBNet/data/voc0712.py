@@ -16,7 +16,8 @@ import torchvision.transforms as transforms
 from PIL import Image, ImageDraw, ImageFont
 import cv2
 import numpy as np
-from .voc_eval import voc_eval
+from .voc_eval import load_gt_cache, gt_arrays, voc_eval_all, voc_eval_table, format_results
+from utils.detection_store import as_store
 if sys.version_info[0] == 2:
     import xml.etree.cElementTree as ET
 else:
@@ -158,7 +159,7 @@ class VOCDetection(data.Dataset):
     """
 
     def __init__(self, root, image_sets, preproc=None, target_transform=None,
-                 dataset_name='VOC0712'):
+                 dataset_name='VOC0712', cache_dir=None):
         self.root = root
         self.image_set = image_sets
         self.preproc = preproc
@@ -172,6 +173,10 @@ class VOCDetection(data.Dataset):
             rootpath = os.path.join(self.root, 'VOC' + year)
             for line in open(os.path.join(rootpath, 'ImageSets', 'Main', name + '.txt')):
                 self.ids.append((rootpath, line.strip()))
+        # annotations of every image as arrays for the evaluation, loaded
+        # (or built) on first use
+        self._cache_dir = cache_dir or os.path.join(self.root, 'annotations_cache')
+        self._gt = None
 
     def __getitem__(self, index):
         img_id = self.ids[index]
@@ -209,6 +214,25 @@ class VOCDetection(data.Dataset):
         img_id = self.ids[index]
         return cv2.imread(self._imgpath % img_id, cv2.IMREAD_COLOR)
 
+    def pull_gt(self, index):
+        '''Returns the cached annotation of image at index as arrays
+
+        Argument:
+            index (int): index of img to get annotation of
+        Return:
+            names, [n,4] boxes as written in the xml, difficult flags
+        '''
+        gt = self._gt_cache()
+        start, end = gt['offsets'][index], gt['offsets'][index + 1]
+        return (gt['names'][gt['label'][start:end]],
+                gt['bbox'][start:end], gt['difficult'][start:end])
+
+    def _gt_cache(self):
+        if self._gt is None:
+            self._gt = load_gt_cache([self._annopath % img_id for img_id in self.ids],
+                                     self._cache_dir)
+        return self._gt
+
     def pull_anno(self, index):
         '''Returns the original annotation of image at index
 
@@ -240,7 +264,8 @@ class VOCDetection(data.Dataset):
         to_tensor = transforms.ToTensor()
         return torch.Tensor(self.pull_image(index)).unsqueeze_(0)
 
-    def evaluate_detections(self, all_boxes, output_dir=None):
+    def evaluate_detections(self, all_boxes, output_dir=None, write_results=False,
+                            ovthreshs=None, processes=None):
         """
         all_boxes is a list of length number-of-classes.
         Each list element is a list of length number-of-images.
@@ -248,9 +273,21 @@ class VOCDetection(data.Dataset):
         or a numpy array of detection.
 
         all_boxes[class][image] = [] or np.array of shape #dets x 5
+
+        A DetectionStore (or its all_boxes() view) is evaluated in place.
+        The detections go to the evaluator in memory; the comp4 results files
+        are only written with write_results, e.g. for an official submission.
+        With ovthreshs (e.g. np.linspace(.5, .95, 10)) the AP of every class
+        at every IoU threshold is printed as well, computed by voc_eval_table
+        with a pool of processes for large detection sets.
         """
-        self._write_voc_results_file(all_boxes)
-        self._do_python_eval(output_dir)
+        store = as_store(all_boxes)
+        if write_results:
+            self._write_voc_results_file(store)
+        mean_ap = self._do_python_eval(store, output_dir)
+        if ovthreshs is not None:
+            self._do_ap_table(store, ovthreshs, processes, output_dir)
+        return mean_ap
 
     def _get_voc_results_file_template(self):
         filename = 'comp4_det_test' + '_{:s}.txt'
@@ -262,52 +299,33 @@ class VOCDetection(data.Dataset):
         return path
 
     def _write_voc_results_file(self, all_boxes):
+        store = as_store(all_boxes)
+        imagenames = [index[1] for index in self.ids]
         for cls_ind, cls in enumerate(VOC_CLASSES):
-            cls_ind = cls_ind 
             if cls == '__background__':
                 continue
             print('Writing {} VOC results file'.format(cls))
             filename = self._get_voc_results_file_template().format(cls)
+            img, dets = store.class_dets(cls_ind)
             with open(filename, 'wt') as f:
-                for im_ind, index in enumerate(self.ids):
-                    index = index[1]
-                    dets = all_boxes[cls_ind][im_ind]
-                    if dets == []:
-                        continue
-                    for k in range(dets.shape[0]):
-                        f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.
-                                format(index, dets[k, -1],
-                                dets[k, 0] + 1, dets[k, 1] + 1,
-                                dets[k, 2] + 1, dets[k, 3] + 1))
-
-    def _do_python_eval(self, output_dir='output'):
-        rootpath = os.path.join(self.root, 'VOC' + self._year)
-        name = self.image_set[0][1]
-        annopath = os.path.join(
-                                rootpath,
-                                'Annotations',
-                                '{:s}.xml')
-        imagesetfile = os.path.join(
-                                rootpath,
-                                'ImageSets',
-                                'Main',
-                                name+'.txt')
-        cachedir = os.path.join(self.root, 'annotations_cache')
+                f.write(format_results(imagenames, img, dets))
+
+    def _do_python_eval(self, all_boxes, output_dir='output'):
+        gt = gt_arrays(self._gt_cache(), VOC_CLASSES)
         aps = []
         # The PASCAL VOC metric changed in 2010
         use_07_metric = True if int(self._year) < 2010 else False
         print('VOC07 metric? ' + ('Yes' if use_07_metric else 'No'))
         if output_dir is not None and not os.path.isdir(output_dir):
             os.mkdir(output_dir)
-        for i, cls in enumerate(VOC_CLASSES):
+        results = voc_eval_all(all_boxes, gt, VOC_CLASSES, ovthresh=0.5,
+                               use_07_metric=use_07_metric)
+        for cls in VOC_CLASSES:
 
             if cls == '__background__':
                 continue
 
-            filename = self._get_voc_results_file_template().format(cls)
-            rec, prec, ap = voc_eval(
-                                    filename, annopath, imagesetfile, cls, cachedir, ovthresh=0.5,
-                                    use_07_metric=use_07_metric)
+            rec, prec, ap = results[cls]
             aps += [ap]
             print('AP for {} = {:.4f}'.format(cls, ap))
             if output_dir is not None:
@@ -327,6 +345,23 @@ class VOCDetection(data.Dataset):
         print('Recompute with `./tools/reval.py --matlab ...` for your paper.')
         print('-- Thanks, The Management')
         print('--------------------------------------------------------------')
+        return np.mean(aps)
+
+    def _do_ap_table(self, all_boxes, ovthreshs, processes=None, output_dir=None):
+        gt = gt_arrays(self._gt_cache(), VOC_CLASSES)
+        use_07_metric = True if int(self._year) < 2010 else False
+        ovthreshs = list(ovthreshs)
+        aps = voc_eval_table(all_boxes, gt, VOC_CLASSES, ovthreshs, use_07_metric, processes)
+        print('AP@IoU  ' + ' '.join('{:>5.2f}'.format(t) for t in ovthreshs) + '   mean')
+        for cls, ap in zip(VOC_CLASSES[1:], aps.T):
+            print('{:<8.8s} '.format(cls) + ' '.join('{:.3f}'.format(a) for a in ap) +
+                  '  {:.3f}'.format(ap.mean()))
+        print('mAP     ' + ' '.join('{:.3f}'.format(a) for a in aps.mean(1)) +
+              '  {:.3f}'.format(aps.mean()))
+        if output_dir is not None:
+            with open(os.path.join(output_dir, 'ap_table.pkl'), 'wb') as f:
+                pickle.dump({'ovthreshs': ovthreshs, 'ap': aps}, f)
+        return aps
 
 def detection_collate(batch):
     """Custom collate fn for dealing with batches of images that have a different
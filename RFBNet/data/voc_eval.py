@@ -6,9 +6,11 @@
 
 import xml.etree.ElementTree as ET
 import os
-import pickle
+import multiprocessing
 import numpy as np
 import pdb
+from utils.detection_store import as_store
+from utils.file_cache import file_key, save_arrays, load_arrays
 
 
 def parse_rec(filename):
@@ -54,8 +56,7 @@ def voc_ap(rec, prec, use_07_metric=False):
         mpre = np.concatenate(([0.], prec, [0.]))
 
         # compute the precision envelope
-        for i in range(mpre.size - 1, 0, -1):
-            mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+        mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
         # to calculate area under PR curve, look for points
         # where X axis (recall) changes value
@@ -65,6 +66,68 @@ def voc_ap(rec, prec, use_07_metric=False):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
+def load_gt_cache(annofiles, cachedir, processes=None):
+    """Parsed annotation files as contiguous arrays.
+
+    The arrays are cached in cachedir under a hash of the file paths and of
+    every file's mtime and size, so a changed image set or annotation is
+    never served stale.  A missing cache is built with a process pool
+    parsing the XML files.
+
+    Returns a dict with, per image, offsets [num_images+1] into the object
+    arrays bbox [G,4] (int32, as written), label [G] (index into names),
+    difficult [G], truncated [G] and pose [G] (index into poses).
+    """
+    cache = os.path.join(cachedir, 'voc_gt_' + file_key(annofiles))
+    if os.path.isdir(cache):
+        return load_arrays(cache, mmap_mode=None)
+
+    print('Parsing {:d} annotation files'.format(len(annofiles)))
+    if processes == 1:
+        recs = [parse_rec(f) for f in annofiles]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            recs = pool.map(parse_rec, annofiles, chunksize=64)
+        finally:
+            pool.close()
+            pool.join()
+    objs = [obj for objects in recs for obj in objects]
+    names, label = np.unique(np.array([obj['name'] for obj in objs], dtype=str),
+                             return_inverse=True)
+    poses, pose = np.unique(np.array([obj['pose'] for obj in objs], dtype=str),
+                            return_inverse=True)
+    gt = {'offsets': np.concatenate(([0], np.cumsum([len(r) for r in recs]))).astype(np.int64),
+          'bbox': np.array([obj['bbox'] for obj in objs], dtype=np.int32).reshape(-1, 4),
+          'label': label.astype(np.int32),
+          'names': names,
+          'difficult': np.array([obj['difficult'] for obj in objs], dtype=bool),
+          'truncated': np.array([obj['truncated'] for obj in objs], dtype=bool),
+          'pose': pose.astype(np.int32),
+          'poses': poses}
+    print('Saving cached annotations to {:s}'.format(cache))
+    save_arrays(cache, gt)
+    return gt
+
+
+def load_annots(annopath, imagenames, cachedir):
+    """Parsed annotations of every image, keyed by image name, in the
+    parse_rec format.  Backed by load_gt_cache().
+    """
+    gt = load_gt_cache([annopath.format(name) for name in imagenames], cachedir)
+    objects = [{'name': str(gt['names'][label]),
+                'pose': str(gt['poses'][pose]),
+                'truncated': int(truncated),
+                'difficult': int(difficult),
+                'bbox': bbox}
+               for label, pose, truncated, difficult, bbox in zip(
+                   gt['label'], gt['pose'], gt['truncated'], gt['difficult'],
+                   gt['bbox'].tolist())]
+    offsets = gt['offsets']
+    return dict((name, objects[offsets[i]:offsets[i + 1]])
+                for i, name in enumerate(imagenames))
+
+
 def voc_eval(detpath,
              annopath,
              imagesetfile,
@@ -95,33 +158,14 @@ def voc_eval(detpath,
     # assumes detections are in detpath.format(classname)
     # assumes annotations are in annopath.format(imagename)
     # assumes imagesetfile is a text file with each line an image name
-    # cachedir caches the annotations in a pickle file
+    # cachedir caches the annotations, see load_gt_cache
 
     # first load gt
-    if not os.path.isdir(cachedir):
-        os.mkdir(cachedir)
-    cachefile = os.path.join(cachedir, 'annots.pkl')
     # read list of images
     with open(imagesetfile, 'r') as f:
         lines = f.readlines()
     imagenames = [x.strip() for x in lines]
-
-    if not os.path.isfile(cachefile):
-        # load annots
-        recs = {}
-        for i, imagename in enumerate(imagenames):
-            recs[imagename] = parse_rec(annopath.format(imagename))
-            if i % 100 == 0:
-                print('Reading annotation for {:d}/{:d}'.format(
-                    i + 1, len(imagenames)))
-        # save
-        print('Saving cached annotations to {:s}'.format(cachefile))
-        with open(cachefile, 'wb') as f:
-            pickle.dump(recs, f)
-    else:
-        # load
-        with open(cachefile, 'rb') as f:
-            recs = pickle.load(f)
+    recs = load_annots(annopath, imagenames, cachedir)
 
     # extract gt objects for this class
     class_recs = {}
@@ -129,7 +173,7 @@ def voc_eval(detpath,
     for imagename in imagenames:
         R = [obj for obj in recs[imagename] if obj['name'] == classname]
         bbox = np.array([x['bbox'] for x in R])
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
+        difficult = np.array([x['difficult'] for x in R]).astype(bool)
         det = [False] * len(R)
         npos = npos + sum(~difficult)
         class_recs[imagename] = {'bbox': bbox,
@@ -144,7 +188,7 @@ def voc_eval(detpath,
     splitlines = [x.strip().split(' ') for x in lines]
     image_ids = [x[0] for x in splitlines]
     confidence = np.array([float(x[1]) for x in splitlines])
-    BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
+    BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 4)
 
         # sort by confidence
     sorted_ind = np.argsort(-confidence)
@@ -202,3 +246,228 @@ def voc_eval(detpath,
     ap = voc_ap(rec, prec, use_07_metric)
 
     return rec, prec, ap
+
+
+def gt_arrays(gt_cache, classnames):
+    """Ground truth from load_gt_cache() regrouped by (image, class).
+
+    Returns a dict with bbox [G,4] (float), difficult [G] (bool), cls [G]
+    and offsets [num_images*num_classes+1]: objects of class j in image i are rows
+    offsets[i*num_classes+j]:offsets[i*num_classes+j+1].  Objects whose name
+    is not in classnames are dropped.
+    """
+    class_index = dict((name, j) for j, name in enumerate(classnames))
+    num_images = len(gt_cache['offsets']) - 1
+    cls = np.array([class_index.get(name, -1) for name in gt_cache['names']],
+                   dtype=np.int64)[gt_cache['label']]
+    img = np.repeat(np.arange(num_images), np.diff(gt_cache['offsets']))
+    keep = cls >= 0
+    keys = img[keep] * len(classnames) + cls[keep]
+    # stable, so objects keep their annotation order within a group
+    order = np.argsort(keys, kind='mergesort')
+    return {'cls': keys[order] % len(classnames),
+            'bbox': gt_cache['bbox'][keep][order].astype(float),
+            'difficult': gt_cache['difficult'][keep][order],
+            'offsets': np.searchsorted(keys[order],
+                                       np.arange(num_images * len(classnames) + 1))}
+
+
+def _round_half_even(x, decimals):
+    """x rounded to decimals as '{:.Nf}'.format(x) and float() would do."""
+    scale = 10. ** decimals
+    y = x * scale
+    r = np.rint(y)
+    # x * scale is inexact: redo values within reach of a rounding tie
+    near = np.flatnonzero(np.abs(np.abs(y - np.floor(y)) - 0.5) < 1e-6)
+    for k in near:
+        r[k] = round(float('{:.{:d}f}'.format(x[k], decimals)) * scale)
+    return r / scale
+
+
+def as_written(dets):
+    """Boxes and scores of [n,5] float32 dets as they come back from the
+    results files of VOCDetection: 1-based boxes with one decimal and scores
+    with three.
+    """
+    boxes = _round_half_even((dets[:, :4] + 1).astype(np.float64).ravel(), 1)
+    scores = _round_half_even(dets[:, 4].astype(np.float64), 3)
+    return boxes.reshape(-1, 4), scores
+
+
+def format_results(imagenames, img, dets):
+    """Lines of a results file for detections of one class, in the format
+    voc_eval reads: image name, score and 1-based box per line.
+
+    imagenames: name of every image
+    img: image index of every detection, Shape: [n]
+    dets: boxes and scores, Shape: [n,5]
+    Returns the whole file as one string, formatted by a single call.
+    """
+    n = len(dets)
+    if n == 0:
+        return ''
+    fields = np.empty((n, 6), dtype=object)
+    fields[:, 0] = np.asarray(imagenames, dtype=object)[np.asarray(img)]
+    fields[:, 1] = dets[:, 4].tolist()
+    fields[:, 2:] = (dets[:, :4] + 1).tolist()
+    return ('%s %.3f %.1f %.1f %.1f %.1f\n' * n) % tuple(fields.ravel())
+
+
+def _match_class(all_boxes, gt, j, num_classes, round_like_file=True):
+    """Sort the detections of class j by confidence like voc_eval and find
+    the best overlapping object of each in its image.
+
+    Returns ovmax [nd] (-inf without objects) and jmax [nd], the row in gt of
+    that object.  Both do not depend on the IoU threshold.
+    """
+    starts = gt['offsets'][j:-1:num_classes]
+    ends = gt['offsets'][j + 1::num_classes]
+    img, dets = all_boxes.class_dets(j)
+    if round_like_file:
+        BB, confidence = as_written(dets)
+    else:
+        BB, confidence = dets[:, :4].astype(float), dets[:, 4].astype(float)
+    # same sort as voc_eval, on the same order of detections
+    sorted_ind = np.argsort(-confidence)
+    BB = BB[sorted_ind, :]
+    img = np.asarray(img)[sorted_ind]
+    nd = len(img)
+
+    # every detection against the (padded) objects of its image
+    num_gt = ends[img] - starts[img]
+    max_gt = int(num_gt.max()) if nd else 0
+    ovmax = np.full(nd, -np.inf)
+    jmax = np.zeros(nd, dtype=np.int64)
+    if max_gt > 0:
+        col = np.arange(max_gt)
+        valid = col < num_gt[:, None]
+        rows = np.where(valid, starts[img][:, None] + col, 0)
+        BBGT = gt['bbox'][rows]
+        ixmin = np.maximum(BBGT[:, :, 0], BB[:, None, 0])
+        iymin = np.maximum(BBGT[:, :, 1], BB[:, None, 1])
+        ixmax = np.minimum(BBGT[:, :, 2], BB[:, None, 2])
+        iymax = np.minimum(BBGT[:, :, 3], BB[:, None, 3])
+        iw = np.maximum(ixmax - ixmin + 1., 0.)
+        ih = np.maximum(iymax - iymin + 1., 0.)
+        inters = iw * ih
+        uni = ((BB[:, None, 2] - BB[:, None, 0] + 1.) * (BB[:, None, 3] - BB[:, None, 1] + 1.) +
+               (BBGT[:, :, 2] - BBGT[:, :, 0] + 1.) *
+               (BBGT[:, :, 3] - BBGT[:, :, 1] + 1.) - inters)
+        overlaps = np.where(valid, inters / uni, -np.inf)
+        jmax = np.argmax(overlaps, axis=1)
+        ovmax = overlaps[np.arange(nd), jmax]
+        jmax = starts[img] + jmax
+    return ovmax, jmax
+
+
+def _rec_prec(ovmax, jmax, difficult, npos, ovthresh):
+    """voc_eval's TP/FP marking at one IoU threshold, then rec and prec."""
+    # a match is a TP only for the highest scored detection that claims a
+    # non-difficult object; later claims are FPs, difficult ones neither
+    matched = ovmax > ovthresh
+    claims = matched & ~difficult[np.where(matched, jmax, 0)]
+    tp = np.zeros(len(ovmax))
+    _, first = np.unique(jmax[claims], return_index=True)
+    tp[np.flatnonzero(claims)[first]] = 1.
+    fp = (~matched | claims).astype(float) - tp
+
+    # compute precision recall
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    return rec, prec
+
+
+def voc_eval_all(all_boxes, gt, classnames, ovthresh=0.5, use_07_metric=False,
+                 round_like_file=True):
+    """Evaluate every class in one pass, from detections in memory.
+
+    all_boxes: all_boxes[class][image] [n,5] arrays, or a DetectionStore
+    gt: ground truth from gt_arrays()
+    classnames: class names, index 0 is background and is skipped
+    [round_like_file]: round detections like the results files voc_eval
+        reads, which makes rec, prec and ap identical to voc_eval
+    Returns a dict mapping class name to (rec, prec, ap).
+    """
+    all_boxes = as_store(all_boxes)
+    results = {}
+    for j, classname in enumerate(classnames):
+        if classname == '__background__':
+            continue
+        npos = int(np.sum(~gt['difficult'][gt['cls'] == j]))
+        ovmax, jmax = _match_class(all_boxes, gt, j, len(classnames), round_like_file)
+        rec, prec = _rec_prec(ovmax, jmax, gt['difficult'], npos, ovthresh)
+        results[classname] = (rec, prec, voc_ap(rec, prec, use_07_metric))
+    return results
+
+
+# state of a voc_eval_table worker: the shared inputs, handed over once per
+# process, and the matches of the last class it saw
+_worker = {}
+
+
+def _init_worker(all_boxes, gt, num_classes, use_07_metric, round_like_file):
+    _worker.clear()
+    _worker.update(all_boxes=all_boxes, gt=gt, num_classes=num_classes,
+                   use_07_metric=use_07_metric, round_like_file=round_like_file)
+
+
+def _eval_unit(unit):
+    j, ovthresh = unit
+    gt = _worker['gt']
+    if _worker.get('class') != j:
+        # overlaps do not depend on the threshold: match once per class
+        _worker['class'] = j
+        _worker['match'] = _match_class(_worker['all_boxes'], gt, j, _worker['num_classes'],
+                                        _worker['round_like_file'])
+        _worker['npos'] = int(np.sum(~gt['difficult'][gt['cls'] == j]))
+    ovmax, jmax = _worker['match']
+    rec, prec = _rec_prec(ovmax, jmax, gt['difficult'], _worker['npos'], ovthresh)
+    return voc_ap(rec, prec, _worker['use_07_metric'])
+
+
+def voc_eval_table(all_boxes, gt, classnames, ovthreshs=np.linspace(.5, .95, 10),
+                   use_07_metric=False, processes=None, round_like_file=True,
+                   min_pool_work=5000000):
+    """AP of every class at every IoU threshold, computed by a process pool
+    for large detection sets.
+
+    Work units are (class, IoU threshold) pairs.  Detections and ground truth
+    reach each worker once, through the pool initializer (inherited without
+    pickling where processes fork), and units are dealt out class by class
+    so a worker matches a class once for all of its thresholds.  Starting a
+    pool takes about 0.1s while the serial pass runs about 10M detections x
+    thresholds per second, so the pool only pays off for full test sets on
+    several cores; smaller work is evaluated in this process.
+
+    all_boxes, gt, classnames, use_07_metric, round_like_file: as for
+        voc_eval_all
+    [ovthreshs]: IoU thresholds (default 0.5:0.05:0.95)
+    [processes]: pool size (default cpu count), 1 evaluates in this process
+    [min_pool_work]: detections x thresholds below which the table is
+        evaluated in this process whatever the pool size (default 5M, e.g.
+        500k detections at 10 thresholds)
+    Returns ap [len(ovthreshs), num_classes-1], classes in classnames order
+    without the background.
+    """
+    all_boxes = as_store(all_boxes)
+    ovthreshs = list(ovthreshs)
+    classes = [j for j, name in enumerate(classnames) if name != '__background__']
+    units = [(j, t) for j in classes for t in ovthreshs]
+    initargs = (all_boxes, gt, len(classnames), use_07_metric, round_like_file)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1 or len(all_boxes) * len(ovthreshs) < min_pool_work:
+        _init_worker(*initargs)
+        aps = [_eval_unit(unit) for unit in units]
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, initargs)
+        try:
+            aps = pool.map(_eval_unit, units, chunksize=len(ovthreshs))
+        finally:
+            pool.close()
+            pool.join()
+    return np.array(aps).reshape(len(classes), len(ovthreshs)).T
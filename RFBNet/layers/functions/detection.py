@@ -3,7 +3,7 @@ import torch.nn as nn
 import torch.backends.cudnn as cudnn
 from torch.autograd import Function
 from torch.autograd import Variable
-from utils.box_utils import decode
+from utils.box_utils import decode_batch
 
 
 class Detect(Function):
@@ -17,6 +17,7 @@ class Detect(Function):
         self.background_label = bkg_label
 
         self.variance = cfg['variance']
+        self.boxes = None
 
     def forward(self, predictions, prior):
         """
@@ -27,6 +28,11 @@ class Detect(Function):
                 Shape: [batch*num_priors,num_classes]
             prior_data: (tensor) Prior boxes and variances from priorbox layers
                 Shape: [1,num_priors,4]
+        Return:
+            boxes: (tensor) Decoded boxes, Shape: [batch,num_priors,4]
+            scores: (tensor) View of conf_data, Shape: [batch,num_priors,num_classes]
+            Index them per image (boxes[i], scores[i]) to get views without
+            copies.  The boxes buffer is reused, so the next call overwrites it.
         """
 
         loc, conf = predictions
@@ -36,28 +42,14 @@ class Detect(Function):
         prior_data = prior.data
         num = loc_data.size(0)  # batch size
         self.num_priors = prior_data.size(0)
-        self.boxes = torch.zeros(1, self.num_priors, 4)
-        self.scores = torch.zeros(1, self.num_priors, self.num_classes)
-        if loc_data.is_cuda:
-            self.boxes = self.boxes.cuda()
-            self.scores = self.scores.cuda()
-
-        if num == 1:
-            # size batch x num_classes x num_priors
-            conf_preds = conf_data.unsqueeze(0)
-
-        else:
-            conf_preds = conf_data.view(num, num_priors,
-                                        self.num_classes)
-            self.boxes.expand_(num, self.num_priors, 4)
-            self.scores.expand_(num, self.num_priors, self.num_classes)
+        loc_data = loc_data.view(num, self.num_priors, 4)
+        self.scores = conf_data.view(num, self.num_priors, self.num_classes)
+        # reuse the boxes buffer while batch size and device stay the same
+        if self.boxes is None or self.boxes.size() != loc_data.size() or \
+                self.boxes.device != loc_data.device:
+            self.boxes = loc_data.new(loc_data.size())
 
         # Decode predictions into bboxes.
-        for i in range(num):
-            decoded_boxes = decode(loc_data[i], prior_data, self.variance)
-            conf_scores = conf_preds[i].clone()
-
-            self.boxes[i] = decoded_boxes
-            self.scores[i] = conf_scores
+        decode_batch(loc_data, prior_data, self.variance, out=self.boxes)
 
         return self.boxes, self.scores
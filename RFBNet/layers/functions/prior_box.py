@@ -1,8 +1,14 @@
+import os
+import hashlib
 import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
+import numpy as np
+from utils.file_cache import save_arrays, load_arrays
 from math import sqrt as sqrt
-from itertools import product as product
+
+# priors already generated in this process, keyed by PriorBox.cache_key()
+_prior_cache = {}
 
 
 class PriorBox(object):
@@ -13,8 +19,10 @@ class PriorBox(object):
     paper, so we include both versions, but note v2 is the most tested and most
     recent version of the paper.
 
+    Generated priors are memoized per config in-process and, when cache_dir
+    is given, as .npy files in that directory.
     """
-    def __init__(self, cfg):
+    def __init__(self, cfg, cache_dir=None):
         super(PriorBox, self).__init__()
         self.image_size = cfg['min_dim']
         # number of priors for feature map location (either 4 or 6)
@@ -26,33 +34,59 @@ class PriorBox(object):
         self.steps = cfg['steps']
         self.aspect_ratios = cfg['aspect_ratios']
         self.clip = cfg['clip']
+        self.cache_dir = cache_dir
         for v in self.variance:
             if v <= 0:
                 raise ValueError('Variances must be greater than 0')
 
+    def cache_key(self):
+        key = repr((self.image_size, list(self.feature_maps), list(self.steps),
+                    list(self.min_sizes), list(self.max_sizes),
+                    [list(ar) for ar in self.aspect_ratios], bool(self.clip)))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
     def forward(self):
+        key = self.cache_key()
+        mean = _prior_cache.get(key)
+        if mean is None and self.cache_dir is not None:
+            cache = os.path.join(self.cache_dir, 'priors_' + key)
+            if os.path.isdir(cache):
+                mean = load_arrays(cache, ['priors'], mmap_mode=None)['priors']
+            else:
+                mean = self._generate()
+                save_arrays(cache, {'priors': mean})
+        if mean is None:
+            mean = self._generate()
+        _prior_cache[key] = mean
+        return torch.from_numpy(mean.copy())
+
+    def _generate(self):
+        """Array version of the original per-location loops.  Every value goes
+        through the same double precision arithmetic and is rounded to float32
+        once, so the result is bit-identical to the looped version.
+        """
         mean = []
         for k, f in enumerate(self.feature_maps):
-            for i, j in product(range(f), repeat=2):
-                f_k = self.image_size / self.steps[k]
-                cx = (j + 0.5) / f_k
-                cy = (i + 0.5) / f_k
-
-                s_k = self.min_sizes[k]/self.image_size
-                mean += [cx, cy, s_k, s_k]
-
-                # aspect_ratio: 1
-                # rel size: sqrt(s_k * s_(k+1))
-                s_k_prime = sqrt(s_k * (self.max_sizes[k]/self.image_size))
-                mean += [cx, cy, s_k_prime, s_k_prime]
-
-                # rest of aspect ratios
-                for ar in self.aspect_ratios[k]:
-                    mean += [cx, cy, s_k*sqrt(ar), s_k/sqrt(ar)]
-                    mean += [cx, cy, s_k/sqrt(ar), s_k*sqrt(ar)]
-
-        # back to torch land
-        output = torch.Tensor(mean).view(-1, 4)
+            f_k = self.image_size / self.steps[k]
+            centers = (np.arange(f, dtype=np.float64) + 0.5) / f_k
+
+            s_k = self.min_sizes[k]/self.image_size
+            # aspect_ratio: 1
+            # rel size: sqrt(s_k * s_(k+1))
+            s_k_prime = sqrt(s_k * (self.max_sizes[k]/self.image_size))
+            sizes = [(s_k, s_k), (s_k_prime, s_k_prime)]
+            # rest of aspect ratios
+            for ar in self.aspect_ratios[k]:
+                sizes += [(s_k*sqrt(ar), s_k/sqrt(ar)), (s_k/sqrt(ar), s_k*sqrt(ar))]
+
+            # [rows (cy), cols (cx), priors per location, 4]
+            boxes = np.empty((f, f, len(sizes), 4), dtype=np.float64)
+            boxes[..., 0] = centers[np.newaxis, :, np.newaxis]
+            boxes[..., 1] = centers[:, np.newaxis, np.newaxis]
+            boxes[..., 2:] = np.array(sizes, dtype=np.float64)
+            mean.append(boxes.reshape(-1, 4))
+
+        output = np.concatenate(mean).astype(np.float32)
         if self.clip:
-            output.clamp_(max=1, min=0)
+            np.clip(output, 0, 1, out=output)
         return output
@@ -2,7 +2,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from utils.box_utils import match, log_sum_exp
+from utils.box_utils import match, match_batch, pad_targets, log_sum_exp, topk_mask
 GPU = False
 if torch.cuda.is_available():
     GPU = True
@@ -32,7 +32,8 @@ class MultiBoxLoss(nn.Module):
     """
 
 
-    def __init__(self, num_classes,overlap_thresh,prior_for_matching,bkg_label,neg_mining,neg_pos,neg_overlap,encode_target):
+    def __init__(self, num_classes,overlap_thresh,prior_for_matching,bkg_label,neg_mining,neg_pos,neg_overlap,encode_target,
+                 batch_match=True,mining='topk',max_neg=None):
         super(MultiBoxLoss, self).__init__()
         self.num_classes = num_classes
         self.threshold = overlap_thresh
@@ -43,6 +44,12 @@ class MultiBoxLoss(nn.Module):
         self.negpos_ratio = neg_pos
         self.neg_overlap = neg_overlap
         self.variance = [0.1,0.2]
+        # match the whole batch in one vectorized pass instead of per image
+        self.batch_match = batch_match
+        # 'topk' selects negatives with a per-row top-k, 'sort' ranks them
+        # with the original double sort; max_neg caps negatives per image
+        self.mining = mining
+        self.max_neg = max_neg
 
     def forward(self, predictions, priors, targets):
         """Multibox Loss
@@ -64,13 +71,18 @@ class MultiBoxLoss(nn.Module):
         num_classes = self.num_classes
 
         # match priors (default boxes) and ground truth boxes
-        loc_t = torch.Tensor(num, num_priors, 4)
-        conf_t = torch.LongTensor(num, num_priors)
-        for idx in range(num):
-            truths = targets[idx][:,:-1].data
-            labels = targets[idx][:,-1].data
-            defaults = priors.data
-            match(self.threshold,truths,defaults,self.variance,labels,loc_t,conf_t,idx)
+        if self.batch_match:
+            truths, labels, valid = pad_targets([t.data for t in targets])
+            loc_t, conf_t = match_batch(self.threshold, truths, priors.data,
+                                        self.variance, labels, valid)
+        else:
+            loc_t = torch.Tensor(num, num_priors, 4)
+            conf_t = torch.LongTensor(num, num_priors)
+            for idx in range(num):
+                truths = targets[idx][:,:-1].data
+                labels = targets[idx][:,-1].data
+                defaults = priors.data
+                match(self.threshold,truths,defaults,self.variance,labels,loc_t,conf_t,idx)
         if GPU:
             loc_t = loc_t.cuda()
             conf_t = conf_t.cuda()
@@ -87,18 +99,31 @@ class MultiBoxLoss(nn.Module):
         loc_t = loc_t[pos_idx].view(-1,4)
         loss_l = F.smooth_l1_loss(loc_p, loc_t, size_average=False)
 
-        # Compute max conf across batch for hard negative mining
-        batch_conf = conf_data.view(-1,self.num_classes)
-        loss_c = log_sum_exp(batch_conf) - batch_conf.gather(1, conf_t.view(-1,1))
-
         # Hard Negative Mining
-        loss_c[pos.view(-1,1)] = 0 # filter out pos boxes for now
-        loss_c = loss_c.view(num, -1)
-        _,loss_idx = loss_c.sort(1, descending=True)
-        _,idx_rank = loss_idx.sort(1)
         num_pos = pos.long().sum(1,keepdim=True)
         num_neg = torch.clamp(self.negpos_ratio*num_pos, max=pos.size(1)-1)
-        neg = idx_rank < num_neg.expand_as(idx_rank)
+        if self.max_neg is not None:
+            num_neg = torch.clamp(num_neg, max=self.max_neg)
+        if self.mining == 'topk':
+            with torch.no_grad():
+                # the mining loss only ranks priors: no graph, exp in place,
+                # and the target of every prior left after filtering out the
+                # pos boxes is the background label 0
+                x_max = conf_data.data.max()
+                loss_c = (conf_data.data - x_max).exp_().sum(2).log_() + x_max
+                loss_c -= conf_data.data[:, :, 0]
+                loss_c[pos] = 0
+                neg = topk_mask(loss_c, num_neg)
+        else:
+            # Compute max conf across batch for hard negative mining
+            batch_conf = conf_data.view(-1,self.num_classes)
+            loss_c = log_sum_exp(batch_conf) - batch_conf.gather(1, conf_t.view(-1,1))
+
+            loss_c[pos.view(-1,1)] = 0 # filter out pos boxes for now
+            loss_c = loss_c.view(num, -1)
+            _,loss_idx = loss_c.sort(1, descending=True)
+            _,idx_rank = loss_idx.sort(1)
+            neg = idx_rank < num_neg.expand_as(idx_rank)
 
         # Confidence Loss Including Positive and Negative Examples
         pos_idx = pos.unsqueeze(2).expand_as(conf_data)
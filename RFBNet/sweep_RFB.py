@@ -0,0 +1,86 @@
+from __future__ import print_function
+import os
+import time
+import argparse
+from itertools import product
+from data import VOCroot, COCOroot
+from data import AnnotationTransform, COCODetection, VOCDetection
+from utils.nms_wrapper import nms_candidates
+from utils.detection_store import DetectionStore
+from utils.raw_cache import RawOutputCache
+
+parser = argparse.ArgumentParser(
+    description='Receptive Field Block Net post-processing sweep')
+parser.add_argument('-d', '--dataset', default='VOC',
+                    help='VOC or COCO version')
+parser.add_argument('--save_folder', default='eval/', type=str,
+                    help='Dir the raw cache was saved to by test_RFB.py --raw_cache')
+parser.add_argument('--nms', default='0.45', type=str,
+                    help='Comma separated nms overlap thresholds')
+parser.add_argument('--thresh', default='0.01', type=str,
+                    help='Comma separated pre-nms score thresholds')
+parser.add_argument('--max_per_image', default='200', type=str,
+                    help='Comma separated max detections per image, 0 for no limit')
+parser.add_argument('--pre_nms_top_k', default=0, type=int,
+                    help='Max candidates per class kept before nms, 0 for all of them')
+parser.add_argument('--cpu', default=False, type=bool,
+                    help='Use cpu nms')
+args = parser.parse_args()
+
+
+def parse_list(values, type):
+    return [type(v) for v in values.split(',')]
+
+
+def post_process(cache, nms_thresh, thresh, max_per_image):
+    """Rebuild all_boxes from the cached outputs with one setting."""
+    all_boxes = [[[] for _ in range(cache.num_images)]
+                 for _ in range(cache.num_classes)]
+    for i in range(cache.num_images):
+        cls, dets = cache.candidates(i, thresh, args.pre_nms_top_k or None)
+        dets_per_class = nms_candidates(cls, dets, cache.num_classes, nms_thresh,
+                                        max_per_image, force_cpu=args.cpu)
+        for j in range(1, cache.num_classes):
+            all_boxes[j][i] = dets_per_class[j]
+    return DetectionStore.from_all_boxes(all_boxes)
+
+
+if __name__ == '__main__':
+    if args.dataset == 'VOC':
+        testset = VOCDetection(
+            VOCroot, [('2007', 'test')], None, AnnotationTransform())
+    elif args.dataset == 'COCO':
+        testset = COCODetection(
+            COCOroot, [('2014', 'minival')], None)
+    else:
+        print('Only VOC and COCO dataset are supported now!')
+    save_folder = os.path.join(args.save_folder, args.dataset)
+    cache = RawOutputCache.load(os.path.join(save_folder, 'raw_outputs'))
+    if cache.num_images != len(testset):
+        raise ValueError('Raw cache has {:d} images, test set {:d}'.format(
+            cache.num_images, len(testset)))
+
+    results = []
+    for nms_thresh, thresh, max_per_image in product(
+            parse_list(args.nms, float), parse_list(args.thresh, float),
+            parse_list(args.max_per_image, int)):
+        print('nms {:.2f}  thresh {:.3f}  max_per_image {:d}'.format(
+            nms_thresh, thresh, max_per_image))
+        t0 = time.time()
+        store = post_process(cache, nms_thresh, thresh, max_per_image)
+        post_time = time.time() - t0
+        output_dir = os.path.join(save_folder, 'sweep', 'nms{:g}_thresh{:g}_max{:d}'.format(
+            nms_thresh, thresh, max_per_image))
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        store.save(os.path.join(output_dir, 'detections'))
+        mAP = testset.evaluate_detections(store.all_boxes(), output_dir)
+        if mAP is None:  # no ground truth, e.g. COCO test-dev
+            mAP = float('nan')
+        results.append((nms_thresh, thresh, max_per_image, mAP, post_time))
+
+    print('~~~~ Sweep over {:d} images ~~~~'.format(cache.num_images))
+    print('   nms  thresh  max/img     mAP   post-process')
+    for nms_thresh, thresh, max_per_image, mAP, post_time in results:
+        print('{:6.2f}  {:6.3f}  {:7d}  {:6.4f}  {:10.2f}s'.format(
+            nms_thresh, thresh, max_per_image, mAP, post_time))
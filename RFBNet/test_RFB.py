@@ -2,19 +2,27 @@ from __future__ import print_function
 import sys
 import os
 import pickle
+import shutil
 import argparse
 import torch
 import torch.nn as nn
 import torch.backends.cudnn as cudnn
 import torchvision.transforms as transforms
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from torch.autograd import Variable
 from data import VOCroot,COCOroot 
 from data import AnnotationTransform, COCODetection, VOCDetection, BaseTransform, VOC_300,VOC_512,COCO_300,COCO_512, COCO_mobile_300
+from data import EvalDataset, eval_collate
 
 import torch.utils.data as data
+import torch.multiprocessing as mp
 from layers.functions import Detect,PriorBox
-from utils.nms_wrapper import nms
+from utils.nms_wrapper import batched_nms_candidates
+from utils.box_utils import select_candidates
+from utils.detection_store import DetectionStore
+from utils.raw_cache import RawCacheWriter, RawOutputCache
+from utils.file_cache import file_key
 from utils.timer import Timer
 
 parser = argparse.ArgumentParser(description='Receptive Field Block Net')
@@ -35,6 +43,33 @@ parser.add_argument('--cpu', default=False, type=bool,
                     help='Use cpu nms')
 parser.add_argument('--retest', default=False, type=bool,
                     help='test cache results')
+parser.add_argument('--nms_thresh', default=0.45, type=float,
+                    help='Overlap threshold of the per-class nms, e.g. one picked with sweep_RFB.py')
+parser.add_argument('--pre_nms_top_k', default=0, type=int,
+                    help='Max candidates per class kept before nms, 0 for all of them')
+parser.add_argument('-b', '--batch_size', default=8, type=int,
+                    help='Batch size for evaluation')
+parser.add_argument('--num_workers', default=4, type=int,
+                    help='Number of workers used in dataloading')
+parser.add_argument('--num_shards', default=1, type=int,
+                    help='Number of processes the test set is split across')
+parser.add_argument('--shard_threads', default=None, type=int,
+                    help='Torch threads per shard process, default cores / shards')
+parser.add_argument('--raw_cache', default=False, type=bool,
+                    help='Also save decoded network outputs for sweep_RFB.py')
+parser.add_argument('--cache_floor', default=0.01, type=float,
+                    help='Scores at or below this are left out of the raw cache')
+parser.add_argument('--write_results', default=False, type=bool,
+                    help='Also write the VOC comp4 results files, e.g. for a submission')
+parser.add_argument('--eval_processes', default=1, type=int,
+                    help='Processes for the COCO evaluation and the VOC AP table, 0 for all '
+                         'cores; the AP table stays serial below 500k detections')
+parser.add_argument('--ap_table', default=False, type=bool,
+                    help='VOC: also print the AP of every class at IoU 0.5:0.05:0.95')
+parser.add_argument('--running_ap', default=0, type=int,
+                    help='COCO: evaluate while detecting and print the AP every N images, 0 to disable')
+parser.add_argument('--check_paths', default='eager', choices=['eager', 'lazy', 'background'],
+                    help='COCO: check image paths at startup, on read only, or in background threads')
 args = parser.parse_args()
 
 if not os.path.exists(args.save_folder):
@@ -54,101 +89,275 @@ elif args.version == 'RFB_mobile':
     cfg = COCO_mobile_300
 else:
     print('Unkown version!')
+rgb_means = ((104, 117, 123),(103.94,116.78,123.68))[args.version == 'RFB_mobile']
 
-priorbox = PriorBox(cfg)
+priorbox = PriorBox(cfg, cache_dir=os.path.join(args.save_folder, 'cache'))
 with torch.no_grad():
     priors = priorbox.forward()
     if args.cuda:
         priors = priors.cuda()
 
 
-def test_net(save_folder, net, detector, cuda, testset, transform, max_per_image=300, thresh=0.005):
+def im_detect_post(boxes, scores, num_classes, max_per_image, thresh, pre_nms_top_k=None,
+                   nms_thresh=0.45):
+    """Per-class nms and the max_per_image cut for a batch of images, with
+    one nms call for every class of every image.
 
-    if not os.path.exists(save_folder):
-        os.mkdir(save_folder)
-    # dump predictions and assoc. ground truth to text file for now
-    num_images = len(testset)
+    boxes [batch,num_priors,4] are in image pixels, scores
+    [batch,num_priors,num_classes].  Returns, per image, a list of
+    [num_dets,5] arrays indexed by class, entry 0 unused.
+    """
+    img, cls, dets = [], [], []
+    for b in range(boxes.size(0)):
+        # threshold and cut candidates on the device, copy only survivors
+        c_cls, inds, c_scores = select_candidates(scores[b], thresh, pre_nms_top_k)
+        img.append(torch.full_like(c_cls, b))
+        cls.append(c_cls)
+        dets.append(torch.cat((boxes[b][inds], c_scores.unsqueeze(1)), 1))
+    return batched_nms_candidates(torch.cat(img).cpu().numpy(), torch.cat(cls).cpu().numpy(),
+                                  torch.cat(dets).cpu().numpy(), boxes.size(0), num_classes,
+                                  nms_thresh, max_per_image, force_cpu=args.cpu)
+
+
+def detect_images(net, detector, cuda, testset, transform, image_ids, max_per_image, thresh,
+                  pre_nms_top_k=None, nms_thresh=0.45, batch_size=1, num_workers=0,
+                  raw_writer=None, on_image=None):
+    """Detections for the images image_ids of testset, as a list indexed by
+    class of lists indexed by position in image_ids.  The decoded outputs are
+    also added to raw_writer, by position, if one is given, and on_image is
+    called with (position, detections indexed by class) of every image.
+    """
     num_classes = (21, 81)[args.dataset == 'COCO']
-    all_boxes = [[[] for _ in range(num_images)]
+    all_boxes = [[[] for _ in image_ids]
                  for _ in range(num_classes)]
+    position = dict((i, pos) for pos, i in enumerate(image_ids))
 
     _t = {'im_detect': Timer(), 'misc': Timer()}
-    det_file = os.path.join(save_folder, 'detections.pkl')
 
-    if args.retest:
-        f = open(det_file,'rb')
-        all_boxes = pickle.load(f)
-        print('Evaluating detections')
-        testset.evaluate_detections(all_boxes, save_folder)
-        return
+    # images are read and transformed in the loader workers; nms of one batch
+    # runs in a helper thread while the next batch goes through the net
+    loader = data.DataLoader(data.Subset(EvalDataset(testset, transform), image_ids),
+                             batch_size, shuffle=False, num_workers=num_workers,
+                             collate_fn=eval_collate, pin_memory=cuda)
 
+    def post_process(indices, boxes, scores):
+        _t['misc'].tic()
+        if raw_writer is not None:
+            for b, i in enumerate(indices):
+                raw_writer.add(position[i], boxes[b], scores[b])
+        for i, dets_per_class in zip(indices, im_detect_post(
+                boxes, scores, num_classes, max_per_image, thresh, pre_nms_top_k, nms_thresh)):
+            for j in range(1, num_classes):
+                all_boxes[j][position[i]] = dets_per_class[j]
+            if on_image is not None:
+                on_image(position[i], dets_per_class)
+        return _t['misc'].toc()
 
-    for i in range(num_images):
-        img = testset.pull_image(i)
-        scale = torch.Tensor([img.shape[1], img.shape[0],
-                             img.shape[1], img.shape[0]])
+    pool = ThreadPoolExecutor(max_workers=1)
+    pending = None
+    nms_time = 0.
+    for indices, x, scale in loader:
         with torch.no_grad():
-            x = transform(img).unsqueeze(0)
             if cuda:
-                x = x.cuda()
-                scale = scale.cuda()
-
-        _t['im_detect'].tic()
-        out = net(x)      # forward pass
-        boxes, scores = detector.forward(out,priors)
-        detect_time = _t['im_detect'].toc()
-        boxes = boxes[0]
-        scores=scores[0]
+                x = x.cuda(non_blocking=True)
+                scale = scale.cuda(non_blocking=True)
 
-        boxes *= scale
-        boxes = boxes.cpu().numpy()
-        scores = scores.cpu().numpy()
-        # scale each detection back up to the image
+            _t['im_detect'].tic()
+            out = net(x)      # forward pass
+            boxes, scores = detector.forward(out,priors)
+            # scale each detection back up to the image; this also copies
+            # the boxes out of the detector's reused buffer
+            boxes = boxes * scale.unsqueeze(1)
+            detect_time = _t['im_detect'].toc()
 
-        _t['misc'].tic()
+        if pending is not None:
+            nms_time = pending.result()
+        pending = pool.submit(post_process, indices, boxes, scores)
 
-        for j in range(1, num_classes):
-            inds = np.where(scores[:, j] > thresh)[0]
-            if len(inds) == 0:
-                all_boxes[j][i] = np.empty([0, 5], dtype=np.float32)
-                continue
-            c_bboxes = boxes[inds]
-            c_scores = scores[inds, j]
-            c_dets = np.hstack((c_bboxes, c_scores[:, np.newaxis])).astype(
-                np.float32, copy=False)
-
-            keep = nms(c_dets, 0.45, force_cpu=args.cpu)
-            c_dets = c_dets[keep, :]
-            all_boxes[j][i] = c_dets
-        if max_per_image > 0:
-            image_scores = np.hstack([all_boxes[j][i][:, -1] for j in range(1,num_classes)])
-            if len(image_scores) > max_per_image:
-                image_thresh = np.sort(image_scores)[-max_per_image]
-                for j in range(1, num_classes):
-                    keep = np.where(all_boxes[j][i][:, -1] >= image_thresh)[0]
-                    all_boxes[j][i] = all_boxes[j][i][keep, :]
-
-        nms_time = _t['misc'].toc()
-
-        if i % 20 == 0:
+        if any(position[i] % 20 == 0 for i in indices):
             print('im_detect: {:d}/{:d} {:.3f}s {:.3f}s'
-                .format(i + 1, num_images, detect_time, nms_time))
+                .format(position[indices[-1]] + 1, len(image_ids), detect_time, nms_time))
             _t['im_detect'].clear()
             _t['misc'].clear()
+    if pending is not None:
+        pending.result()
+    pool.shutdown()
+    return all_boxes
+
+
+def shard_image_ids(num_images, shard, num_shards):
+    """Contiguous slice of the test set handled by one shard."""
+    return np.array_split(np.arange(num_images), num_shards)[shard].tolist()
+
+
+def shard_dir(save_folder, num_images, test_kwargs):
+    """Directory of the shard stores of one evaluation, named by the
+    checkpoint's path, mtime and size and by every setting that changes the
+    detections, so shards of another model or other settings are never
+    resumed.
+    """
+    settings = sorted((k, v) for k, v in test_kwargs.items()
+                      if k not in ('batch_size', 'num_workers'))
+    return os.path.join(save_folder, 'shards', file_key(
+        args.trained_model, args.version, args.size, args.dataset, num_images, settings,
+        args.raw_cache and args.cache_floor))
+
+
+def shard_file(shards, shard, num_shards, kind='detections'):
+    return os.path.join(shards, '{:s}_{:d}_of_{:d}'.format(kind, shard, num_shards))
+
+
+def shard_done(shards, shard, num_shards):
+    if args.raw_cache and not RawOutputCache.exists(
+            shard_file(shards, shard, num_shards, 'raw')):
+        return False
+    return DetectionStore.exists(shard_file(shards, shard, num_shards))
+
+
+def eval_shard(shard, num_shards, shards, num_threads, test_kwargs):
+    """Worker process entry: run one shard with its own model replica and
+    write its detections to the shard file.
+    """
+    torch.set_num_threads(num_threads)
+    testset = load_testset()
+    net = load_net(args.cuda)
+    image_ids = shard_image_ids(len(testset), shard, num_shards)
+    print('Shard {:d}/{:d}: {:d} images, {:d} threads'.format(
+        shard + 1, num_shards, len(image_ids), num_threads))
+    raw_writer = None
+    if args.raw_cache:
+        raw_writer = RawCacheWriter(len(image_ids), net.num_classes, args.cache_floor)
+    boxes = detect_images(net, Detect(net.num_classes, 0, cfg), args.cuda, testset,
+                          BaseTransform(net.size, rgb_means, (2, 0, 1)),
+                          image_ids, raw_writer=raw_writer, **test_kwargs)
+    if raw_writer is not None:
+        raw_writer.close().save(shard_file(shards, shard, num_shards, 'raw'))
+    # a shard store only appears once it is complete, so resume can trust it
+    DetectionStore.from_all_boxes(boxes).save(shard_file(shards, shard, num_shards))
+
+
+def run_shards(save_folder, num_images, num_shards, num_threads, test_kwargs):
+    """Evaluate the test set in num_shards worker processes, skipping shards
+    finished by an earlier run of the same model and settings, and merge the
+    shard stores into one.  The shard stores are removed once merged.
+    """
+    shards = shard_dir(save_folder, num_images, test_kwargs)
+    if not os.path.exists(shards):
+        os.makedirs(shards)
+    todo = [k for k in range(num_shards)
+            if not shard_done(shards, k, num_shards)]
+    if len(todo) < num_shards:
+        print('Resuming: {:d}/{:d} shards already done'.format(
+            num_shards - len(todo), num_shards))
+    # spawn, not fork: every worker builds its own replica, also on cuda
+    ctx = mp.get_context('spawn')
+    procs = [ctx.Process(target=eval_shard,
+                         args=(k, num_shards, shards, num_threads, test_kwargs))
+             for k in todo]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    failed = [k for k, p in zip(todo, procs) if p.exitcode != 0]
+    if failed:
+        raise RuntimeError('Shards {} failed, rerun to resume'.format(failed))
+
+    stores = []
+    for k in range(num_shards):
+        store = DetectionStore.load(shard_file(shards, k, num_shards))
+        if store.num_images != len(shard_image_ids(num_images, k, num_shards)):
+            raise ValueError('Shard {} does not match the test set'.format(
+                shard_file(shards, k, num_shards)))
+        stores.append(store)
+    if args.raw_cache:
+        RawOutputCache.concatenate([
+            RawOutputCache.load(shard_file(shards, k, num_shards, 'raw'))
+            for k in range(num_shards)]).save(os.path.join(save_folder, 'raw_outputs'))
+    store = DetectionStore.concatenate(stores)
+    shutil.rmtree(shards)
+    return store
+
+
+def test_net(save_folder, net, detector, cuda, testset, transform, max_per_image=300, thresh=0.005,
+             pre_nms_top_k=None, nms_thresh=0.45, batch_size=1, num_workers=0, num_shards=1,
+             shard_threads=1):
+
+    if not os.path.exists(save_folder):
+        os.mkdir(save_folder)
+    # dump predictions and assoc. ground truth to text file for now
+    num_images = len(testset)
+    det_file = os.path.join(save_folder, 'detections')
+
+    if args.retest:
+        if DetectionStore.exists(det_file):
+            all_boxes = DetectionStore.load(det_file).all_boxes()
+        else:
+            # results saved before the detection store was introduced
+            f = open(det_file + '.pkl','rb')
+            all_boxes = pickle.load(f)
+        print('Evaluating detections')
+        evaluate(testset, all_boxes, save_folder)
+        return
 
-    with open(det_file, 'wb') as f:
-        pickle.dump(all_boxes, f, pickle.HIGHEST_PROTOCOL)
+    test_kwargs = dict(max_per_image=max_per_image, thresh=thresh, pre_nms_top_k=pre_nms_top_k,
+                       nms_thresh=nms_thresh, batch_size=batch_size, num_workers=num_workers)
+    on_image = None
+    if num_shards > 1:
+        # net and detector are built in the shard workers
+        store = run_shards(save_folder, num_images, num_shards, shard_threads, test_kwargs)
+    else:
+        raw_writer = None
+        if args.raw_cache:
+            raw_writer = RawCacheWriter(num_images, net.num_classes, args.cache_floor)
+        if args.running_ap and args.dataset == 'COCO' and testset.coco_name.find('test') == -1:
+            stream = testset.stream_evaluator()
+            on_image = running_ap(testset, stream, num_images, args.running_ap)
+        store = DetectionStore.from_all_boxes(detect_images(
+            net, detector, cuda, testset, transform, list(range(num_images)),
+            raw_writer=raw_writer, on_image=on_image, **test_kwargs))
+        if raw_writer is not None:
+            raw_writer.close().save(os.path.join(save_folder, 'raw_outputs'))
+    store.save(det_file)
 
     print('Evaluating detections')
-    testset.evaluate_detections(all_boxes, save_folder)
+    if on_image is not None:
+        # every image is matched already: no results json
+        testset.evaluate_stream(stream, save_folder)
+    else:
+        evaluate(testset, store.all_boxes(), save_folder)
 
 
-if __name__ == '__main__':
-    # load net
+def running_ap(testset, stream, num_images, every):
+    """on_image callback feeding the COCO stream evaluator, printing the AP
+    of the images so far every `every` images.
+    """
+    done = [0]
+
+    def on_image(i, dets_per_class):
+        testset.add_stream_detections(stream, i, dets_per_class)
+        done[0] += 1
+        if done[0] % every == 0 and done[0] < num_images:
+            print('running AP@[.5:.95] {:d}/{:d}: {:.4f}'.format(
+                done[0], num_images, testset.stream_ap(stream)))
+    return on_image
+
+
+def evaluate(testset, all_boxes, save_folder):
+    if args.dataset == 'VOC':
+        return testset.evaluate_detections(all_boxes, save_folder,
+                                           write_results=args.write_results,
+                                           ovthreshs=np.linspace(.5, .95, 10) if args.ap_table
+                                           else None,
+                                           processes=args.eval_processes or None)
+    return testset.evaluate_detections(all_boxes, save_folder,
+                                       processes=args.eval_processes or None)
+
+
+def load_net(cuda):
     img_dim = (300,512)[args.size=='512']
     num_classes = (21, 81)[args.dataset == 'COCO']
     net = build_net('test', img_dim, num_classes)    # initialize detector
-    state_dict = torch.load(args.trained_model)
+    state_dict = torch.load(args.trained_model, map_location='cpu')
     # create new OrderedDict that does not contain `module.`
 
     from collections import OrderedDict
@@ -162,29 +371,47 @@ if __name__ == '__main__':
         new_state_dict[name] = v
     net.load_state_dict(new_state_dict)
     net.eval()
-    print('Finished loading model!')
-    print(net)
-    # load data
+    if cuda:
+        net = net.cuda()
+        cudnn.benchmark = True
+    else:
+        net = net.cpu()
+    return net
+
+
+def load_testset():
     if args.dataset == 'VOC':
         testset = VOCDetection(
             VOCroot, [('2007', 'test')], None, AnnotationTransform())
     elif args.dataset == 'COCO':
         testset = COCODetection(
-            COCOroot, [('2014', 'minival')], None)
+            COCOroot, [('2014', 'minival')], None, check_paths=args.check_paths)
             #COCOroot, [('2015', 'test-dev')], None)
     else:
         print('Only VOC and COCO dataset are supported now!')
-    if args.cuda:
-        net = net.cuda()
-        cudnn.benchmark = True
-    else:
-        net = net.cpu()
+    return testset
+
+
+if __name__ == '__main__':
+    # load net
+    img_dim = (300,512)[args.size=='512']
+    num_classes = (21, 81)[args.dataset == 'COCO']
+    net = detector = None
+    if args.num_shards == 1 and not args.retest:
+        net = load_net(args.cuda)
+        print('Finished loading model!')
+        print(net)
+        detector = Detect(num_classes,0,cfg)
+    # load data
+    testset = load_testset()
     # evaluation
     #top_k = (300, 200)[args.dataset == 'COCO']
     top_k = 200
-    detector = Detect(num_classes,0,cfg)
     save_folder = os.path.join(args.save_folder,args.dataset)
-    rgb_means = ((104, 117, 123),(103.94,116.78,123.68))[args.version == 'RFB_mobile']
+    shard_threads = args.shard_threads or max(1, mp.cpu_count() // args.num_shards)
     test_net(save_folder, net, detector, args.cuda, testset,
-             BaseTransform(net.size, rgb_means, (2, 0, 1)),
-             top_k, thresh=0.01)
+             BaseTransform(img_dim, rgb_means, (2, 0, 1)),
+             top_k, thresh=0.01, pre_nms_top_k=args.pre_nms_top_k or None,
+             nms_thresh=args.nms_thresh,
+             batch_size=args.batch_size, num_workers=args.num_workers,
+             num_shards=args.num_shards, shard_threads=shard_threads)
@@ -0,0 +1,52 @@
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+
+from utils.pycocotools.coco import COCO
+
+
+def random_coco(rng, num_images, num_cats):
+    """COCO ground truth and bbox results: crowd regions, objects of every
+    area range, duplicated objects and detections for IoU ties, coarse
+    scores for score ties and some (image, category) pairs with more
+    detections than maxDets.
+    """
+    images = [{'id': i + 1, 'width': 640, 'height': 480} for i in range(num_images)]
+    cats = [{'id': c + 1, 'name': str(c + 1)} for c in range(num_cats)]
+    anns, results = [], []
+    for img in images:
+        objs = []
+        for _ in range(rng.randint(0, 12)):
+            w, h = np.exp(rng.uniform(np.log(4), np.log(400), 2))
+            x, y = rng.uniform(0, 640 - w), rng.uniform(0, 480 - h)
+            objs.append([x, y, w, h])
+            if rng.rand() < 0.1:
+                objs.append([x, y, w, h])
+        for bb in objs:
+            anns.append({'id': len(anns) + 1, 'image_id': img['id'],
+                         'category_id': int(rng.randint(1, num_cats + 1)),
+                         'bbox': bb, 'area': bb[2] * bb[3] * rng.uniform(0.5, 1),
+                         'iscrowd': int(rng.rand() < 0.1)})
+        for ann in anns[len(anns) - len(objs):]:
+            for _ in range(rng.randint(0, 6)):
+                bb = np.array(ann['bbox']) * rng.normal(1, 0.15, 4)
+                results.append({'image_id': img['id'], 'category_id': ann['category_id'],
+                                'bbox': bb.tolist() if rng.rand() < 0.9 else list(ann['bbox']),
+                                'score': round(rng.rand(), 2)})
+        for _ in range(rng.randint(0, 60) + (rng.rand() < 0.02) * 120):
+            w, h = rng.uniform(4, 300, 2)
+            results.append({'image_id': img['id'], 'category_id': int(rng.randint(1, 4)),
+                            'bbox': [rng.uniform(0, 600), rng.uniform(0, 440), w, h],
+                            'score': round(rng.rand(), 2)})
+    return {'images': images, 'categories': cats, 'annotations': anns}, results
+
+
+def coco_apis(dataset, results):
+    """COCO ground truth and loadRes() result objects of random_coco data."""
+    with redirect_stdout(io.StringIO()):
+        coco_gt = COCO()
+        coco_gt.dataset = dataset
+        coco_gt.createIndex()
+        coco_dt = coco_gt.loadRes([dict(r) for r in results])
+    return coco_gt, coco_dt
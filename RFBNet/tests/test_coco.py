@@ -0,0 +1,26 @@
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+import pytest
+
+from random_coco import random_coco, coco_apis
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_load_res_arrays_equals_load_res(seed):
+    dataset, results = random_coco(np.random.RandomState(seed), 50, 4)
+    coco_gt, ref = coco_apis(dataset, results)
+    with redirect_stdout(io.StringIO()):
+        res = coco_gt.loadResArrays([r['image_id'] for r in results],
+                                    [r['bbox'] for r in results],
+                                    [r['score'] for r in results],
+                                    [r['category_id'] for r in results])
+    # loadResArrays makes no polygon from the boxes
+    assert [dict((k, v) for k, v in a.items() if k != 'segmentation')
+            for a in ref.dataset['annotations']] == res.dataset['annotations']
+    assert dict(ref.anns).keys() == dict(res.anns).keys()
+    assert (dict((i, [a['id'] for a in anns]) for i, anns in ref.imgToAnns.items()) ==
+            dict((i, [a['id'] for a in anns]) for i, anns in res.imgToAnns.items()))
+    assert dict(ref.catToImgs) == dict(res.catToImgs)
+    assert ref.cats == res.cats and ref.imgs == res.imgs
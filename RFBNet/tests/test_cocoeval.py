@@ -0,0 +1,43 @@
+import io
+from contextlib import redirect_stdout
+
+import numpy as np
+import pytest
+
+from utils.pycocotools.cocoeval import COCOeval
+from random_coco import random_coco, coco_apis
+
+
+def coco_eval(coco_gt, coco_dt, **params):
+    E = COCOeval(coco_gt, coco_dt, 'bbox')
+    for name, value in params.items():
+        setattr(E.params, name, value)
+    with redirect_stdout(io.StringIO()):
+        E.evaluate()
+        E.accumulate()
+    return E
+
+
+def assert_same_eval_imgs(a, b):
+    assert len(a) == len(b)
+    for x, y in zip(a, b):
+        assert (x is None) == (y is None)
+        if x is None:
+            continue
+        for key in ('image_id', 'category_id', 'aRng', 'maxDet', 'dtIds', 'gtIds', 'dtScores'):
+            assert x[key] == y[key]
+        for key in ('dtMatches', 'gtMatches', 'gtIgnore', 'dtIgnore'):
+            np.testing.assert_array_equal(x[key], y[key])
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('params', [dict(), dict(maxDets=[1, 3, 7]),
+                                    dict(iouThrs=np.array([.1, .5, .55, .9])),
+                                    dict(useCats=0)])
+def test_fast_match_equals_matching_loop(seed, params):
+    coco_gt, coco_dt = coco_apis(*random_coco(np.random.RandomState(seed), 100, 4))
+    ref = coco_eval(coco_gt, coco_dt, fastMatch=0, **params)
+    new = coco_eval(coco_gt, coco_dt, fastMatch=1, **params)
+    assert_same_eval_imgs(ref.evalImgs, new.evalImgs)
+    np.testing.assert_array_equal(ref.eval['precision'], new.eval['precision'])
+    np.testing.assert_array_equal(ref.eval['recall'], new.eval['recall'])
@@ -0,0 +1,32 @@
+import numpy as np
+
+from utils.pycocotools import mask as maskUtils
+
+
+def test_bb_iou_expected_values():
+    # x, y, w, h; the second gt is a crowd region: iou over the dt area.
+    # The last dt touches the first gt and lies inside the crowd
+    dt = [[0, 0, 10, 10], [5, 5, 10, 10], [20, 20, 5, 5], [10, 0, 5, 5]]
+    gt = [[0, 0, 10, 10], [5, 0, 10, 10]]
+    ious = maskUtils.bbIou(dt, gt, [0, 1])
+    np.testing.assert_array_equal(ious, [[1., .5],
+                                         [25. / 175, .5],
+                                         [0., 0.],
+                                         [0., 1.]])
+    # arrays give the same as lists
+    np.testing.assert_array_equal(
+        maskUtils.bbIou(np.array(dt, dtype=np.float32), np.array(gt), np.array([0, 1])), ious)
+
+
+def test_bb_iou_crowd_contains_dt():
+    dt, gt = [[2, 2, 2, 2]], [[0, 0, 10, 10]]
+    np.testing.assert_array_equal(maskUtils.bbIou(dt, gt, [0]), [[.04]])
+    np.testing.assert_array_equal(maskUtils.bbIou(dt, gt, [1]), [[1.]])
+
+
+def test_bb_iou_empty():
+    gt = [[0, 0, 10, 10]]
+    assert maskUtils.bbIou([], gt, [0]) == []
+    assert maskUtils.bbIou([[0, 0, 10, 10]], [], []) == []
+    assert maskUtils.bbIou([], [], []) == []
+    assert maskUtils.bbIou(np.zeros((0, 4)), np.zeros((0, 4)), np.zeros(0)) == []
@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+
+from data.voc0712 import VOC_CLASSES
+from data.voc_eval import voc_eval, voc_eval_all, gt_arrays, load_gt_cache
+
+
+def random_voc(rng, num_images):
+    """VOC annotations and detections: jittered copies of the ground truth
+    (hits and duplicates), random boxes and coarse scores for ties.
+    """
+    names = ['{:06d}'.format(i) for i in range(num_images)]
+    recs = {}
+    for name in names:
+        objs = []
+        for _ in range(rng.randint(0, 8)):
+            x1, y1 = rng.randint(0, 300, 2)
+            w, h = rng.randint(5, 200, 2)
+            objs.append({'name': VOC_CLASSES[rng.randint(1, 21)],
+                         'difficult': int(rng.rand() < 0.15),
+                         'bbox': [x1 + 1, y1 + 1, x1 + w, y1 + h]})
+        recs[name] = objs
+    all_boxes = [[[] for _ in names] for _ in VOC_CLASSES]
+    for i, name in enumerate(names):
+        for j in range(1, len(VOC_CLASSES)):
+            m = rng.randint(0, 6)
+            boxes = rng.uniform(0, 400, (m, 4))
+            boxes[:, 2:] = boxes[:, :2] + rng.uniform(5, 150, (m, 2))
+            for obj in recs[name]:
+                if obj['name'] == VOC_CLASSES[j]:
+                    boxes = np.vstack((boxes, np.array(obj['bbox'], dtype=np.float64) - 1 +
+                                       rng.normal(0, 4, (rng.randint(0, 3), 4))))
+            scores = np.round(rng.uniform(0, 1, (len(boxes), 1)), rng.randint(2, 5))
+            all_boxes[j][i] = np.hstack((boxes, scores)).astype(np.float32)
+    return names, recs, all_boxes
+
+
+def write_voc(root, names, recs, all_boxes):
+    """The xml annotations, image set file and comp4 results files voc_eval
+    reads, written as VOCDetection writes them.
+    """
+    annopath = os.path.join(root, 'Annotations', '{:s}.xml')
+    os.makedirs(os.path.dirname(annopath))
+    for name in names:
+        with open(annopath.format(name), 'w') as f:
+            f.write('<annotation><filename>{:s}.jpg</filename>'.format(name))
+            for obj in recs[name]:
+                f.write('<object><name>{:s}</name><pose>Unspecified</pose>'
+                        '<truncated>0</truncated><difficult>{:d}</difficult><bndbox>'
+                        '<xmin>{:d}</xmin><ymin>{:d}</ymin><xmax>{:d}</xmax><ymax>{:d}</ymax>'
+                        '</bndbox></object>'.format(obj['name'], obj['difficult'],
+                                                    *[int(v) for v in obj['bbox']]))
+            f.write('</annotation>')
+    imagesetfile = os.path.join(root, 'test.txt')
+    with open(imagesetfile, 'w') as f:
+        f.write('\n'.join(names) + '\n')
+    detpath = os.path.join(root, 'comp4_det_test_{:s}.txt')
+    for j, cls in enumerate(VOC_CLASSES[1:], 1):
+        with open(detpath.format(cls), 'w') as f:
+            for i, name in enumerate(names):
+                for d in all_boxes[j][i]:
+                    f.write('{:s} {:.3f} {:.1f} {:.1f} {:.1f} {:.1f}\n'.format(
+                        name, d[-1], d[0] + 1, d[1] + 1, d[2] + 1, d[3] + 1))
+    return annopath, imagesetfile, detpath
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+@pytest.mark.parametrize('use_07_metric', [True, False])
+@pytest.mark.parametrize('ovthresh', [0.5, 0.7])
+def test_voc_eval_all_equals_voc_eval(tmpdir, seed, use_07_metric, ovthresh):
+    root = str(tmpdir)
+    names, recs, all_boxes = random_voc(np.random.RandomState(seed), 60)
+    annopath, imagesetfile, detpath = write_voc(root, names, recs, all_boxes)
+    gt = gt_arrays(load_gt_cache([annopath.format(n) for n in names], root), VOC_CLASSES)
+    results = voc_eval_all(all_boxes, gt, VOC_CLASSES, ovthresh, use_07_metric)
+    for cls in VOC_CLASSES[1:]:
+        rec, prec, ap = voc_eval(detpath, annopath, imagesetfile, cls, root,
+                                 ovthresh, use_07_metric)
+        np.testing.assert_array_equal(results[cls][0], rec)
+        np.testing.assert_array_equal(results[cls][1], prec)
+        assert results[cls][2] == ap
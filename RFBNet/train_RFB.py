@@ -53,6 +53,8 @@ parser.add_argument('--log_iters', default=True,
                     type=bool, help='Print the loss at each iteration')
 parser.add_argument('--save_folder', default='./weights/',
                     help='Location to save checkpoint models')
+parser.add_argument('--check_paths', default='eager', choices=['eager', 'lazy', 'background'],
+                    help='COCO: check image paths at startup, on read only, or in background threads')
 args = parser.parse_args()
 
 
@@ -145,7 +147,7 @@ optimizer = optim.SGD(net.parameters(), lr=args.lr,
 #                      momentum=args.momentum, weight_decay=args.weight_decay)
 
 criterion = MultiBoxLoss(num_classes, 0.5, True, 0, True, 3, 0.5, False)
-priorbox = PriorBox(cfg)
+priorbox = PriorBox(cfg, cache_dir=os.path.join(args.save_folder, 'cache'))
 with torch.no_grad():
     priors = priorbox.forward()
     if args.cuda:
@@ -166,7 +168,7 @@ def train():
             img_dim, rgb_means, p), AnnotationTransform())
     elif args.dataset == 'COCO':
         dataset = COCODetection(COCOroot, train_sets, preproc(
-            img_dim, rgb_means, p))
+            img_dim, rgb_means, p), check_paths=args.check_paths)
     else:
         print('Only VOC and COCO are supported now!')
         return
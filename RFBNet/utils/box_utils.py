@@ -127,6 +127,114 @@ def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx):
     loc_t[idx] = loc    # [num_priors,4] encoded offsets to learn
     conf_t[idx] = conf  # [num_priors] top class label for each prior
 
+
+def pad_targets(targets, pad_box=(0., 0., 1., 1.)):
+    """Stack a list of per-image targets into one padded batch tensor.
+    Args:
+        targets: (list[tensor]) Ground truth for each image, Shape: [num_obj,5]
+            (last idx is the label).
+        pad_box: (tuple) Box written to padded rows, kept non-degenerate so
+            encoding it stays finite.
+    Return:
+        truths: (tensor) Padded boxes, Shape: [batch,max_obj,4].
+        labels: (tensor) Padded labels, Shape: [batch,max_obj].
+        valid: (tensor) Mask of real (non padded) objects, Shape: [batch,max_obj].
+    """
+    num = len(targets)
+    max_obj = max([t.size(0) for t in targets] + [1])
+    ref = targets[0]
+    truths = ref.new(num, max_obj, 4)
+    truths[:] = ref.new(pad_box)
+    labels = ref.new(num, max_obj).zero_()
+    valid = torch.zeros(num, max_obj, dtype=torch.bool, device=ref.device)
+    for idx, t in enumerate(targets):
+        n = t.size(0)
+        truths[idx, :n] = t[:, :-1]
+        labels[idx, :n] = t[:, -1]
+        valid[idx, :n] = 1
+    return truths, labels, valid
+
+
+def jaccard_batch(box_a, box_b):
+    """Batched jaccard().  Broadcasts each coordinate separately instead of
+    expanding [A,B,2] intermediates, with the same arithmetic as jaccard().
+    Args:
+        box_a: (tensor) Ground truth bounding boxes, Shape: [batch,num_objects,4]
+        box_b: (tensor) Prior boxes from priorbox layers, Shape: [num_priors,4]
+    Return:
+        jaccard overlap: (tensor) Shape: [batch,num_objects,num_priors]
+    """
+    # contiguous per-coordinate columns broadcast much faster than strided views
+    ax1, ay1, ax2, ay2 = box_a.unsqueeze(3).unbind(2)
+    bx1, by1, bx2, by2 = box_b.t().contiguous()
+    ax1, ay1, ax2, ay2 = [c.contiguous() for c in (ax1, ay1, ax2, ay2)]
+    inter_w = torch.min(ax2, bx2) - torch.max(ax1, bx1)
+    inter_h = torch.min(ay2, by2) - torch.max(ay1, by1)
+    inter = inter_w.clamp_(min=0) * inter_h.clamp_(min=0)
+    area_a = (ax2-ax1) * (ay2-ay1)
+    area_b = (bx2-bx1) * (by2-by1)
+    union = area_a + area_b - inter
+    return inter.div_(union)
+
+
+def match_batch(threshold, truths, priors, variances, labels, valid,
+                max_elems=1 << 20):
+    """Batched, loop-free version of match().  Produces the targets match()
+    would produce image by image, for the whole batch at once.  Location
+    targets are only encoded for positive priors, the rest are left at zero.
+    Args:
+        threshold: (float) The overlap threshold used when mathing boxes.
+        truths: (tensor) Padded ground truth boxes, Shape: [batch,max_obj,4].
+        priors: (tensor) Prior boxes from priorbox layers, Shape: [n_priors,4].
+        variances: (list[float]) Variances of priorboxes
+        labels: (tensor) Padded class labels, Shape: [batch,max_obj].
+        valid: (tensor) Mask of real objects in truths, Shape: [batch,max_obj].
+        max_elems: (int) Images are matched in groups whose overlap matrix
+            stays below this many elements, to keep it cache resident.
+    Return:
+        loc_t: (tensor) Encoded location targets, Shape: [batch,n_priors,4].
+        conf_t: (tensor) Matched class labels, Shape: [batch,n_priors].
+    """
+    num, num_priors = truths.size(0), priors.size(0)
+    loc_t = truths.new(num, num_priors, 4).zero_()
+    conf_t = torch.zeros(num, num_priors, dtype=torch.long,
+                         device=truths.device)
+    if not valid.any():
+        return loc_t, conf_t
+    # drop trailing columns that are padding in every image
+    num_obj = int(valid.any(0).nonzero().max()) + 1
+    truths, labels, valid = \
+        truths[:, :num_obj], labels[:, :num_obj].long(), valid[:, :num_obj]
+    defaults = point_form(priors)
+    later = torch.ones(num_obj, num_obj, dtype=torch.bool,
+                       device=truths.device).triu(1)
+    step = max(1, max_elems // (num_obj * num_priors))
+    for start in range(0, num, step):
+        chunk = slice(start, start + step)
+        # jaccard index, padded objects can never be the best truth of a prior
+        overlaps = jaccard_batch(truths[chunk], defaults)
+        overlaps.masked_fill_(~valid[chunk].unsqueeze(2), -1)
+        # [chunk,num_objects] best prior for each ground truth
+        best_prior_overlap, best_prior_idx = overlaps.max(2)
+        # [chunk,num_priors] best ground truth for each prior
+        best_truth_overlap, best_truth_idx = overlaps.max(1)
+        # ensure every gt matches with its prior of max overlap; when several
+        # gts share a best prior the last one wins, as in match()
+        same = best_prior_idx.unsqueeze(2) == best_prior_idx.unsqueeze(1)
+        overridden = (same & later & valid[chunk].unsqueeze(1)).any(2)
+        b_idx, j_idx = (valid[chunk] & ~overridden).nonzero().t()
+        p_idx = best_prior_idx[b_idx, j_idx]
+        best_truth_overlap[b_idx, p_idx] = 2
+        best_truth_idx[b_idx, p_idx] = j_idx
+        conf = labels[chunk].gather(1, best_truth_idx)
+        conf[best_truth_overlap < threshold] = 0  # label as background
+        conf_t[chunk] = conf
+        # encode offsets for positive priors only
+        b_idx, p_idx = conf.nonzero().t()
+        matches = truths[chunk][b_idx, best_truth_idx[b_idx, p_idx]]
+        loc_t[b_idx + start, p_idx] = encode(matches, priors[p_idx], variances)
+    return loc_t, conf_t
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
@@ -196,6 +304,31 @@ def decode(loc, priors, variances):
     boxes[:, 2:] += boxes[:, :2]
     return boxes
 
+def decode_batch(loc, priors, variances, out=None):
+    """Batched decode(): decode the location predictions of a whole batch
+    against the same priors in one broadcasted op, with the same arithmetic
+    as decode().
+    Args:
+        loc (tensor): location predictions for loc layers,
+            Shape: [batch,num_priors,4]
+        priors (tensor): Prior boxes in center-offset form.
+            Shape: [num_priors,4].
+        variances: (list[float]) Variances of priorboxes
+        out (tensor, optional): buffer to write the boxes to,
+            Shape: [batch,num_priors,4]
+    Return:
+        decoded bounding box predictions, Shape: [batch,num_priors,4]
+    """
+    if out is None:
+        out = loc.new(loc.size())
+    xy = loc[..., :2] * variances[0] * priors[:, 2:]
+    xy += priors[:, :2]
+    wh = torch.exp(loc[..., 2:] * variances[1])
+    wh *= priors[:, 2:]
+    out[..., :2] = xy.sub_(wh / 2)
+    out[..., 2:] = wh.add_(xy)
+    return out
+
 def decode_multi(loc, priors, offsets, variances):
     """Decode locations from predictions using priors to undo
     the encoding we did for offset regression at train time.
@@ -227,6 +360,25 @@ def log_sum_exp(x):
     return torch.log(torch.sum(torch.exp(x-x_max), 1, keepdim=True)) + x_max
 
 
+def topk_mask(x, k):
+    """Mark the k largest entries of every row without fully sorting it.
+    Replaces ranking with sort(1) + sort(1) for hard negative mining; the
+    selection is the same up to ties.
+    Args:
+        x: (tensor) Scores, Shape: [batch,num_priors].
+        k: (tensor) Number of entries to keep per row, Shape: [batch,1].
+    Return:
+        (tensor) bool mask of selected entries, Shape: [batch,num_priors].
+    """
+    mask = torch.zeros_like(x, dtype=torch.bool)
+    k_max = int(k.max()) if k.numel() else 0
+    if k_max == 0:
+        return mask
+    _, idx = x.topk(k_max, 1)
+    rank = torch.arange(k_max, device=x.device).unsqueeze(0)
+    return mask.scatter_(1, idx, rank < k)
+
+
 # Original author: Francisco Massa:
 # https://github.com/fmassa/object-detection.torch
 # Ported to PyTorch by Max deGroot (02/01/2017)
@@ -297,3 +449,26 @@ def nms(boxes, scores, overlap=0.5, top_k=200):
     return keep, count
 
 
+def select_candidates(scores, thresh=0.01, top_k=None):
+    """Pre-NMS candidate selection for one image, done before anything is
+    copied off the device: scores <= thresh are dropped and, if top_k is
+    given, only the top_k highest scores of each class are kept.
+    Args:
+        scores: (tensor) Class scores, Shape: [num_priors,num_classes].
+            Class 0 is background and is skipped.
+        thresh: (float) Pre-NMS score threshold.
+        top_k: (int) The Maximum number of candidates per class, None for
+            all of them.
+    Return:
+        cls, idx, score: (tensors) Class, prior index and score of every
+            candidate, Shape: [num_candidates].  Grouped by class, priors in
+            ascending order within a class.
+    """
+    cls_scores = scores[:, 1:].t()  # [classes-1,priors]
+    mask = cls_scores > thresh
+    if top_k is not None and top_k < cls_scores.size(1):
+        k = torch.full((cls_scores.size(0), 1), top_k, dtype=torch.long,
+                       device=scores.device)
+        mask &= topk_mask(cls_scores, k)
+    cls, idx = mask.nonzero().t()
+    return cls + 1, idx, cls_scores[cls, idx]
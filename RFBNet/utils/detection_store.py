@@ -0,0 +1,157 @@
+import os
+import numpy as np
+from .file_cache import save_arrays, load_arrays
+
+
+class DetectionStore(object):
+    """Detections of a whole test set in a few flat arrays.
+
+    Rows are sorted by image, then class.  dets holds (x1, y1, x2, y2, score)
+    per row and offsets[i * num_classes + j] is the first row of class j in
+    image i, so the detections of one (image, class) pair, and of one image,
+    are contiguous slices that need no copy.
+
+    Arguments:
+        img (ndarray): image index of every detection, Shape: [N]
+        cls (ndarray): class of every detection, Shape: [N]
+        dets (ndarray): boxes and scores, Shape: [N,5]
+        num_images (int): number of images in the test set
+        num_classes (int): number of classes including background
+    """
+    _arrays = ('img', 'cls', 'dets', 'offsets')
+
+    def __init__(self, img, cls, dets, num_images, num_classes, offsets=None):
+        if offsets is None:
+            key = img.astype(np.int64) * num_classes + cls
+            order = np.argsort(key, kind='mergesort')
+            img, cls, dets, key = img[order], cls[order], dets[order], key[order]
+            offsets = np.searchsorted(key, np.arange(num_images * num_classes + 1))
+        self.img = img
+        self.cls = cls
+        self.dets = dets
+        self.offsets = offsets
+        self.num_images = num_images
+        self.num_classes = num_classes
+
+    def __len__(self):
+        return len(self.dets)
+
+    @classmethod
+    def from_all_boxes(cls, all_boxes):
+        """Build from the nested all_boxes[class][image] lists of [n,5]
+        arrays (empty lists are allowed).
+        """
+        num_classes, num_images = len(all_boxes), len(all_boxes[0])
+        # walk image-major so the rows come out already sorted
+        chunks, counts = [], np.zeros(num_images * num_classes, dtype=np.int64)
+        for i in range(num_images):
+            for j in range(num_classes):
+                d = all_boxes[j][i]
+                if len(d):
+                    chunks.append(d)
+                    counts[i * num_classes + j] = len(d)
+        dets = (np.concatenate(chunks).astype(np.float32, copy=False) if chunks
+                else np.zeros((0, 5), dtype=np.float32))
+        key = np.repeat(np.arange(num_images * num_classes), counts)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        return cls((key // num_classes).astype(np.int32),
+                   (key % num_classes).astype(np.int32),
+                   dets, num_images, num_classes, offsets)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Join stores of consecutive image ranges, e.g. evaluation shards."""
+        num_classes = stores[0].num_classes
+        first_image = np.cumsum([0] + [s.num_images for s in stores])
+        first_row = np.cumsum([0] + [len(s) for s in stores])
+        img = np.concatenate([s.img + start for s, start in zip(stores, first_image)])
+        offsets = np.concatenate([[0]] + [s.offsets[1:] + start
+                                          for s, start in zip(stores, first_row)])
+        return cls(img.astype(np.int32), np.concatenate([s.cls for s in stores]),
+                   np.concatenate([s.dets for s in stores]),
+                   int(first_image[-1]), num_classes, offsets)
+
+    def boxes(self, i, j):
+        """[n,5] detections of class j in image i, a view."""
+        k = i * self.num_classes + j
+        return self.dets[self.offsets[k]:self.offsets[k + 1]]
+
+    def image_offsets(self):
+        """First row of every image, Shape: [num_images+1]."""
+        return self.offsets[::self.num_classes]
+
+    def image(self, i):
+        """(cls, dets) of every detection in image i, views."""
+        start, end = self.offsets[i * self.num_classes], self.offsets[(i + 1) * self.num_classes]
+        return self.cls[start:end], self.dets[start:end]
+
+    def class_dets(self, j):
+        """(img, dets) of every detection of class j, by image."""
+        inds = np.flatnonzero(self.cls == j)
+        return self.img[inds], self.dets[inds]
+
+    def all_boxes(self):
+        """Lazy all_boxes[class][image] view for the existing evaluators."""
+        return _NestedView(self)
+
+    def save(self, path):
+        """Write the arrays as .npy files in directory path."""
+        save_arrays(path, dict((name, getattr(self, name)) for name in self._arrays),
+                    shape=np.array([self.num_images, self.num_classes], dtype=np.int64))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Open a saved store, memory-mapped by default."""
+        arrays = load_arrays(path, cls._arrays + ('shape',), mmap_mode)
+        num_images, num_classes = np.asarray(arrays['shape']).tolist()
+        return cls(arrays['img'], arrays['cls'], arrays['dets'],
+                   num_images, num_classes, arrays['offsets'])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'shape.npy'))
+
+
+def as_store(all_boxes):
+    """all_boxes[class][image] lists or a view of a store as a
+    DetectionStore, copying only when it is not backed by one already.
+    """
+    if isinstance(all_boxes, DetectionStore):
+        return all_boxes
+    if isinstance(all_boxes, _NestedView):
+        return all_boxes.store
+    return DetectionStore.from_all_boxes(all_boxes)
+
+
+class _NestedView(object):
+    """all_boxes[class][image] on top of a DetectionStore."""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.num_classes
+
+    def __getitem__(self, j):
+        return _ClassView(self.store, j)
+
+    def __iter__(self):
+        for j in range(len(self)):
+            yield self[j]
+
+
+class _ClassView(object):
+
+    def __init__(self, store, j):
+        self.store = store
+        self.j = j
+
+    def __len__(self):
+        return self.store.num_images
+
+    def __getitem__(self, i):
+        return self.store.boxes(i, self.j)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,47 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+
+
+def file_key(paths, *extra):
+    """sha1 hex digest of the absolute path, mtime and size of every file of
+    paths, and of the extra values, so a cache named by it is never served
+    for a changed file.
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    key = hashlib.sha1()
+    for f in paths:
+        f = os.path.abspath(os.path.expanduser(f))
+        st = os.stat(f)
+        key.update('{:s}\0{!r}\0{:d}\n'.format(f, st.st_mtime, st.st_size).encode('utf-8'))
+    for value in extra:
+        key.update('{!r}\n'.format(value).encode('utf-8'))
+    return key.hexdigest()
+
+
+def save_arrays(path, arrays, **extra):
+    """Write arrays as .npy files in directory path.  The directory is built
+    under a temporary name and renamed, so it is either complete or absent.
+    """
+    tmp_path = path.rstrip(os.sep) + '.' + str(os.getpid()) + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    arrays = dict(arrays, **extra)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+
+def load_arrays(path, names=None, mmap_mode='r'):
+    """Open the .npy files written by save_arrays, memory-mapped by default.
+    names defaults to every array in path.
+    """
+    if names is None:
+        names = [f[:-len('.npy')] for f in os.listdir(path) if f.endswith('.npy')]
+    return dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+                for name in names)
@@ -7,6 +7,7 @@
 
 import numpy as np
 cimport numpy as np
+cimport cython
 
 cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
     return a if a >= b else b
@@ -14,7 +15,7 @@ cdef inline np.float32_t max(np.float32_t a, np.float32_t b):
 cdef inline np.float32_t min(np.float32_t a, np.float32_t b):
     return a if a <= b else b
 
-def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
+def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, double thresh):
     cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
     cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
     cdef np.ndarray[np.float32_t, ndim=1] x2 = dets[:, 2]
@@ -22,11 +23,11 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
     cdef np.ndarray[np.float32_t, ndim=1] scores = dets[:, 4]
 
     cdef np.ndarray[np.float32_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-    cdef np.ndarray[np.int_t, ndim=1] order = scores.argsort()[::-1]
+    cdef np.ndarray[np.intp_t, ndim=1] order = scores.argsort()[::-1]
 
     cdef int ndets = dets.shape[0]
-    cdef np.ndarray[np.int_t, ndim=1] suppressed = \
-            np.zeros((ndets), dtype=np.int)
+    cdef np.ndarray[np.intp_t, ndim=1] suppressed = \
+            np.zeros((ndets), dtype=np.intp)
 
     # nominal indices
     cdef int _i, _j
@@ -67,6 +68,73 @@ def cpu_nms(np.ndarray[np.float32_t, ndim=2] dets, np.float thresh):
 
     return keep
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cpu_nms_groups(np.ndarray[np.float32_t, ndim=2] dets,
+                   np.ndarray[np.int64_t, ndim=1] offsets, double thresh):
+    """cpu_nms of every group of rows dets[offsets[g]:offsets[g+1]] in one
+    call, e.g. every class of every image.  Boxes are only compared within
+    their group.  Returns the kept rows, group by group, each group's in the
+    order cpu_nms gives them for the group alone.
+    """
+    cdef np.ndarray[np.float32_t, ndim=1] x1 = dets[:, 0]
+    cdef np.ndarray[np.float32_t, ndim=1] y1 = dets[:, 1]
+    cdef np.ndarray[np.float32_t, ndim=1] x2 = dets[:, 2]
+    cdef np.ndarray[np.float32_t, ndim=1] y2 = dets[:, 3]
+    cdef np.ndarray[np.float32_t, ndim=1] scores = dets[:, 4]
+
+    cdef np.ndarray[np.float32_t, ndim=1] areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+    cdef np.ndarray[np.intp_t, ndim=1] order
+
+    cdef int ndets = dets.shape[0]
+    cdef np.ndarray[np.uint8_t, ndim=1] suppressed = \
+            np.zeros((ndets), dtype=np.uint8)
+    cdef np.ndarray[np.intp_t, ndim=1] keep = np.empty((ndets), dtype=np.intp)
+    cdef int nkeep = 0
+
+    cdef int g, start, end
+    cdef int _i, _j
+    cdef int i, j
+    cdef np.float32_t ix1, iy1, ix2, iy2, iarea
+    cdef np.float32_t xx1, yy1, xx2, yy2
+    cdef np.float32_t w, h
+    cdef np.float32_t inter, ovr
+
+    for g in range(offsets.shape[0] - 1):
+        start = offsets[g]
+        end = offsets[g + 1]
+        if end == start:
+            continue
+        # the sort of cpu_nms on the group alone, so ties go the same way
+        order = scores[start:end].argsort()[::-1] + start
+        for _i in range(end - start):
+            i = order[_i]
+            if suppressed[i] == 1:
+                continue
+            keep[nkeep] = i
+            nkeep += 1
+            ix1 = x1[i]
+            iy1 = y1[i]
+            ix2 = x2[i]
+            iy2 = y2[i]
+            iarea = areas[i]
+            for _j in range(_i + 1, end - start):
+                j = order[_j]
+                if suppressed[j] == 1:
+                    continue
+                xx1 = max(ix1, x1[j])
+                yy1 = max(iy1, y1[j])
+                xx2 = min(ix2, x2[j])
+                yy2 = min(iy2, y2[j])
+                w = max(0.0, xx2 - xx1 + 1)
+                h = max(0.0, yy2 - yy1 + 1)
+                inter = w * h
+                ovr = inter / (iarea + areas[j] - inter)
+                if ovr >= thresh:
+                    suppressed[j] = 1
+
+    return keep[:nkeep]
+
 def cpu_soft_nms(np.ndarray[float, ndim=2] boxes, float sigma=0.5, float Nt=0.3, float threshold=0.001, unsigned int method=0):
     cdef unsigned int N = boxes.shape[0]
     cdef float iw, ih, box_area
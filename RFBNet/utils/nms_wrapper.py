@@ -5,8 +5,14 @@
 # Written by Ross Girshick
 # --------------------------------------------------------
 
-from .nms.cpu_nms import cpu_nms, cpu_soft_nms
-from .nms.gpu_nms import gpu_nms
+import numpy as np
+from .nms.cpu_nms import cpu_nms, cpu_nms_groups, cpu_soft_nms
+try:
+    from .nms.gpu_nms import gpu_nms
+except ImportError:
+    # built without cuda (see utils/build.py): only cpu nms works
+    def gpu_nms(dets, thresh, device_id=0):
+        raise ImportError('nms.gpu_nms is not compiled, use cpu nms')
 
 
 # def nms(dets, thresh, force_cpu=False):
@@ -29,3 +35,57 @@ def nms(dets, thresh, force_cpu=False):
         #return cpu_soft_nms(dets, thresh, method = 0)
         return cpu_nms(dets, thresh)
     return gpu_nms(dets, thresh)
+
+
+def nms_groups(dets, offsets, thresh, force_cpu=False):
+    """NMS within every group of rows dets[offsets[g]:offsets[g+1]], e.g.
+    every class of every image, in one call.  Returns the kept rows, group
+    by group, each group's in the order nms gives them.
+    """
+    if force_cpu:
+        return cpu_nms_groups(dets, offsets.astype(np.int64), thresh)
+    keep = [np.asarray(gpu_nms(dets[start:end], thresh), dtype=np.intp) + start
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()) if end > start]
+    return np.concatenate(keep) if keep else np.zeros(0, dtype=np.intp)
+
+
+def batched_nms_candidates(img, cls, dets, num_images, num_classes, thresh,
+                           max_per_image=0, force_cpu=False):
+    """Per-class NMS of the candidates of a batch of images in one
+    nms_groups call, followed by the max_per_image cut of every image.
+    img [n] and cls [n] hold the image and class of every row of dets
+    [n,5], rows grouped by image, then by class.  Returns, per image, a list
+    of [num_dets,5] arrays indexed by class, entry 0 (background) unused.
+    """
+    groups = np.asarray(img, dtype=np.int64) * num_classes + cls
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(
+        groups, minlength=num_images * num_classes))))
+    keep = nms_groups(dets, offsets, thresh, force_cpu=force_cpu)
+    dets = dets[keep, :]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(
+        groups[keep], minlength=num_images * num_classes)))).tolist()
+    all_dets = []
+    for i in range(num_images):
+        dets_per_class = [None] + [dets[offsets[i * num_classes + j]:
+                                        offsets[i * num_classes + j + 1]]
+                                   for j in range(1, num_classes)]
+        if max_per_image > 0:
+            image_scores = np.concatenate([dets_per_class[j][:, -1]
+                                           for j in range(1, num_classes)])
+            if len(image_scores) > max_per_image:
+                image_thresh = np.partition(image_scores, -max_per_image)[-max_per_image]
+                for j in range(1, num_classes):
+                    keep = np.where(dets_per_class[j][:, -1] >= image_thresh)[0]
+                    dets_per_class[j] = dets_per_class[j][keep, :]
+        all_dets.append(dets_per_class)
+    return all_dets
+
+
+def nms_candidates(cls, dets, num_classes, thresh, max_per_image=0, force_cpu=False):
+    """Per-class NMS of one image's candidates followed by the max_per_image
+    cut.  cls [n] holds the class of every row of dets [n,5], rows grouped by
+    class.  Returns a list of [num_dets,5] arrays indexed by class, entry 0
+    (background) unused.
+    """
+    return batched_nms_candidates(np.zeros(len(cls), dtype=np.int64), cls, dets, 1,
+                                  num_classes, thresh, max_per_image, force_cpu)[0]
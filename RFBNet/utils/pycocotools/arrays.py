@@ -0,0 +1,18 @@
+# Array helpers shared by the numpy code paths of coco.py and cocoeval.py.
+
+import numpy as np
+
+def ranges(starts, counts):
+    '''
+    concatenated aranges starts[j]:starts[j]+counts[j]
+    '''
+    ends = np.cumsum(counts)
+    return np.repeat(starts - ends + counts, counts) + np.arange(ends[-1] if len(ends) else 0)
+
+def found(keys, query, pos):
+    '''
+    whether query[j] is keys[pos[j]], pos from np.searchsorted(keys, query)
+    '''
+    if len(keys) == 0:
+        return np.zeros(len(query), dtype=bool)
+    return keys[np.minimum(pos, len(keys)-1)] == query
@@ -19,6 +19,7 @@ __version__ = '2.0'
 
 # The following API functions are defined:
 #  COCO       - COCO api class that loads COCO annotation file and prepare data structures.
+#  COCOArrays - COCO api with the annotations indexed in numpy arrays.
 #  decodeMask - Decode binary mask M encoded via run-length encoding.
 #  encodeMask - Encode binary mask M using run-length encoding.
 #  getAnnIds  - Get ann ids that satisfy given filter conditions.
@@ -30,6 +31,7 @@ __version__ = '2.0'
 #  annToMask  - Convert segmentation in an annotation to binary mask.
 #  showAnns   - Display the specified annotations.
 #  loadRes    - Load algorithm results and create API for accessing them.
+#  loadResArrays - Load bbox results given as arrays, indexed vectorized.
 #  download   - Download COCO images from mscoco.org server.
 # Throughout the API "ann"=annotation, "cat"=category, and "img"=image.
 # Help on each functions can be accessed by: "help COCO>function".
@@ -51,16 +53,20 @@ from matplotlib.collections import PatchCollection
 from matplotlib.patches import Polygon
 import numpy as np
 import copy
+import gc
 import itertools
 from . import mask as maskUtils
 import os
 from collections import defaultdict
+from .arrays import ranges, found
 import sys
 PYTHON_VERSION = sys.version_info[0]
 if PYTHON_VERSION == 2:
     from urllib import urlretrieve
+    from collections import Mapping
 elif PYTHON_VERSION == 3:
     from urllib.request import urlretrieve
+    from collections.abc import Mapping
 
 class COCO:
     def __init__(self, annotation_file=None):
@@ -300,10 +306,11 @@ class COCO:
 
         print('Loading and preparing results...')
         tic = time.time()
-        if type(resFile) == str or type(resFile) == unicode:
+        if type(resFile) == str or (PYTHON_VERSION == 2 and type(resFile) == unicode):
             anns = json.load(open(resFile))
         elif type(resFile) == np.ndarray:
-            anns = self.loadNumpyAnnotations(resFile)
+            assert(resFile.shape[1] == 7)
+            return self.loadResArrays(resFile[:, 0], resFile[:, 1:5], resFile[:, 5], resFile[:, 6])
         else:
             anns = resFile
         assert type(anns) == list, 'results in not an array of objects'
@@ -350,6 +357,65 @@ class COCO:
         res.createIndex()
         return res
 
+    def loadResArrays(self, imgIds, bboxes, scores, catIds):
+        """
+        Load bbox results given as arrays and return a result api object, as
+        loadRes on the same results but without a dict walk to fill them in:
+        area and ids are computed vectorized, no polygon segmentation is made
+        from the boxes and the indexes are built from the results sorted by
+        image and by category.
+        :param   imgIds (int array)   : image id of every result [N]
+                 bboxes (float array) : x,y,w,h of every result [Nx4]
+                 scores (float array) : score of every result [N]
+                 catIds (int array)   : category id of every result [N]
+        :return: res (obj)            : result api object
+        """
+        res = COCO()
+        res.dataset['images'] = [img for img in self.dataset['images']]
+        res.dataset['categories'] = copy.deepcopy(self.dataset['categories'])
+
+        print('Loading and preparing results...')
+        tic = time.time()
+        imgIds = np.asarray(imgIds).astype(np.int64)
+        catIds = np.asarray(catIds).astype(np.int64)
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        assert np.all(np.isin(imgIds, list(self.getImgIds()))), \
+               'Results do not correspond to current coco set'
+        ids = np.arange(1, len(imgIds)+1)
+        # the cyclic gc would rescan the new dicts many times over: off while
+        # they are built, none of them can be part of a cycle
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            anns = [{'image_id': imgId, 'category_id': catId, 'bbox': bb, 'score': score,
+                     'area': area, 'id': id, 'iscrowd': 0}
+                    for imgId, catId, bb, score, area, id in zip(
+                        imgIds.tolist(), catIds.tolist(), bboxes.tolist(),
+                        np.asarray(scores, dtype=np.float64).tolist(),
+                        (bboxes[:, 2]*bboxes[:, 3]).tolist(), ids.tolist())]
+        finally:
+            if gcEnabled:
+                gc.enable()
+        print('DONE (t={:0.2f}s)'.format(time.time()- tic))
+
+        res.dataset['annotations'] = anns
+        print('creating index...')
+        res.anns = dict(zip(ids.tolist(), anns))
+        res.imgs = dict((img['id'], img) for img in res.dataset['images'])
+        res.cats = dict((cat['id'], cat) for cat in res.dataset['categories'])
+        # stable sorts keep the results of every image and category in order
+        order = np.argsort(imgIds, kind='mergesort')
+        keys, starts = np.unique(imgIds[order], return_index=True)
+        byImage = [anns[n] for n in order.tolist()]
+        res.imgToAnns = defaultdict(list, zip(keys.tolist(), [byImage[a:b] for a, b in
+                                    zip(starts.tolist(), starts[1:].tolist() + [len(anns)])]))
+        order = np.argsort(catIds, kind='mergesort')
+        keys, starts = np.unique(catIds[order], return_index=True)
+        res.catToImgs = defaultdict(list, zip(keys.tolist(), [l.tolist() for l in
+                                    np.split(imgIds[order], starts[1:])]))
+        print('index created!')
+        return res
+
     def download(self, tarDir = None, imgIds = [] ):
         '''
         Download COCO images from mscoco.org server.
@@ -384,18 +450,14 @@ class COCO:
         assert(type(data) == np.ndarray)
         print(data.shape)
         assert(data.shape[1] == 7)
-        N = data.shape[0]
-        ann = []
-        for i in range(N):
-            if i % 1000000 == 0:
-                print('{}/{}'.format(i,N))
-            ann += [{
-                'image_id'  : int(data[i, 0]),
-                'bbox'  : [ data[i, 1], data[i, 2], data[i, 3], data[i, 4] ],
-                'score' : data[i, 5],
-                'category_id': int(data[i, 6]),
-                }]
-        return ann
+        return [{
+                'image_id'  : imgId,
+                'bbox'  : bb,
+                'score' : score,
+                'category_id': catId,
+                } for imgId, bb, score, catId in zip(data[:, 0].astype(np.int64).tolist(),
+                                                     data[:, 1:5].tolist(), data[:, 5].tolist(),
+                                                     data[:, 6].astype(np.int64).tolist())]
 
     def annToRLE(self, ann):
         """
@@ -425,4 +487,367 @@ class COCO:
         """
         rle = self.annToRLE(ann)
         m = maskUtils.decode(rle)
-        return m
\ No newline at end of file
+        return m
+
+class COCOArrays(COCO):
+    """
+    COCO api with the annotations in numpy arrays instead of one dict each.
+    Rows are in file order; the rows of every image (category) are
+    imgRows[imgOffsets[n]:imgOffsets[n+1]] for the n-th id of imgKeys
+    (catKeys), so id queries are searchsorted lookups and masks.  The
+    annotation dicts returned by loadAnns, anns, imgToAnns and catToImgs are
+    built on access, with the fields id, image_id, category_id, bbox, area,
+    iscrowd and the keepFields (e.g. segmentation, off by default).  A query
+    of one image (getAnnIds(imgIds=id) then loadAnns) builds the ids and
+    dicts of every image once and then shares them, as COCO does.  The
+    annotations are dropped from self.dataset once indexed.
+    toArrays/fromArrays turn the whole api into flat arrays and back, e.g.
+    to keep it in memory-mapped files instead of parsing the json again.
+    """
+    _fields = (('id', np.int64), ('image_id', np.int64), ('category_id', np.int64),
+               ('area', np.float64), ('iscrowd', np.int64))
+
+    def __init__(self, annotation_file=None, keepFields=()):
+        """
+        :param annotation_file (str): location of annotation file
+        :param keepFields (str array): other annotation fields to keep
+        :return:
+        """
+        self.dataset, self.cats, self.imgs = dict(), dict(), dict()
+        self.keepFields = list(keepFields)
+        if not annotation_file == None:
+            print('loading annotations into memory...')
+            tic = time.time()
+            dataset = json.load(open(annotation_file, 'r'))
+            assert type(dataset)==dict, 'annotation file format {} not supported'.format(type(dataset))
+            print('Done (t={:0.2f}s)'.format(time.time()- tic))
+            self.dataset = dataset
+        self.createIndex()
+
+    def createIndex(self):
+        print('creating index...')
+        anns = self.dataset.pop('annotations', [])
+        self.columns = dict((name, np.array([ann[name] for ann in anns], dtype=dtype))
+                            for name, dtype in self._fields)
+        self.columns['bbox'] = np.array([ann['bbox'] for ann in anns],
+                                        dtype=np.float64).reshape(-1, 4)
+        self.extra = dict((name, [ann.get(name) for ann in anns]) for name in self.keepFields)
+        self._indexColumns()
+        self.imgs = dict((img['id'], img) for img in self.dataset.get('images', []))
+        self.cats = dict((cat['id'], cat) for cat in self.dataset.get('categories', []))
+        print('index created!')
+
+    def _indexColumns(self):
+        '''
+        CSR row index per image and per category and the sorted ann ids
+        '''
+        c = self.columns
+        self.imgKeys, self.imgRows, self.imgOffsets = _csr(c['image_id'])
+        self.catKeys, self.catRows, self.catOffsets = _csr(c['category_id'])
+        self.annOrder = np.argsort(c['id'], kind='mergesort')
+        self.annKeys = c['id'][self.annOrder]
+        self._indexViews()
+
+    def _indexViews(self):
+        c = self.columns
+        self.anns = _ArrayIndex(c['id'], self.annKeys, self._loadAnn)
+        self.imgToAnns = _ArrayIndex(self.imgKeys, self.imgKeys, self._imgAnns)
+        self.catToImgs = _ArrayIndex(self.catKeys, self.catKeys, self._catImgs)
+        # img id -> (ann ids, ann dicts), built on the first single image query
+        self._imgLists = None
+        # ids getAnnIds returned last and their rows, for loadAnns of the same ids
+        self._lastAnns = (None, None)
+
+    _indexArrays = ('imgKeys', 'imgRows', 'imgOffsets', 'catKeys', 'catRows', 'catOffsets',
+                    'annOrder', 'annKeys')
+
+    def toArrays(self):
+        '''
+        The api as a dict of numpy arrays fromArrays rebuilds it from: the
+        annotation columns and index, the images as one column per field
+        (strings and other values in json string tables) and the rest of
+        the dataset (categories, info, ...) as json.
+        :return: arrays (dict)
+        '''
+        arrays = dict(('ann_' + name, column) for name, column in self.columns.items())
+        arrays.update((name, getattr(self, name)) for name in self._indexArrays)
+        for name in self.keepFields:
+            arrays['extra_' + name], arrays['extra_' + name + '_offsets'] = _stringTable(
+                [json.dumps(value) for value in self.extra[name]])
+        images = self.dataset.get('images', [])
+        imageFields = []
+        for name in [name for img in images[:1] for name in img] + sorted(
+                set(name for img in images for name in img) - set(images[0] if images else [])):
+            values = [img.get(name) for img in images]
+            if all(type(v) == int for v in values):
+                kind, arrays['img_' + name] = 'int', np.array(values, dtype=np.int64)
+            elif all(type(v) in (int, float) for v in values):
+                kind, arrays['img_' + name] = 'float', np.array(values, dtype=np.float64)
+            else:
+                # '' for an image without the field
+                kind = 'json'
+                arrays['img_' + name], arrays['img_' + name + '_offsets'] = _stringTable(
+                    ['' if not name in img else json.dumps(img[name]) for img in images])
+            imageFields.append([name, kind])
+        meta = {'dataset': dict((k, v) for k, v in self.dataset.items() if k != 'images'),
+                'numImages': len(images), 'imageFields': imageFields,
+                'keepFields': self.keepFields}
+        arrays['meta'] = np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)
+        return arrays
+
+    @classmethod
+    def fromArrays(cls, arrays):
+        '''
+        Rebuild the api from toArrays, keeping the arrays given (e.g.
+        memory-mapped) for the annotations and their index
+        :param arrays (dict): arrays from toArrays
+        :return: coco (obj)
+        '''
+        print('loading annotations from arrays...')
+        tic = time.time()
+        self = cls.__new__(cls)
+        meta = json.loads(bytes(arrays['meta']).decode('utf-8'))
+        self.keepFields = meta['keepFields']
+        self.columns = dict((name[len('ann_'):], array) for name, array in arrays.items()
+                            if name.startswith('ann_'))
+        for name in self._indexArrays:
+            setattr(self, name, arrays[name])
+        self.extra = dict((name, _Strings(arrays['extra_' + name],
+                                          arrays['extra_' + name + '_offsets']))
+                          for name in self.keepFields)
+        names, columns, missing = [], [], False
+        for name, kind in meta['imageFields']:
+            names.append(name)
+            if kind == 'json':
+                column = _Strings(arrays['img_' + name], arrays['img_' + name + '_offsets']).tolist()
+                missing |= _MISSING in column
+                columns.append(column)
+            else:
+                columns.append(np.asarray(arrays['img_' + name]).tolist())
+        images = [dict(zip(names, values)) for values in zip(*columns)]
+        if not names:
+            images = [dict() for _ in range(meta['numImages'])]
+        if missing:
+            images = [dict((k, v) for k, v in img.items() if not v is _MISSING) for img in images]
+        self.dataset = meta['dataset']
+        self.dataset['images'] = images
+        self._indexViews()
+        self.imgs = dict((img['id'], img) for img in images)
+        self.cats = dict((cat['id'], cat) for cat in self.dataset.get('categories', []))
+        print('Done (t={:0.2f}s)'.format(time.time()- tic))
+        return self
+
+    def _rows(self, keys, rows, offsets, query):
+        '''
+        rows of every id of query found in keys, in query order
+        '''
+        query = np.asarray(query, dtype=np.int64).ravel()
+        if len(query) == 1:
+            # one id, e.g. an image: a slice
+            n = np.searchsorted(keys, query[0])
+            if n < len(keys) and keys[n] == query[0]:
+                return rows[offsets[n]:offsets[n+1]]
+            return rows[:0]
+        pos = np.searchsorted(keys, query)
+        pos = pos[found(keys, query, pos)]
+        return rows[ranges(offsets[pos], offsets[pos+1] - offsets[pos])]
+
+    def getAnnRows(self, imgIds):
+        '''
+        Rows into self.columns of the anns of every image of imgIds, in file
+        order: the anns of imgIds[n] are rows[offsets[n]:offsets[n+1]]
+        :param imgIds (int array) : img ids, images without anns allowed
+        :return: rows (int array), offsets (int array) [len(imgIds)+1]
+        '''
+        imgIds = np.asarray(imgIds, dtype=np.int64).ravel()
+        pos = np.searchsorted(self.imgKeys, imgIds)
+        hit = found(self.imgKeys, imgIds, pos)
+        # imgOffsets has one more entry than imgKeys: pos is always valid
+        starts = self.imgOffsets[pos]
+        counts = np.where(hit, self.imgOffsets[np.minimum(pos+1, len(self.imgKeys))] - starts, 0)
+        rows = self.imgRows[ranges(starts, counts)]
+        return rows, np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    def getAnnIds(self, imgIds=[], catIds=[], areaRng=[], iscrowd=None):
+        """
+        Get ann ids that satisfy given filter conditions. default skips that filter
+        :param imgIds  (int array)     : get anns for given imgs
+               catIds  (int array)     : get anns for given cats
+               areaRng (float array)   : get anns for given area range (e.g. [0 inf])
+               iscrowd (boolean)       : get anns for given crowd label (False or True)
+        :return: ids (int array)       : integer array of ann ids
+        """
+        imgIds = imgIds if type(imgIds) == list else [imgIds]
+        catIds = catIds if type(catIds) == list else [catIds]
+        c = self.columns
+
+        if len(imgIds) == 1 and len(catIds) == len(areaRng) == 0 and iscrowd == None:
+            # one image, e.g. in a loop over the images: a dict lookup, no numpy
+            ids, anns = self._imgList(imgIds[0])
+            self._lastAnns = (ids, anns)
+            # a copy: the caller may change the list it gets
+            return list(ids)
+        if len(imgIds) == 0:
+            rows = np.arange(len(c['id']))
+        else:
+            rows = self._rows(self.imgKeys, self.imgRows, self.imgOffsets, imgIds)
+        if not len(catIds) == 0:
+            rows = rows[np.isin(c['category_id'][rows], catIds)]
+        if not len(areaRng) == 0:
+            area = c['area'][rows]
+            rows = rows[(area > areaRng[0]) & (area < areaRng[1])]
+        if not iscrowd == None:
+            rows = rows[c['iscrowd'][rows] == iscrowd]
+        ids = c['id'][rows].tolist()
+        # a copy: the caller may change the list it gets
+        self._lastAnns = (list(ids), rows)
+        return ids
+
+    def _imgList(self, imgId):
+        '''
+        ann ids and dicts of imgId, ([], []) if it has none; the dicts of
+        every image are built on the first call, in one pass
+        '''
+        if self._imgLists is None:
+            rows = np.asarray(self.imgRows)
+            ids, anns = self.columns['id'][rows].tolist(), self._annDicts(rows)
+            offsets = np.asarray(self.imgOffsets).tolist()
+            self._imgLists = dict((imgId, (ids[a:b], anns[a:b])) for imgId, a, b in
+                                  zip(np.asarray(self.imgKeys).tolist(), offsets[:-1], offsets[1:]))
+        return self._imgLists.get(imgId, ([], []))
+
+    def getImgIds(self, imgIds=[], catIds=[]):
+        '''
+        Get img ids that satisfy given filter conditions.
+        :param imgIds (int array) : get imgs for given ids
+        :param catIds (int array) : get imgs with all given cats
+        :return: ids (int array)  : integer array of img ids
+        '''
+        imgIds = imgIds if type(imgIds) == list else [imgIds]
+        catIds = catIds if type(catIds) == list else [catIds]
+
+        if len(imgIds) == len(catIds) == 0:
+            ids = self.imgs.keys()
+        else:
+            ids = set(imgIds)
+            for i, catId in enumerate(catIds):
+                catImgs = set(np.unique(self.columns['image_id'][self._rows(
+                    self.catKeys, self.catRows, self.catOffsets, catId)]).tolist())
+                if i == 0 and len(ids) == 0:
+                    ids = catImgs
+                else:
+                    ids &= catImgs
+        return list(ids)
+
+    def loadAnns(self, ids=[]):
+        """
+        Load anns with the specified ids, as new dicts, or the shared dicts
+        of the image if ids are those getAnnIds returned for one image.
+        :param ids (int array)       : integer ids specifying anns
+        :return: anns (object array) : loaded ann objects
+        """
+        if type(ids) == list:
+            lastIds, rows = self._lastAnns
+            if not ids == lastIds:
+                rows = self._annRows(ids)
+            elif type(rows) == list:
+                # the dicts of one image
+                return list(rows)
+            return self._annDicts(rows)
+        elif isinstance(ids, (int, np.integer)):
+            return self._annDicts(self._annRows([ids]))
+
+    def _annRows(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.searchsorted(self.annKeys, ids)
+        hit = found(self.annKeys, ids, pos)
+        if not np.all(hit):
+            raise KeyError(ids[~hit][0].item())
+        return self.annOrder[pos]
+
+    def _annDicts(self, rows):
+        names = [name for name, _ in self._fields] + ['bbox']
+        columns = [self.columns[name][rows].tolist() for name in names]
+        columns += [[self.extra[name][r] for r in rows.tolist()] for name in self.keepFields]
+        names += self.keepFields
+        return [dict(zip(names, values)) for values in zip(*columns)]
+
+    def _loadAnn(self, id):
+        return self.loadAnns(id)[0]
+
+    def _imgAnns(self, imgId):
+        return self._annDicts(self._rows(self.imgKeys, self.imgRows, self.imgOffsets, imgId))
+
+    def _catImgs(self, catId):
+        return self.columns['image_id'][self._rows(
+            self.catKeys, self.catRows, self.catOffsets, catId)].tolist()
+
+
+def _csr(keys):
+    '''
+    unique keys, rows sorted by key (stable) and the offsets of every key
+    '''
+    unique, inverse = np.unique(keys, return_inverse=True)
+    rows = np.argsort(inverse, kind='mergesort')
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(inverse, minlength=len(unique)))))
+    return unique, rows, offsets.astype(np.int64)
+
+
+def _stringTable(strings):
+    '''
+    utf-8 bytes of strings concatenated [uint8] and their offsets [N+1]
+    '''
+    data = [string.encode('utf-8') for string in strings]
+    offsets = np.concatenate(([0], np.cumsum([len(d) for d in data]))).astype(np.int64)
+    return np.frombuffer(b''.join(data), dtype=np.uint8), offsets
+
+
+# an empty string in a json string table: no value
+_MISSING = object()
+
+
+class _Strings(object):
+    '''
+    json values of a string table, decoded on access
+    '''
+    def __init__(self, data, offsets):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, n):
+        string = bytes(self._data[self._offsets[n]:self._offsets[n+1]]).decode('utf-8')
+        return json.loads(string) if string else _MISSING
+
+    def tolist(self):
+        data, offsets = bytes(self._data), np.asarray(self._offsets).tolist()
+        return [json.loads(data[a:b].decode('utf-8')) if b > a else _MISSING
+                for a, b in zip(offsets[:-1], offsets[1:])]
+
+
+class _ArrayIndex(Mapping):
+    '''
+    read-only dict over COCOArrays: keys in the given order, values from get
+    '''
+    def __init__(self, keys, sortedKeys, get):
+        self._keys = keys
+        self._sortedKeys = sortedKeys
+        self._get = get
+
+    def __getitem__(self, key):
+        # np.int64 ids too, as the dicts of COCO find them
+        if not isinstance(key, (int, np.integer)):
+            raise KeyError(key)
+        key = int(key)
+        query = np.array([key])
+        if not found(self._sortedKeys, query, np.searchsorted(self._sortedKeys, query))[0]:
+            raise KeyError(key)
+        return self._get(key)
+
+    def __iter__(self):
+        return iter(self._keys.tolist())
+
+    def __len__(self):
+        return len(self._keys)
\ No newline at end of file
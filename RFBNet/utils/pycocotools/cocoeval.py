@@ -3,8 +3,10 @@ __author__ = 'tsungyi'
 import numpy as np
 import datetime
 import time
+import multiprocessing
 from collections import defaultdict
 from . import mask as maskUtils
+from .arrays import ranges
 import copy
 
 class COCOeval:
@@ -29,11 +31,14 @@ class COCOeval:
     #  iouType    - ['segm'] set iouType to 'segm', 'bbox' or 'keypoints'
     #  iouType replaced the now DEPRECATED useSegm parameter.
     #  useCats    - [1] if true use category labels for evaluation
+    #  fastMatch  - [1] if true use vectorized matching in evaluateImg
+    #  fastAccumulate - [1] if true use vectorized precision in accumulate
     # Note: if useCats=0 category labels are ignored as in proposal scoring.
     # Note: multiple areaRngs [Ax2] and maxDets [Mx1] can be specified.
     #
     # evaluate(): evaluates detections on every image and every category and
-    # concats the results into the "evalImgs" with fields:
+    # concats the results into the "evalImgs" (an EvalImgs, array backed and
+    # indexed like a list of dicts) with fields:
     #  dtIds      - [1xD] id for each of the D detections (dt)
     #  gtIds      - [1xG] id for each of the G ground truths (gt)
     #  dtMatches  - [TxD] matching gt id at each IoU or 0
@@ -51,6 +56,9 @@ class COCOeval:
     #  recall     - [TxKxAxM] max recall for every evaluation setting
     # Note: precision and recall==-1 for settings with no gt objects.
     #
+    # COCOevalStream (below) builds evalImgs one image of bbox detections at a
+    # time, for running AP/AR during inference without a results file.
+    #
     # See also coco, mask, pycocoDemo, pycocoEvalDemo
     #
     # Microsoft COCO Toolbox.      version 2.0
@@ -119,9 +127,12 @@ class COCOeval:
         self.evalImgs = defaultdict(list)   # per-image per-category evaluation results
         self.eval     = {}                  # accumulated evaluation results
 
-    def evaluate(self):
+    def evaluate(self, processes=1):
         '''
         Run per image evaluation on given images and store results (a list of dict) in self.evalImgs
+        :param processes: pool size for bbox evaluation over chunks of images,
+                          from arrays with fastMatch, None for the cpu count,
+                          1 to evaluate in this process
         :return: None
         '''
         tic = time.time()
@@ -139,28 +150,65 @@ class COCOeval:
         self.params=p
 
         self._prepare()
-        # loop through images, area range, max detection number
-        catIds = p.catIds if p.useCats else [-1]
+        # segm and keypoints need the full annotations and the workers only
+        # match with fastMatch: else always serial
+        if processes != 1 and p.iouType == 'bbox' and p.fastMatch:
+            self._evaluateParallel(processes)
+        else:
+            # loop through images, area range, max detection number
+            catIds = p.catIds if p.useCats else [-1]
 
-        if p.iouType == 'segm' or p.iouType == 'bbox':
-            computeIoU = self.computeIoU
-        elif p.iouType == 'keypoints':
-            computeIoU = self.computeOks
-        self.ious = {(imgId, catId): computeIoU(imgId, catId) \
-                        for imgId in p.imgIds
-                        for catId in catIds}
+            if p.iouType == 'segm' or p.iouType == 'bbox':
+                computeIoU = self.computeIoU
+            elif p.iouType == 'keypoints':
+                computeIoU = self.computeOks
+            self.ious = {(imgId, catId): computeIoU(imgId, catId) \
+                            for imgId in p.imgIds
+                            for catId in catIds}
 
-        evaluateImg = self.evaluateImg
-        maxDet = p.maxDets[-1]
-        self.evalImgs = [evaluateImg(imgId, catId, areaRng, maxDet)
-                 for catId in catIds
-                 for areaRng in p.areaRng
-                 for imgId in p.imgIds
-             ]
+            evaluateImg = self.evaluateImg
+            maxDet = p.maxDets[-1]
+            self.evalImgs = EvalImgs.fromDicts((evaluateImg(imgId, catId, areaRng, maxDet)
+                     for catId in catIds
+                     for areaRng in p.areaRng
+                     for imgId in p.imgIds
+                 ), catIds, p.areaRng, p.imgIds, maxDet, len(p.iouThrs))
         self._paramsEval = copy.deepcopy(self.params)
         toc = time.time()
         print('DONE (t={:0.2f}s).'.format(toc-tic))
 
+    def _evaluateParallel(self, processes):
+        '''
+        evaluate() in a process pool: the gts and dts go to the workers once,
+        as arrays, through the pool initializer; every worker evaluates
+        chunks of images from the arrays (_evaluateArrays) and the chunks are
+        merged in the order of the serial evaluation
+        '''
+        p = self.params
+        gt = _annArrays([g for anns in self._gts.values() for g in anns], _GT_FIELDS)
+        dt = _annArrays([d for anns in self._dts.values() for d in anns], _DT_FIELDS)
+        # a few chunks per process so uneven images balance out
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        bounds = np.linspace(0, len(p.imgIds), min(4*processes, len(p.imgIds))+1).astype(int)
+        tasks = [(start, end) for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist())]
+        pool = multiprocessing.Pool(processes, _initWorker, (p, gt, dt))
+        try:
+            results = pool.map(_evaluateChunk, tasks)
+        finally:
+            pool.close()
+            pool.join()
+        self.ious = {}
+        for ious, _ in results:
+            self.ious.update(ious)
+        # evalImgs are [KxAxI] in that order: interleave the chunks
+        catIds = p.catIds if p.useCats else [-1]
+        pieces = []
+        for ka in range(len(catIds)*len(p.areaRng)):
+            for (_, evalImgs), (start, end) in zip(results, tasks):
+                pieces.append(evalImgs._piece(ka*(end-start), (ka+1)*(end-start)))
+        self.evalImgs = EvalImgs._join(pieces, catIds, p.areaRng, p.imgIds, p.maxDets[-1])
+
     def computeIoU(self, imgId, catId):
         p = self.params
         if p.useCats:
@@ -187,6 +235,9 @@ class COCOeval:
 
         # compute iou between each dt and gt region
         iscrowd = [int(o['iscrowd']) for o in gt]
+        if p.iouType == 'bbox':
+            # boxes need no compiled extension
+            return maskUtils.bbIou(d,g,iscrowd)
         ious = maskUtils.iou(d,g,iscrowd)
         return ious
 
@@ -270,7 +321,10 @@ class COCOeval:
         dtm  = np.zeros((T,D))
         gtIg = np.array([g['_ignore'] for g in gt])
         dtIg = np.zeros((T,D))
-        if not len(ious)==0:
+        if not len(ious)==0 and p.fastMatch:
+            gtm, dtm, dtIg = self._matchImg(ious[0:D], gtIg, iscrowd,
+                                            [g['id'] for g in gt], [d['id'] for d in dt])
+        elif not len(ious)==0:
             for tind, t in enumerate(p.iouThrs):
                 for dind, d in enumerate(dt):
                     # information about best match so far (m=-1 -> unmatched)
@@ -313,6 +367,82 @@ class COCOeval:
                 'dtIgnore':     dtIg,
             }
 
+    def _matchImg(self, ious, gtIg, iscrowd, gtIds, dtIds):
+        '''
+        greedy matching of evaluateImg at every IoU threshold at once
+        :param ious: [DxG] ious of the dts (score order) and gts (ignore last)
+        :return: gtm [TxG], dtm [TxD] and dtIg [TxD] as the reference loop
+        '''
+        thrs = np.minimum(self.params.iouThrs, 1-1e-10)
+        gtIg = np.broadcast_to(np.asarray(gtIg), (len(thrs), ious.shape[1]))
+        return self._match(ious, thrs, gtIg, iscrowd, gtIds, dtIds)
+
+    @classmethod
+    def _match(cls, ious, thrs, gtIg, iscrowd, gtIds, dtIds):
+        '''
+        _matchImg with a row of gt ignore flags per threshold, e.g. the
+        thresholds of every area range in one call.  The gts need not be
+        ignore last: the match only depends on which gts are ignored.
+        :param thrs: [T] thresholds, gtIg: [TxG] ignore flags
+        :return: gtm [TxG], dtm [TxD] and dtIg [TxD] as the reference loop
+        '''
+        T = len(thrs)
+        D, G = ious.shape
+        gtm  = np.zeros((T,G))
+        dtm  = np.zeros((T,D))
+        dtIg = np.zeros((T,D))
+        if ious.max() < thrs.min():
+            return gtm, dtm, dtIg
+        gtIds = np.asarray(gtIds)
+        dtIds = np.asarray(dtIds)
+        crowd = np.array(iscrowd, dtype=bool)
+        regular = gtIg == 0
+        # [TxDxG] gts above each threshold for each dt
+        above = ious >= thrs[:, None, None]
+        # a non-crowd gt above threshold for more than one dt is contested and
+        # its dts are matched in score order; every other dt only ever sees
+        # unmatched or crowd gts and is matched independently
+        claims = above.any(axis=0)
+        claims[:, crowd] = False
+        serial = claims[:, claims.sum(axis=0) > 1].any(axis=1)
+        # gt index each dt matches at each threshold, -1 for none
+        match = np.full((T,D), -1)
+        free = np.flatnonzero(~serial)
+        m, hit = cls._bestGt(above[:, free], ious[free], regular[:, None])
+        match[:, free] = np.where(hit, m, -1)
+        if serial.any():
+            taken = np.zeros((T,G), dtype=bool)
+            t, d = (match >= 0).nonzero()
+            taken[t, match[t, d]] = dtIds[d] > 0
+            for dind in serial.nonzero()[0]:
+                # if a gt is already matched, and not a crowd, skip it
+                m, hit = cls._bestGt(above[:, dind] & (~taken | crowd), ious[dind], regular)
+                match[:, dind] = np.where(hit, m, -1)
+                taken[hit, m[hit]] |= dtIds[dind] > 0
+        t, d = (match >= 0).nonzero()
+        m = match[t, d]
+        dtIg[t, d] = gtIg[t, m]
+        dtm[t, d]  = gtIds[m]
+        # a gt keeps the id of the last dt matched to it (crowds match many)
+        last = np.full((T,G), -1)
+        np.maximum.at(last, (t, m), d)
+        t, g = (last >= 0).nonzero()
+        gtm[t, g] = dtIds[last[t, g]]
+        return gtm, dtm, dtIg
+
+    @staticmethod
+    def _bestGt(cand, ious, regular):
+        '''
+        gt each dt matches among its candidates cand [...xG]: ignored gts only
+        if no regular gt is a candidate, and the last of equal best ious, like
+        the running max of the reference loop
+        :return: gt index and whether there was a candidate, both [...]
+        '''
+        hasReg = (cand & regular).any(axis=-1, keepdims=True)
+        cand = cand & (regular == hasReg)
+        scores = np.where(cand, ious, -np.inf)[..., ::-1]
+        return cand.shape[-1]-1 - scores.argmax(axis=-1), cand.any(axis=-1)
+
     def accumulate(self, p = None):
         '''
         Accumulate per image evaluation results and store the result in self.eval
@@ -355,27 +485,39 @@ class COCOeval:
             for a, a0 in enumerate(a_list):
                 Na = a0*I0
                 for m, maxDet in enumerate(m_list):
-                    E = [self.evalImgs[Nk + Na + i] for i in i_list]
-                    E = [e for e in E if not e is None]
-                    if len(E) == 0:
-                        continue
-                    dtScores = np.concatenate([e['dtScores'][0:maxDet] for e in E])
+                    if isinstance(self.evalImgs, EvalImgs):
+                        E = self.evalImgs.gather(Nk + Na + np.array(i_list, dtype=np.int64), maxDet)
+                        if E is None:
+                            continue
+                        dtScores, dtm, dtIg, gtIg = E
+                    else:
+                        E = [self.evalImgs[Nk + Na + i] for i in i_list]
+                        E = [e for e in E if not e is None]
+                        if len(E) == 0:
+                            continue
+                        dtScores = np.concatenate([e['dtScores'][0:maxDet] for e in E])
+                        dtm  = np.concatenate([e['dtMatches'][:,0:maxDet] for e in E], axis=1)
+                        dtIg = np.concatenate([e['dtIgnore'][:,0:maxDet]  for e in E], axis=1)
+                        gtIg = np.concatenate([e['gtIgnore'] for e in E])
 
                     # different sorting method generates slightly different results.
                     # mergesort is used to be consistent as Matlab implementation.
                     inds = np.argsort(-dtScores, kind='mergesort')
 
-                    dtm  = np.concatenate([e['dtMatches'][:,0:maxDet] for e in E], axis=1)[:,inds]
-                    dtIg = np.concatenate([e['dtIgnore'][:,0:maxDet]  for e in E], axis=1)[:,inds]
-                    gtIg = np.concatenate([e['gtIgnore'] for e in E])
+                    dtm  = dtm[:,inds]
+                    dtIg = dtIg[:,inds]
                     npig = np.count_nonzero(gtIg==0 )
                     if npig == 0:
                         continue
                     tps = np.logical_and(               dtm,  np.logical_not(dtIg) )
                     fps = np.logical_and(np.logical_not(dtm), np.logical_not(dtIg) )
 
-                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float)
-                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float)
+                    tp_sum = np.cumsum(tps, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(fps, axis=1).astype(dtype=float)
+                    if p.fastAccumulate:
+                        precision[:,:,k,a,m], recall[:,k,a,m] = \
+                            self._prRecall(tp_sum, fp_sum, npig, p.recThrs)
+                        continue
                     for t, (tp, fp) in enumerate(zip(tp_sum, fp_sum)):
                         tp = np.array(tp)
                         fp = np.array(fp)
@@ -414,6 +556,38 @@ class COCOeval:
         toc = time.time()
         print('DONE (t={:0.2f}s).'.format( toc-tic))
 
+    @staticmethod
+    def _prRecall(tp_sum, fp_sum, npig, recThrs):
+        '''
+        precision at the recall thresholds and max recall of one setting, for
+        all IoU thresholds at once, as the loop of accumulate
+        :param tp_sum, fp_sum: [TxD] cumulative tps and fps in score order
+        :return: precision [TxR] and recall [T]
+        '''
+        T, nd = tp_sum.shape
+        q = np.zeros((T, len(recThrs)))
+        if nd == 0:
+            return q, np.zeros(T)
+        rc = tp_sum / npig
+        pr = tp_sum / (fp_sum+tp_sum+np.spacing(1))
+        # monotone precision envelope: reverse cumulative max
+        pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+        # rc is an integer count tp over npig, so rc < recThr exactly when tp
+        # is below the first count that reaches recThr; counts of row t are
+        # offset by t*step to search every row in one sorted array
+        maxTp = int(tp_sum[:, -1].max())
+        first = np.searchsorted(np.arange(maxTp+1) / npig, recThrs, side='left')
+        step = maxTp + 2
+        offset = np.arange(T)[:, None] * step
+        inds = np.searchsorted((tp_sum.astype(np.int64) + offset).ravel(),
+                               (first + offset).ravel(), side='left').reshape(T, -1)
+        inds -= np.arange(T)[:, None] * nd
+        # recall thresholds beyond the max recall keep precision 0
+        valid = inds < nd
+        t = np.nonzero(valid)[0]
+        q[valid] = pr[t, inds[valid]]
+        return q, rc[:, -1]
+
     def summarize(self):
         '''
         Compute and display summary metrics for evaluation results.
@@ -490,6 +664,371 @@ class COCOeval:
     def __str__(self):
         self.summarize()
 
+class EvalImgs:
+    '''
+    Results of evaluate() in flat arrays instead of a list of dicts.
+
+    The dt and gt fields of every evalImgs entry are concatenated in entry
+    order: the dts of entry n are columns dtOffsets[n]:dtOffsets[n+1] of
+    dtIds, dtScores, dtMatches [TxND] and dtIgnore [TxND], its gts columns
+    gtOffsets[n]:gtOffsets[n+1] of gtIds, gtMatches [TxNG] and gtIgnore.
+    Entries are indexed by (category, area range, image) as the list was,
+    n = k*A*I + a*I + i, and an entry without dts and gts is None.
+    Indexing or iterating gives the dicts of the list, built on access.
+    '''
+    _dtFields = (('dtIds', np.int64), ('dtScores', np.float64),
+                 ('dtMatches', np.float64), ('dtIgnore', bool))
+    _gtFields = (('gtIds', np.int64), ('gtMatches', np.float64), ('gtIgnore', np.int64))
+    _matrices = ('dtMatches', 'dtIgnore', 'gtMatches')
+
+    def __init__(self, catIds, areaRng, imgIds, maxDet, dtOffsets, gtOffsets, arrays):
+        self.catIds = list(catIds)
+        self.areaRng = list(areaRng)
+        self.imgIds = list(imgIds)
+        self.maxDet = maxDet
+        self.dtOffsets = dtOffsets
+        self.gtOffsets = gtOffsets
+        for name, array in arrays.items():
+            setattr(self, name, array)
+
+    @classmethod
+    def fromDicts(cls, evalImgs, catIds, areaRng, imgIds, maxDet, T, blockSize=10000):
+        '''
+        pack evalImgs dicts (or None) given in [KxAxI] order, from any
+        iterable, a block at a time so the dicts never all exist at once
+        '''
+        pieces, block = [], []
+        for e in evalImgs:
+            block.append(e)
+            if len(block) == blockSize:
+                pieces.append(cls._pack(block, T))
+                block = []
+        pieces.append(cls._pack(block, T))
+        return cls._join(pieces, catIds, areaRng, imgIds, maxDet)
+
+    @classmethod
+    def _pack(cls, evalImgs, T):
+        '''
+        dt counts, gt counts and concatenated fields of a list of dicts
+        '''
+        dtCounts = np.array([0 if e is None else len(e['dtIds']) for e in evalImgs], dtype=np.int64)
+        gtCounts = np.array([0 if e is None else len(e['gtIds']) for e in evalImgs], dtype=np.int64)
+        E = [e for e in evalImgs if not e is None]
+        arrays = {}
+        for name, dtype in cls._dtFields + cls._gtFields:
+            shape = (T, -1) if name in cls._matrices else (-1,)
+            arrays[name] = np.concatenate([np.zeros(shape[:-1] + (0,), dtype=dtype)] +
+                                          [np.asarray(e[name], dtype=dtype).reshape(shape)
+                                           for e in E], axis=-1)
+        return dtCounts, gtCounts, arrays
+
+    def _piece(self, start, end):
+        '''
+        dt counts, gt counts and fields of entries start:end, as _pack
+        '''
+        d0, d1 = self.dtOffsets[start], self.dtOffsets[end]
+        g0, g1 = self.gtOffsets[start], self.gtOffsets[end]
+        arrays = dict((name, getattr(self, name)[..., d0:d1]) for name, _ in self._dtFields)
+        arrays.update((name, getattr(self, name)[..., g0:g1]) for name, _ in self._gtFields)
+        return (np.diff(self.dtOffsets[start:end+1]), np.diff(self.gtOffsets[start:end+1]),
+                arrays)
+
+    @classmethod
+    def _join(cls, pieces, catIds, areaRng, imgIds, maxDet):
+        '''
+        EvalImgs of consecutive pieces from _pack or _piece
+        '''
+        dtOffsets = np.concatenate([[0]] + [np.cumsum(np.concatenate([p[0] for p in pieces]))])
+        gtOffsets = np.concatenate([[0]] + [np.cumsum(np.concatenate([p[1] for p in pieces]))])
+        arrays = dict((name, np.concatenate([p[2][name] for p in pieces], axis=-1))
+                      for name, _ in cls._dtFields + cls._gtFields)
+        return cls(catIds, areaRng, imgIds, maxDet, dtOffsets.astype(np.int64),
+                   gtOffsets.astype(np.int64), arrays)
+
+    def _take(self, entries):
+        '''
+        dt counts, gt counts and fields of the given entries in that order, as _pack
+        '''
+        nDt = self.dtOffsets[entries+1] - self.dtOffsets[entries]
+        nGt = self.gtOffsets[entries+1] - self.gtOffsets[entries]
+        dtRows = ranges(self.dtOffsets[entries], nDt)
+        gtRows = ranges(self.gtOffsets[entries], nGt)
+        arrays = dict((name, getattr(self, name)[..., dtRows]) for name, _ in self._dtFields)
+        arrays.update((name, getattr(self, name)[..., gtRows]) for name, _ in self._gtFields)
+        return nDt, nGt, arrays
+
+    def gather(self, entries, maxDet):
+        '''
+        what accumulate concatenates for a setting: the first maxDet dts and
+        all gts of entries, or None if every entry is None
+        :return: dtScores [D], dtMatches [TxD], dtIgnore [TxD], gtIgnore [G]
+        '''
+        nDt = self.dtOffsets[entries+1] - self.dtOffsets[entries]
+        nGt = self.gtOffsets[entries+1] - self.gtOffsets[entries]
+        if not np.any(nDt + nGt):
+            return None
+        dtRows = ranges(self.dtOffsets[entries], np.minimum(nDt, maxDet))
+        gtRows = ranges(self.gtOffsets[entries], nGt)
+        return (self.dtScores[dtRows], self.dtMatches[:, dtRows], self.dtIgnore[:, dtRows],
+                self.gtIgnore[gtRows])
+
+    def __len__(self):
+        return len(self.dtOffsets) - 1
+
+    def __getitem__(self, n):
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError('evalImgs index out of range')
+        d0, d1 = self.dtOffsets[n], self.dtOffsets[n+1]
+        g0, g1 = self.gtOffsets[n], self.gtOffsets[n+1]
+        if d0 == d1 and g0 == g1:
+            return None
+        I, A = len(self.imgIds), len(self.areaRng)
+        return {
+                'image_id':     self.imgIds[n % I],
+                'category_id':  self.catIds[n // (A*I)],
+                'aRng':         self.areaRng[n // I % A],
+                'maxDet':       self.maxDet,
+                'dtIds':        self.dtIds[d0:d1].tolist(),
+                'gtIds':        self.gtIds[g0:g1].tolist(),
+                'dtMatches':    self.dtMatches[:, d0:d1],
+                'gtMatches':    self.gtMatches[:, g0:g1],
+                'dtScores':     self.dtScores[d0:d1].tolist(),
+                'gtIgnore':     self.gtIgnore[g0:g1],
+                'dtIgnore':     self.dtIgnore[:, d0:d1],
+            }
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+
+# annotation fields a bbox evaluation uses, shipped to workers as arrays
+_GT_FIELDS = (('image_id', np.int64), ('category_id', np.int64), ('id', np.int64),
+              ('bbox', np.float64), ('area', np.float64), ('iscrowd', np.int64),
+              ('ignore', np.int64))
+_DT_FIELDS = (('image_id', np.int64), ('category_id', np.int64), ('id', np.int64),
+              ('bbox', np.float64), ('area', np.float64), ('score', np.float64))
+
+
+def _annArrays(anns, fields):
+    '''
+    annotation dicts as one array per field, sorted by image and category id
+    (stable, so the order of the annotations of every image and category is
+    kept)
+    '''
+    arrays = dict((name, np.array([ann[name] for ann in anns], dtype=dtype))
+                  for name, dtype in fields)
+    arrays['bbox'] = arrays['bbox'].reshape(-1, 4)
+    order = np.lexsort((arrays['category_id'], arrays['image_id']))
+    return dict((name, array[order]) for name, array in arrays.items())
+
+
+def _chunk(arrays, imgIds):
+    '''
+    rows of the sorted arrays of images imgIds[0] to imgIds[-1]
+    '''
+    start = np.searchsorted(arrays['image_id'], imgIds[0], side='left')
+    end = np.searchsorted(arrays['image_id'], imgIds[-1], side='right')
+    return dict((name, array[start:end]) for name, array in arrays.items())
+
+
+# params, gt and dt arrays of _evaluateParallel, in a pool worker
+_shared = {}
+
+
+def _initWorker(p, gt, dt):
+    _shared.update(p=p, gt=gt, dt=dt)
+
+
+def _evaluateChunk(bounds):
+    '''
+    ious and evalImgs of the images p.imgIds[start:end], in a pool worker
+    '''
+    start, end = bounds
+    p = _shared['p']
+    imgIds = p.imgIds[start:end]
+    return _evaluateArrays(p, imgIds, _chunk(_shared['gt'], imgIds),
+                           _chunk(_shared['dt'], imgIds))
+
+
+def _pairOffsets(arrays, imgIds, catIds, useCats):
+    '''
+    rows of the (image, category) pairs of the sorted arrays: the rows of
+    imgIds[i] and catIds[k] are offsets[i*K+k]:offsets[i*K+k+1], as
+    computeIoU and evaluateImg gather them (all of catIds for useCats=0)
+    '''
+    rows = np.flatnonzero(np.isin(arrays['category_id'], catIds))
+    img = np.searchsorted(imgIds, arrays['image_id'][rows])
+    if useCats:
+        key = img*len(catIds) + np.searchsorted(catIds, arrays['category_id'][rows])
+        pairs = len(imgIds)*len(catIds)
+    else:
+        key, pairs = img, len(imgIds)
+    return rows, np.searchsorted(key, np.arange(pairs+1))
+
+
+def _evaluateArrays(p, imgIds, gt, dt):
+    '''
+    computeIoU and evaluateImg of every image of imgIds (sorted) and category
+    from the gt and dt arrays of _annArrays, without annotation dicts; the
+    area ranges of a pair are matched in one call
+    :return: ious (dict) and evalImgs of imgIds, as the serial evaluation
+    '''
+    catIds = p.catIds if p.useCats else [-1]
+    K, A, I, T = len(catIds), len(p.areaRng), len(imgIds), len(p.iouThrs)
+    maxDet = p.maxDets[-1]
+    imgIds = np.asarray(imgIds, dtype=np.int64)
+    gtRows, gtOffsets = _pairOffsets(gt, imgIds, np.asarray(p.catIds), p.useCats)
+    dtRows, dtOffsets = _pairOffsets(dt, imgIds, np.asarray(p.catIds), p.useCats)
+    thrs = np.tile(np.minimum(p.iouThrs, 1-1e-10), A)
+    lo, hi = np.array(p.areaRng, dtype=np.float64).T
+    ious, entries = {}, [None]*(K*A*I)
+    for i, imgId in enumerate(imgIds.tolist()):
+        for k, catId in enumerate(catIds):
+            g = gtRows[gtOffsets[i*K+k]:gtOffsets[i*K+k+1]]
+            d = dtRows[dtOffsets[i*K+k]:dtOffsets[i*K+k+1]]
+            if len(g) == 0 and len(d) == 0:
+                ious[imgId, catId] = []
+                continue
+            d = d[np.argsort(-dt['score'][d], kind='mergesort')[:maxDet]]
+            iscrowd = gt['iscrowd'][g]
+            ious[imgId, catId] = iou = maskUtils.bbIou(dt['bbox'][d], gt['bbox'][g], iscrowd)
+            gtIds, dtIds = gt['id'][g], dt['id'][d]
+            # [AxG] and [AxD] outside of every area range, gt ignore as evaluateImg
+            gtArea, dtArea = gt['area'][g], dt['area'][d]
+            gtIg = ((gt['ignore'][g] != 0) | (gtArea < lo[:, None]) |
+                    (gtArea > hi[:, None])).astype(np.int64)
+            dtOut = (dtArea < lo[:, None]) | (dtArea > hi[:, None])
+            if len(iou) > 0:
+                gtm, dtm, dtIg = COCOeval._match(iou, thrs, np.repeat(gtIg, T, axis=0),
+                                                 iscrowd, gtIds, dtIds)
+            else:
+                gtm, dtm, dtIg = np.zeros((A*T, len(g))), np.zeros((A*T, len(d))), np.zeros((A*T, len(d)))
+            dtIg = np.logical_or(dtIg, np.logical_and(dtm == 0, np.repeat(dtOut, T, axis=0)))
+            dtScores = dt['score'][d]
+            for a in range(A):
+                gtind = np.argsort(gtIg[a], kind='mergesort')
+                rows = slice(a*T, (a+1)*T)
+                entries[k*A*I + a*I + i] = (dtIds, dtScores, dtm[rows], dtIg[rows],
+                                            gtIds[gtind], gtm[rows][:, gtind], gtIg[a][gtind])
+    dtCounts = np.array([0 if e is None else len(e[0]) for e in entries], dtype=np.int64)
+    gtCounts = np.array([0 if e is None else len(e[4]) for e in entries], dtype=np.int64)
+    E = [e for e in entries if not e is None]
+    arrays = {}
+    for n, (name, dtype) in enumerate(EvalImgs._dtFields + EvalImgs._gtFields):
+        empty = np.zeros((T, 0) if name in EvalImgs._matrices else (0,), dtype=dtype)
+        arrays[name] = np.concatenate([empty] + [e[n].astype(dtype, copy=False) for e in E],
+                                      axis=-1)
+    return ious, EvalImgs._join([(dtCounts, gtCounts, arrays)], catIds, p.areaRng,
+                                imgIds.tolist(), maxDet)
+
+
+class COCOevalStream(COCOeval):
+    '''
+    COCOeval fed one image of bbox detections at a time, e.g. while a network
+    runs over the test set.  The gts are indexed once; every added image is
+    matched right away and only its compact evalImgs records are kept, so
+    evaluate() + accumulate() give the running AP/AR of the images added so
+    far.  Once every image is added (or with allImages=1) the results equal
+    COCOeval on the same detections loaded with loadRes.
+    Usage:
+     E = COCOevalStream(cocoGt)
+     E.addImage(imgId, catIds, bboxes, scores)   # [N], [Nx4] x,y,w,h, [N]
+     E.evaluate(); E.accumulate(); E.summarize()
+    '''
+    def __init__(self, cocoGt, iouType='bbox'):
+        if iouType != 'bbox':
+            raise Exception('only bbox detections can be streamed')
+        COCOeval.__init__(self, cocoGt, None, iouType)
+        p = self.params
+        p.imgIds = list(np.unique(p.imgIds))
+        p.catIds = list(np.unique(p.catIds))
+        self._imgIds = list(p.imgIds)
+        self._imgIndex = dict((imgId, n) for n, imgId in enumerate(self._imgIds))
+        # gts with their ignore flags, as _prepare
+        gts = cocoGt.loadAnns(cocoGt.getAnnIds(imgIds=p.imgIds))
+        for gt in gts:
+            gt['ignore'] = 'iscrowd' in gt and gt['iscrowd']
+            self._gts[gt['image_id'], gt['category_id']].append(gt)
+        self._records = {}                  # image index -> packed [KxA] evalImgs
+        self._nextId = 1                    # dt ids, as loadRes numbers them
+
+    def addImage(self, imgId, catIds, bboxes, scores):
+        '''
+        Match the detections of one image and keep their evalImgs records
+        :param imgId (int): image id, every image is added at most once
+        :param catIds (int array): category id of every detection [N]
+        :param bboxes (float array): x,y,w,h of every detection [Nx4]
+        :param scores (float array): score of every detection [N]
+        :return: None
+        '''
+        if not imgId in self._imgIndex:
+            raise Exception('image {} is not in the ground truth'.format(imgId))
+        n = self._imgIndex[imgId]
+        if n in self._records:
+            raise Exception('image {} was already added'.format(imgId))
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        for catId, bb, score in zip(np.asarray(catIds).tolist(), bboxes.tolist(),
+                                    np.asarray(scores, dtype=np.float64).tolist()):
+            self._dts[imgId, catId].append({
+                'image_id': imgId, 'category_id': catId, 'bbox': bb, 'score': score,
+                'area': bb[2]*bb[3], 'id': self._nextId, 'iscrowd': 0})
+            self._nextId += 1
+        self._records[n] = self._evaluateImage(imgId)
+
+    def _evaluateImage(self, imgId):
+        '''
+        packed evalImgs of one image for every category and area range, then
+        drop its dts and ious
+        '''
+        p = self.params
+        catIds = p.catIds if p.useCats else [-1]
+        for catId in catIds:
+            self.ious[imgId, catId] = self.computeIoU(imgId, catId)
+        record = EvalImgs._pack([self.evaluateImg(imgId, catId, areaRng, p.maxDets[-1])
+                                 for catId in catIds
+                                 for areaRng in p.areaRng], len(p.iouThrs))
+        for catId in catIds:
+            del self.ious[imgId, catId]
+        for key in [key for key in self._dts if key[0] == imgId]:
+            del self._dts[key]
+        return record
+
+    def evaluate(self, allImages=0):
+        '''
+        Build self.evalImgs from the records of the added images
+        :param allImages: if true also evaluate the images not added yet, as
+                          images without detections
+        :return: None
+        '''
+        tic = time.time()
+        print('Running per image evaluation...')
+        p = self.params
+        p.maxDets = sorted(p.maxDets)
+        records = dict(self._records)
+        if allImages:
+            for n, imgId in enumerate(self._imgIds):
+                if not n in records:
+                    records[n] = self._evaluateImage(imgId)
+        order = sorted(records)
+        # accumulate reads the images of p.imgIds: only the evaluated ones
+        p.imgIds = [self._imgIds[n] for n in order]
+        catIds = p.catIds if p.useCats else [-1]
+        maxDet = p.maxDets[-1]
+        KA, I = len(catIds)*len(p.areaRng), len(order)
+        byImage = EvalImgs._join([records[n] for n in order] or [EvalImgs._pack([], len(p.iouThrs))],
+                                 catIds, p.areaRng, p.imgIds, maxDet)
+        # records are [IxKxA], evalImgs [KxAxI]
+        entries = (np.arange(I)[None, :]*KA + np.arange(KA)[:, None]).ravel()
+        self.evalImgs = EvalImgs._join([byImage._take(entries)], catIds, p.areaRng,
+                                       p.imgIds, maxDet)
+        self._paramsEval = copy.deepcopy(p)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+
 class Params:
     '''
     Params for coco evaluation api
@@ -498,8 +1037,8 @@ class Params:
         self.imgIds = []
         self.catIds = []
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [1, 10, 100]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [0 ** 2, 32 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'small', 'medium', 'large']
@@ -509,8 +1048,8 @@ class Params:
         self.imgIds = []
         self.catIds = []
         # np.arange causes trouble.  the data point on arange is slightly larger than the true value
-        self.iouThrs = np.linspace(.5, 0.95, np.round((0.95 - .5) / .05) + 1, endpoint=True)
-        self.recThrs = np.linspace(.0, 1.00, np.round((1.00 - .0) / .01) + 1, endpoint=True)
+        self.iouThrs = np.linspace(.5, 0.95, int(np.round((0.95 - .5) / .05)) + 1, endpoint=True)
+        self.recThrs = np.linspace(.0, 1.00, int(np.round((1.00 - .0) / .01)) + 1, endpoint=True)
         self.maxDets = [20]
         self.areaRng = [[0 ** 2, 1e5 ** 2], [32 ** 2, 96 ** 2], [96 ** 2, 1e5 ** 2]]
         self.areaRngLbl = ['all', 'medium', 'large']
@@ -525,4 +1064,8 @@ class Params:
             raise Exception('iouType not supported')
         self.iouType = iouType
         # useSegm is deprecated
-        self.useSegm = None
\ No newline at end of file
+        self.useSegm = None
+        # match all IoU thresholds at once in evaluateImg, 0 for the reference loop
+        self.fastMatch = 1
+        # vectorized precision envelopes in accumulate, 0 for the reference loop
+        self.fastAccumulate = 1
\ No newline at end of file
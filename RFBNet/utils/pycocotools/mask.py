@@ -1,7 +1,13 @@
 __author__ = 'tsungyi'
 
+import numpy as np
 #import pycocotools._mask as _mask
-from . import _mask
+try:
+    from . import _mask
+except (ImportError, ValueError):
+    # not compiled (see utils/build.py), or built against another numpy:
+    # boxes still work through bbIou
+    _mask = None
 
 # Interface for manipulating masks stored in RLE format.
 #
@@ -33,6 +39,7 @@ from . import _mask
 #  decode         - Decode binary masks encoded via RLE.
 #  merge          - Compute union or intersection of encoded masks.
 #  iou            - Compute intersection over union between masks.
+#  bbIou          - Compute intersection over union between boxes (NumPy only).
 #  area           - Compute area of encoded masks.
 #  toBbox         - Get bounding boxes surrounding encoded masks.
 #  frPyObjects    - Convert polygon, bbox, and uncompressed RLE to encoded RLE mask.
@@ -42,6 +49,7 @@ from . import _mask
 #  masks  = decode( Rs )
 #  R      = merge( Rs, intersect=false )
 #  o      = iou( dt, gt, iscrowd )
+#  o      = bbIou( dt, gt, iscrowd )
 #  a      = area( Rs )
 #  bbs    = toBbox( Rs )
 #  Rs     = frPyObjects( [pyObjects], h, w )
@@ -74,31 +82,71 @@ from . import _mask
 # Code written by Piotr Dollar and Tsung-Yi Lin, 2015.
 # Licensed under the Simplified BSD License [see coco/license.txt]
 
-iou         = _mask.iou
-merge       = _mask.merge
-frPyObjects = _mask.frPyObjects
+def _compiled(name):
+    '''
+    _mask.<name>, or a function raising an ImportError that says to build
+    the extension if it is not available
+    '''
+    if _mask is not None:
+        return getattr(_mask, name)
+    def fn(*args, **kwargs):
+        raise ImportError('pycocotools._mask is not compiled, {} needs it '
+                          '(run ./make.sh)'.format(name))
+    fn.__name__ = name
+    return fn
+
+iou         = _compiled('iou')
+merge       = _compiled('merge')
+frPyObjects = _compiled('frPyObjects')
+_encode     = _compiled('encode')
+_decode     = _compiled('decode')
+_area       = _compiled('area')
+_toBbox     = _compiled('toBbox')
+
+def bbIou(dt, gt, iscrowd):
+    '''
+    iou of bounding boxes [x y w h] as iou() computes it (bbIou of maskApi.c,
+    same operations), without the compiled extension
+    :param dt, gt: [mx4] and [nx4] boxes, arrays or lists
+    :param iscrowd: [n] crowd flags of the gts, iou over the dt area for crowds
+    :return: [mxn] ious, or [] if there are no dts or no gts
+    '''
+    dt = np.asarray(dt, dtype=np.double).reshape(-1, 4)
+    gt = np.asarray(gt, dtype=np.double).reshape(-1, 4)
+    if len(dt) == 0 or len(gt) == 0:
+        return []
+    D, G = dt[:, None, :], gt[None, :, :]
+    w = np.fmin(D[..., 2]+D[..., 0], G[..., 2]+G[..., 0]) - np.fmax(D[..., 0], G[..., 0])
+    h = np.fmin(D[..., 3]+D[..., 1], G[..., 3]+G[..., 1]) - np.fmax(D[..., 1], G[..., 1])
+    i = w*h
+    da = D[..., 2]*D[..., 3]
+    u = np.where(np.array(iscrowd, dtype=bool), da, da+G[..., 2]*G[..., 3]-i)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        o = i/u
+    # no overlap is 0, not a negative or nan ratio
+    return np.where((w <= 0) | (h <= 0), 0., o)
 
 def encode(bimask):
     if len(bimask.shape) == 3:
-        return _mask.encode(bimask)
+        return _encode(bimask)
     elif len(bimask.shape) == 2:
         h, w = bimask.shape
-        return _mask.encode(bimask.reshape((h, w, 1), order='F'))[0]
+        return _encode(bimask.reshape((h, w, 1), order='F'))[0]
 
 def decode(rleObjs):
     if type(rleObjs) == list:
-        return _mask.decode(rleObjs)
+        return _decode(rleObjs)
     else:
-        return _mask.decode([rleObjs])[:,:,0]
+        return _decode([rleObjs])[:,:,0]
 
 def area(rleObjs):
     if type(rleObjs) == list:
-        return _mask.area(rleObjs)
+        return _area(rleObjs)
     else:
-        return _mask.area([rleObjs])[0]
+        return _area([rleObjs])[0]
 
 def toBbox(rleObjs):
     if type(rleObjs) == list:
-        return _mask.toBbox(rleObjs)
+        return _toBbox(rleObjs)
     else:
-        return _mask.toBbox([rleObjs])[0]
+        return _toBbox([rleObjs])[0]
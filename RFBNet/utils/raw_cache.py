@@ -0,0 +1,123 @@
+import os
+import numpy as np
+import torch
+from .box_utils import select_candidates
+from .file_cache import save_arrays, load_arrays
+
+
+class RawOutputCache(object):
+    """Decoded boxes and class scores of a whole test set, as produced by
+    Detect and scaled to image pixels, so post-processing can be rerun
+    without the network.
+
+    Only (prior, class) scores above floor are kept, which is what makes the
+    cache small: the dense [num_priors,num_classes] scores are almost all
+    near zero.  Post-processing with any score threshold >= floor sees
+    exactly the candidates the full pipeline sees.  Every candidate row
+    points into boxes, which holds each prior's box once per image.
+
+    Arguments:
+        boxes (ndarray): boxes of the priors with a candidate, Shape: [M,4]
+        cand_box (ndarray): row of boxes of every candidate, Shape: [K]
+        cand_cls (ndarray): class of every candidate, Shape: [K]
+        cand_score (ndarray): score of every candidate, Shape: [K]
+        offsets (ndarray): first candidate of every image, Shape: [num_images+1]
+        num_classes (int): number of classes including background
+        floor (float): scores <= floor were dropped
+    """
+    _arrays = ('boxes', 'cand_box', 'cand_cls', 'cand_score', 'offsets')
+
+    def __init__(self, boxes, cand_box, cand_cls, cand_score, offsets, num_classes, floor):
+        self.boxes = boxes
+        self.cand_box = cand_box
+        self.cand_cls = cand_cls
+        self.cand_score = cand_score
+        self.offsets = offsets
+        self.num_classes = num_classes
+        self.floor = floor
+
+    @property
+    def num_images(self):
+        return len(self.offsets) - 1
+
+    def candidates(self, i, thresh=None, top_k=None):
+        """(cls, dets) of image i with score > thresh and, if top_k is given,
+        among the top_k scores of their class, grouped by class and in prior
+        order within a class, like select_candidates.  Ties at the top_k-th
+        score go to the lower prior.
+        """
+        start, end = self.offsets[i], self.offsets[i + 1]
+        cls, score = self.cand_cls[start:end], self.cand_score[start:end]
+        rows = self.cand_box[start:end]
+        if thresh is not None:
+            if thresh < self.floor:
+                raise ValueError('Cache was pruned at {}, cannot use thresh {}'.format(
+                    self.floor, thresh))
+            keep = score > thresh
+            cls, score, rows = cls[keep], score[keep], rows[keep]
+        if top_k is not None:
+            # rank of every score within its class
+            order = np.lexsort((-score, cls))
+            rank = np.empty(len(order), dtype=np.int64)
+            rank[order] = np.arange(len(order)) - np.searchsorted(cls[order], cls[order])
+            keep = rank < top_k
+            cls, score, rows = cls[keep], score[keep], rows[keep]
+        dets = np.empty((len(rows), 5), dtype=np.float32)
+        dets[:, :4] = self.boxes[rows]
+        dets[:, 4] = score
+        return cls, dets
+
+    @classmethod
+    def concatenate(cls, caches):
+        """Join caches of consecutive image ranges, e.g. evaluation shards."""
+        first_box = np.cumsum([0] + [len(c.boxes) for c in caches])
+        first_cand = np.cumsum([0] + [len(c.cand_box) for c in caches])
+        offsets = np.concatenate([[0]] + [c.offsets[1:] + start
+                                          for c, start in zip(caches, first_cand)])
+        return cls(np.concatenate([c.boxes for c in caches]),
+                   np.concatenate([c.cand_box + start for c, start in zip(caches, first_box)]),
+                   np.concatenate([c.cand_cls for c in caches]),
+                   np.concatenate([c.cand_score for c in caches]),
+                   offsets, caches[0].num_classes, caches[0].floor)
+
+    def save(self, path):
+        save_arrays(path, dict((name, getattr(self, name)) for name in self._arrays),
+                    meta=np.array([self.num_classes, self.floor], dtype=np.float64))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Open a saved cache, memory-mapped by default."""
+        arrays = load_arrays(path, cls._arrays + ('meta',), mmap_mode)
+        num_classes, floor = np.asarray(arrays['meta']).tolist()
+        return cls(*[arrays[name] for name in cls._arrays],
+                   num_classes=int(num_classes), floor=floor)
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, 'meta.npy'))
+
+
+class RawCacheWriter(object):
+    """Collects one RawOutputCache image by image, in any order."""
+
+    def __init__(self, num_images, num_classes, floor=0.01):
+        self.num_classes = num_classes
+        self.floor = floor
+        self.images = [None] * num_images
+
+    def add(self, i, boxes, scores):
+        """boxes [num_priors,4] in pixels, scores [num_priors,num_classes]."""
+        cls, idx, score = select_candidates(scores, self.floor)
+        priors, rows = torch.unique(idx, sorted=True, return_inverse=True)
+        self.images[i] = (boxes[priors].cpu().numpy(), rows.cpu().numpy().astype(np.int32),
+                          cls.cpu().numpy().astype(np.int16), score.cpu().numpy())
+
+    def close(self):
+        counts = [len(image[1]) for image in self.images]
+        first_box = np.cumsum([0] + [len(image[0]) for image in self.images])
+        return RawOutputCache(
+            np.concatenate([image[0] for image in self.images]).reshape(-1, 4),
+            np.concatenate([image[1] + start for image, start in zip(self.images, first_box)]),
+            np.concatenate([image[2] for image in self.images]),
+            np.concatenate([image[3] for image in self.images]),
+            np.concatenate(([0], np.cumsum(counts))), self.num_classes, self.floor)
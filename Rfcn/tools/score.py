@@ -1,9 +1,17 @@
+import os
+import shutil
+import argparse
+import hashlib
+import multiprocessing
 import numpy as np
 import xml.etree.ElementTree as ET
 
 gt_root = '~/Database/VOC_PASCAL/VOC2007_test/Annotations/'
 val_file = '~/2007test.txt'
 det_root = '~/predict_ss/'
+# parsed annotations are cached here, in the format of RFBNet's
+# data/voc_eval.py load_gt_cache, so both can share one directory
+cache_dir = '~/Database/VOC_PASCAL/annotations_cache/'
 
 _classes = ('__background__',  # always index 0
             'aeroplane', 'bicycle', 'bird', 'boat',
@@ -64,16 +72,97 @@ def voc_ap(rec, prec, use_07_metric=False):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
-def voc_eval(filename, classname, ovthresh=0.5, use_07_metric=False):
-
+def file_key(paths):
+    """sha1 hex digest of the absolute path, mtime and size of every file,
+    the key of RFBNet's utils/file_cache.py."""
+    key = hashlib.sha1()
+    for f in paths:
+        f = os.path.abspath(os.path.expanduser(f))
+        st = os.stat(f)
+        key.update('{:s}\0{!r}\0{:d}\n'.format(f, st.st_mtime, st.st_size).encode('utf-8'))
+    return key.hexdigest()
+
+def save_arrays(path, arrays):
+    """arrays as .npy files in directory path, built under a temporary name
+    and renamed, so it is either complete or absent."""
+    tmp_path = path.rstrip(os.sep) + '.' + str(os.getpid()) + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    os.makedirs(tmp_path)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), array)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp_path, path)
+
+def load_arrays(path):
+    """Every array save_arrays wrote to path."""
+    return dict((f[:-len('.npy')], np.load(os.path.join(path, f)))
+                for f in os.listdir(path) if f.endswith('.npy'))
+
+def load_gt_cache(annofiles, cachedir, processes=None):
+    """Parsed annotation files as contiguous arrays, cached in cachedir
+    under a hash of the file paths and every file's mtime and size.  A
+    missing cache is built with a process pool parsing the XML files.
+    """
+    annofiles = [os.path.expanduser(f) for f in annofiles]
+    cache = os.path.join(os.path.expanduser(cachedir), 'voc_gt_' + file_key(annofiles))
+    if os.path.isdir(cache):
+        return load_arrays(cache)
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        recs = pool.map(parse_rec, annofiles, chunksize=64)
+    finally:
+        pool.close()
+        pool.join()
+    objs = [obj for objects in recs for obj in objects]
+    names, label = np.unique(np.array([obj['name'] for obj in objs], dtype=str),
+                             return_inverse=True)
+    poses, pose = np.unique(np.array([obj['pose'] for obj in objs], dtype=str),
+                            return_inverse=True)
+    gt = {'offsets': np.concatenate(([0], np.cumsum([len(r) for r in recs]))).astype(np.int64),
+          'bbox': np.array([obj['bbox'] for obj in objs], dtype=np.int32).reshape(-1, 4),
+          'label': label.astype(np.int32),
+          'names': names,
+          'difficult': np.array([obj['difficult'] for obj in objs], dtype=bool),
+          'truncated': np.array([obj['truncated'] for obj in objs], dtype=bool),
+          'pose': pose.astype(np.int32),
+          'poses': poses}
+    save_arrays(cache, gt)
+    return gt
+
+def load_gt():
+    """Image names of val_file and their parsed annotations."""
     eval_images = []
     f = open(val_file, 'r')
     for i in f:
         eval_images.append(i.strip())
 
+    gt = load_gt_cache([gt_root + imagename + '.xml' for imagename in eval_images], cache_dir)
+    objects = [{'name': str(gt['names'][label]),
+                'difficult': int(difficult),
+                'bbox': bbox}
+               for label, difficult, bbox in zip(gt['label'], gt['difficult'],
+                                                 gt['bbox'].tolist())]
+    offsets = gt['offsets']
     recs = {}
-    for imagename in eval_images:
-        recs[imagename] = parse_rec(gt_root + imagename + '.xml')
+    for i, imagename in enumerate(eval_images):
+        recs[imagename] = objects[offsets[i]:offsets[i + 1]]
+    return eval_images, recs
+
+def match_class(filename, classname, gt=None):
+    """Detections of classname in filename sorted by confidence, with the
+    best overlapping object of each in its image.  None of it depends on
+    the IoU threshold, so one match serves every threshold.
+    gt: (eval_images, recs) from load_gt(), loaded here if not given
+    Returns (image_ids, ovmax, jmax, difficult, npos): ovmax is -inf for a
+    detection in an image without objects of the class, difficult maps an
+    image to the difficult flags of its objects.
+    """
+    if gt is None:
+        gt = load_gt()
+    eval_images, recs = gt
 
     class_recs = {}
 
@@ -81,34 +170,29 @@ def voc_eval(filename, classname, ovthresh=0.5, use_07_metric=False):
     for imagename in eval_images:
         R = [obj for obj in recs[imagename] if obj['name'] == classname]
         bbox = np.array([x['bbox'] for x in R])
-        difficult = np.array([x['difficult'] for x in R]).astype(np.bool)
-        det = [False] * len(R)
+        difficult = np.array([x['difficult'] for x in R]).astype(bool)
         npos = npos + sum(~difficult)
         class_recs[imagename] = {'bbox': bbox,
-                                 'difficult': difficult,
-                                 'det': det}
-    detfile = det_root + 'comp4' + '_det' + '_test_' + classname + '.txt'
-    with open(detfile, 'r') as f:
+                                 'difficult': difficult}
+    with open(filename, 'r') as f:
         lines = f.readlines()
     splitlines = [x.strip().split(' ') for x in lines]
     image_ids = [x[0] for x in splitlines]
     confidence = np.array([float(x[1]) for x in splitlines])
-    BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
+    BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 4)
 
     # sort by confidence
     sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
     BB = BB[sorted_ind, :]
     image_ids = [image_ids[x] for x in sorted_ind]
 
-    # go down dets and mark TPs and FPs
+    # best overlapping object of every detection
     nd = len(image_ids)
-    tp = np.zeros(nd)
-    fp = np.zeros(nd)
+    ovmax = np.full(nd, -np.inf)
+    jmax = np.zeros(nd, dtype=int)
     for d in range(nd):
         R = class_recs[image_ids[d]]
         bb = BB[d, :].astype(float)
-        ovmax = -np.inf
         BBGT = R['bbox'].astype(float)
 
         if BBGT.size > 0:
@@ -128,14 +212,27 @@ def voc_eval(filename, classname, ovthresh=0.5, use_07_metric=False):
                    (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
 
             overlaps = inters / uni
-            ovmax = np.max(overlaps)
-            jmax = np.argmax(overlaps)
+            ovmax[d] = np.max(overlaps)
+            jmax[d] = np.argmax(overlaps)
+
+    difficult = dict((imagename, R['difficult']) for imagename, R in class_recs.items())
+    return image_ids, ovmax, jmax, difficult, npos
+
+def rec_prec(match, ovthresh=0.5):
+    """Recall and precision of a match_class() result at IoU ovthresh."""
+    image_ids, ovmax, jmax, difficult, npos = match
 
-        if ovmax > ovthresh:
-            if not R['difficult'][jmax]:
-                if not R['det'][jmax]:
+    # go down dets and mark TPs and FPs
+    det = dict((imagename, [False] * len(d)) for imagename, d in difficult.items())
+    nd = len(image_ids)
+    tp = np.zeros(nd)
+    fp = np.zeros(nd)
+    for d in range(nd):
+        if ovmax[d] > ovthresh:
+            if not difficult[image_ids[d]][jmax[d]]:
+                if not det[image_ids[d]][jmax[d]]:
                     tp[d] = 1.
-                    R['det'][jmax] = 1
+                    det[image_ids[d]][jmax[d]] = 1
                 else:
                     fp[d] = 1.
         else:
@@ -148,18 +245,24 @@ def voc_eval(filename, classname, ovthresh=0.5, use_07_metric=False):
     # avoid divide by zero in case the first detection matches a difficult
     # ground truth
     prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    return rec, prec
+
+def voc_eval(filename, classname, ovthresh=0.5, use_07_metric=False, gt=None):
+    """gt: (eval_images, recs) from load_gt(), loaded here if not given"""
+    rec, prec = rec_prec(match_class(filename, classname, gt), ovthresh)
     ap = voc_ap(rec, prec, use_07_metric)
 
     return rec, prec, ap
 
 def compute_ap():
 
+    gt = load_gt()
     aps = []
     for i, cls in enumerate(_classes):
         if cls == '__background__':
             continue
         filename = det_root + 'comp4' + '_det' + '_test_' + cls + '.txt'
-        rec, prec, ap = voc_eval(filename, cls, ovthresh=0.5, use_07_metric=True)
+        rec, prec, ap = voc_eval(filename, cls, ovthresh=0.5, use_07_metric=True, gt=gt)
 
         aps += [ap]
         print('AP for {} = {:.4f}'.format(cls, ap))
@@ -173,8 +276,62 @@ def compute_ap():
     print('{:.3f}'.format(np.mean(aps)))
     print('~~~~~~~~')
 
+# state of a compute_ap_table worker: the ground truth, handed over once
+# per process, and the match of the last class it saw
+_worker = {}
+
+def _init_worker(gt):
+    _worker.clear()
+    _worker['gt'] = gt
+
+def _eval_unit(unit):
+    cls, ovthresh, use_07_metric = unit
+    if _worker.get('class') != cls:
+        # overlaps do not depend on the threshold: match once per class
+        filename = det_root + 'comp4' + '_det' + '_test_' + cls + '.txt'
+        _worker['class'] = cls
+        _worker['match'] = match_class(filename, cls, _worker['gt'])
+    rec, prec = rec_prec(_worker['match'], ovthresh)
+    return voc_ap(rec, prec, use_07_metric)
+
+def compute_ap_table(ovthreshs=np.linspace(.5, .95, 10), use_07_metric=True, processes=None):
+    """AP of every class at every IoU threshold, (class, threshold) units
+    spread over a process pool.  The annotations are parsed once and reach
+    each worker through the pool initializer, not with every task, and units
+    are dealt out class by class so a worker reads and matches the
+    detections of a class once for all of its thresholds.
+    Returns ap [len(ovthreshs), num_classes-1].
+    """
+    ovthreshs = list(ovthreshs)
+    classes = [cls for cls in _classes if cls != '__background__']
+    units = [(cls, t, use_07_metric) for cls in classes for t in ovthreshs]
+    pool = multiprocessing.Pool(processes, _init_worker, (load_gt(),))
+    try:
+        aps = pool.map(_eval_unit, units, chunksize=len(ovthreshs))
+    finally:
+        pool.close()
+        pool.join()
+    aps = np.array(aps).reshape(len(classes), len(ovthreshs)).T
+
+    print('AP@IoU  ' + ' '.join('{:>5.2f}'.format(t) for t in ovthreshs) + '   mean')
+    for cls, ap in zip(classes, aps.T):
+        print('{:<8.8s} '.format(cls) + ' '.join('{:.3f}'.format(a) for a in ap) +
+              '  {:.3f}'.format(ap.mean()))
+    print('mAP     ' + ' '.join('{:.3f}'.format(a) for a in aps.mean(1)) +
+          '  {:.3f}'.format(aps.mean()))
+    return aps
+
 if __name__ == '__main__':
-    compute_ap()
+    parser = argparse.ArgumentParser(description='VOC07 test AP')
+    parser.add_argument('--table', action='store_true',
+                        help='AP table over IoU 0.5:0.95 in a process pool')
+    parser.add_argument('--processes', default=None, type=int,
+                        help='Pool size for --table, default cpu count')
+    args = parser.parse_args()
+    if args.table:
+        compute_ap_table(processes=args.processes)
+    else:
+        compute_ap()
 
 
 